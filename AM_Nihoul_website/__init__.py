@@ -1,8 +1,8 @@
 ___version__ = '0.8.3'
 
+import os
 import pathlib
 import shutil
-import time
 from datetime import timedelta
 
 import click
@@ -46,10 +46,38 @@ class Config:
         'render_as_batch': True
     }
 
+    # navigation (menus, contact), cached in each process and invalidated on change, but other processes only see
+    # the change after this delay (in seconds, `None` to never expire)
+    NAVIGATION_CACHE_TIMEOUT = 300
+
+    # cache of the pages served to anonymous visitors: `None` (disabled), 'memory' (in each process, so other
+    # processes only see a change after the timeout) or 'filesystem' (in `DATA_DIRECTORY/cache`, shared)
+    RESPONSE_CACHE = None
+    RESPONSE_CACHE_TIMEOUT = 600  # in seconds, `None` to never expire
+    RESPONSE_CACHE_MAX_ENTRIES = 1000  # then, the least recently used are evicted (`None` for no limit)
+
     # upload
     UPLOADED_PICTURES_URL = '/photos/'
     UPLOAD_CONVERT_TO_JPG = 250 * 1024
+    UPLOAD_MAX_DIMENSION = 2000  # pasted images are downscaled to fit in a square of that size (`None` for no limit)
+    CHUNKED_UPLOAD_SIZE = 2 * 1024 * 1024  # Dropzone sends the files by chunks of that size (see `uploads.py`)
+    CHUNKED_UPLOAD_MAX_SIZE = 256 * 1024 * 1024  # larger files are refused (by Dropzone as well)
+    CHUNKED_UPLOAD_TIMEOUT = timedelta(days=1)  # then, the chunks of an upload which is not complete are removed
     PICTURE_THUMB_SIZE = (400, 300)
+    PICTURE_VARIANTS_WIDTHS = (800, 1600, 2400)  # smaller versions of the pictures, picked by browsers (`srcset`)
+    PICTURE_VARIANTS_FORMATS = ('webp', 'jpeg')  # the first one is preferred
+    THUMBNAIL_WORKERS = 2  # processes generating the thumbnails after the upload (`0` to do it in the request)
+    THUMBNAIL_TIMEOUT = timedelta(minutes=10)  # then, a thumbnail still pending is generated by the bot
+    ALBUM_PAGE_SIZE = 48  # pictures per page of an album (the next pages are loaded while scrolling)
+
+    # pictures URLs are versioned (`?v=`), so they are cached for that long (in seconds); the web server can
+    # serve `UPLOADED_PICTURES_URL` from `DATA_DIRECTORY/pictures` with the same `Cache-Control` instead
+    PICTURES_MAX_AGE = 365 * 24 * 3600
+
+    # downloads are streamed, unless the web server sends them: `USE_X_SENDFILE = True` (Apache, lighttpd) or
+    # `X_ACCEL_REDIRECT_PREFIX = '/protected/'` (nginx, with an `internal` location aliased to the uploads directory)
+    USE_X_SENDFILE = False
+    X_ACCEL_REDIRECT_PREFIX = None
 
     # newsletter
     REMOVE_RECIPIENTS_DELTA = timedelta(days=5)
@@ -58,6 +86,16 @@ class Config:
     USE_FAKE_MAIL_SENDER = False
     LAUNCH_BOT = True
     BOT_SERVICE_NAME = None
+    BOT_WORKERS = 4  # number of threads sending the emails
+    BOT_BATCH_SIZE = 50  # the emails are loaded by batches, and the progress is committed after each one
+    BOT_EMAILS_PER_MINUTE = 120  # quota (of each process), the other emails wait (`None` for no limit)
+    BOT_EMAILS_PER_ITERATION = 500  # the other emails wait for the next iteration (`None` for no limit)
+    BOT_LEASE = timedelta(minutes=10)  # emails are claimed for that long, then others can send them
+    BOT_MAX_ATTEMPTS = 5  # then, the email is marked as failed (see the admin)
+    BOT_RETRY_DELAY = timedelta(minutes=1)  # doubled after each attempt
+    BOT_THROTTLE_DELAY = timedelta(minutes=15)  # emails throttled by Gmail are postponed that long (not an attempt)
+    BOT_POLL_INTERVAL = 1  # `flask bot` checks for changes in the database that often (in seconds)
+    ARCHIVE_EMAILS_DELTA = timedelta(days=90)  # see `flask archive-emails`
     NEWSLETTER_LOGO = 'AM_Nihoul_website/assets/images/newsletter_logo.png'
 
     # scheduler
@@ -179,10 +217,105 @@ def init_command():
 @click.command('bot')
 @with_appcontext
 def bot_command():
+    """Run the bot in this process (stop it with SIGINT or SIGTERM)"""
+
     from AM_Nihoul_website import bot
-    while True:
-        bot.bot_iteration()
-        time.sleep(current_app.config['JOBS'][0]['seconds'])
+    bot.Worker(current_app.config['JOBS'][0]['seconds'], current_app.config['BOT_POLL_INTERVAL']).run()
+
+
+@click.command('archive-emails')
+@click.option('--delete', is_flag=True, help='delete the emails instead of archiving them')
+@with_appcontext
+def archive_emails_command(delete):
+    """Move the emails sent more than `ARCHIVE_EMAILS_DELTA` ago out of the table of emails"""
+
+    from AM_Nihoul_website.base_models import utcnow
+    from AM_Nihoul_website.visitor.models import Email
+
+    n = Email.archive(utcnow() - current_app.config['ARCHIVE_EMAILS_DELTA'], delete=delete)
+    db.session.commit()
+
+    print('!! {} email(s) {}'.format(n, 'deleted' if delete else 'archived'))
+
+
+@click.group('pictures')
+def pictures_command():
+    """Manage the pictures of the albums"""
+
+
+@pictures_command.command('rebuild')
+@click.option('--workers', type=int, default=None, help='number of processes (default: number of cores)')
+@click.option('--force', is_flag=True, help='also rebuild the pictures which are up to date')
+@with_appcontext
+def pictures_rebuild_command(workers, force):
+    """(Re)generate the thumbnail and variants of the pictures which were not generated with the current settings
+    (`PICTURE_THUMB_SIZE`, `PICTURE_VARIANTS_WIDTHS` and `PICTURE_VARIANTS_FORMATS`). If interrupted, run it again.
+    """
+
+    from AM_Nihoul_website import thumbnails
+
+    done, failed, total = 0, 0, 0
+    for done, failed, total in thumbnails.rebuild(workers, force):
+        print('!! {}/{} picture(s) rebuilt'.format(done + failed, total))
+
+    print('!! {} picture(s) rebuilt, {} failure(s)'.format(done, failed))
+
+
+@click.command('deduplicate')
+@with_appcontext
+def deduplicate_command():
+    """Store the files uploaded before the blob store by content (the files with the same content are then stored
+    only once). Their previous paths are kept as links to the blobs, so that the previous URLs still work.
+    If interrupted, run it again.
+    """
+
+    from AM_Nihoul_website import uploads
+    from AM_Nihoul_website.visitor.models import Blob, UploadedFile, Picture
+
+    for model, upload_set, name_attribute in (
+            (UploadedFile, uploads_set, 'file_name'), (Picture, pictures_set, 'picture_name')):
+        n, saved = 0, 0
+        for o in model.query.filter(model.blob_id.is_(None)).all():
+            name = getattr(o, name_attribute)
+            path = upload_set.path(name)
+            if not os.path.exists(path):
+                print('!! missing file for {} {}'.format(model.__tablename__, o.id))
+                continue
+
+            size = os.path.getsize(path)
+            o.blob = Blob.store(upload_set, uploads.CompletedUpload(name, uploads.link_to_chunks(path)), name)
+            if o.blob.refcount > 1:  # the content was already stored
+                saved += size
+
+            db.session.add(o)
+            db.session.commit()
+
+            uploads.link(o.blob.path(), path)
+            n += 1
+
+        print('!! {} {} stored by content, {} bytes saved'.format(n, model.__tablename__, saved))
+
+
+@click.command('summaries')
+@click.option('--all', 'all_', is_flag=True, help='also recompute the summaries that are already stored')
+@with_appcontext
+def summaries_command(all_):
+    """Compute (and store) the content with summary of pages, briefs and newsletters which lack it"""
+
+    from AM_Nihoul_website.visitor.models import Page, Brief, Newsletter
+
+    for model in (Page, Brief, Newsletter):
+        query = model.query
+        if not all_:
+            query = query.filter(model.summarized_content.is_(None))
+
+        objects = query.all()
+        for o in objects:
+            o.update_summarized_content()
+            db.session.add(o)
+
+        db.session.commit()
+        print('!! {} {} updated'.format(len(objects), model.__tablename__))
 
 
 def create_app(instance_relative_config=True):
@@ -218,6 +351,10 @@ def create_app(instance_relative_config=True):
     # add cli
     app.cli.add_command(init_command)
     app.cli.add_command(bot_command)
+    app.cli.add_command(summaries_command)
+    app.cli.add_command(archive_emails_command)
+    app.cli.add_command(pictures_command)
+    app.cli.add_command(deduplicate_command)
 
     # add blueprint(s)
     from AM_Nihoul_website.visitor.views import visitor_blueprint
@@ -3,10 +3,12 @@ Utils functions to send an email via Gmail, extended to accept embedded files. M
 https://github.com/jeremyephron/simplegmail/blob/66e776d5211042b2868664ca800bdfc45323732c/simplegmail/gmail.py
 """
 
-from typing import Optional, List
+from typing import Optional, List, Tuple
 import base64
 import mimetypes
 import pathlib
+import queue
+import threading
 
 from PIL import Image
 
@@ -24,8 +26,30 @@ from oauth2client import client, file, tools
 from oauth2client.clientsecrets import InvalidClientSecretsError
 
 
+class AttachmentCache:
+    """Attachments (already encoded) which are shared by many messages.
+
+    They are keyed by path, modification time, disposition and cid, so that a file is read and encoded only once.
+    """
+
+    def __init__(self):
+        self.attachments = {}
+        self.lock = threading.Lock()
+
+    def get(self, path: pathlib.Path, disposition: str = 'attachment', cid: str = None) -> MIMEBase:
+        key = (str(path), path.stat().st_mtime_ns, disposition, cid)
+
+        with self.lock:
+            if key not in self.attachments:
+                self.attachments[key] = Message.create_attachment_from_file(path, disposition, cid)
+
+            return self.attachments[key]
+
+
 class Message:
-    """Class representing a message, ready to be sent
+    """Class representing a message, ready to be sent.
+
+    If ``attachment_cache`` is given, the attachments are taken from (and shared through) it.
     """
 
     def __init__(
@@ -37,7 +61,8 @@ class Message:
         msg_plain: str = '',
         cc: Optional[List[str]] = None,
         bcc: Optional[List[str]] = None,
-        reply_to: Optional[str] = None
+        reply_to: Optional[str] = None,
+        attachment_cache: Optional[AttachmentCache] = None
     ):
         self.sender = sender
         self.recipient = recipient
@@ -47,6 +72,7 @@ class Message:
         self.cc = [] if cc is None else cc
         self.bcc = [] if bcc is None else bcc
         self.reply_to = reply_to
+        self.attachment_cache = attachment_cache
 
         self.html_attachments: List[MIMEBase] = []
         self.extra_attachments: List[MIMEBase] = []
@@ -54,8 +80,7 @@ class Message:
     def add_attachment(self, path: pathlib.Path) -> None:
         """Attach a file as a normal attachment"""
 
-        attachment = Message.create_attachment_from_file(path)
-        self.extra_attachments.append(attachment)
+        self.extra_attachments.append(self.create_attachment(path))
 
     def add_html_attachment(self, path: pathlib.Path, cid: str = None) -> None:
         """Add a HTML inline attachment (to be embedded).
@@ -66,8 +91,13 @@ class Message:
         if cid is None:
             cid = path.name
 
-        attachment = Message.create_attachment_from_file(path, 'inline', cid)
-        self.html_attachments.append(attachment)
+        self.html_attachments.append(self.create_attachment(path, 'inline', cid))
+
+    def create_attachment(self, path: pathlib.Path, disposition: str = 'attachment', cid: str = None) -> MIMEBase:
+        if self.attachment_cache is not None:
+            return self.attachment_cache.get(path, disposition, cid)
+
+        return Message.create_attachment_from_file(path, disposition, cid)
 
     @staticmethod
     def create_attachment_from_file(path: pathlib.Path, disposition: str = 'attachment', cid: str = None) -> MIMEBase:
@@ -199,6 +229,7 @@ class Gmail:
                 self.creds = tools.run_flow(flow, store)
 
             self.service = build('gmail', 'v1', http=self.creds.authorize(Http()), cache_discovery=False)
+            self.https = queue.SimpleQueue()
 
         except InvalidClientSecretsError:
             raise FileNotFoundError(
@@ -215,14 +246,81 @@ class Gmail:
 
         msg = message.prepare()
 
+        # `Http` is not thread-safe, so each send borrows one (and its kept-alive connection) from the pool.
+        # The token is refreshed (and stored) by the authorized `Http` when it expires.
+        try:
+            http = self.https.get_nowait()
+        except queue.Empty:
+            http = self.creds.authorize(Http())
+
         try:
             req = self.service.users().messages().send(userId=user_id, body=msg)
-            req.execute()
+            req.execute(http=http)
 
         except HttpError as error:
             # Pass along the error
             raise error
 
+        finally:
+            self.https.put(http)
+
+    @staticmethod
+    def is_auth_error(error: Exception) -> bool:
+        """Whether the client should be rebuilt after ``error``"""
+
+        if isinstance(error, client.AccessTokenRefreshError):
+            return True
+
+        return isinstance(error, HttpError) and error.resp.status == 401
+
+    @staticmethod
+    def is_rate_limit_error(error: Exception) -> bool:
+        return isinstance(error, HttpError) and error.resp.status == 429
+
+
+# EXIF orientation (tag 0x0112) -> transposition that makes the image upright
+TRANSPOSITIONS = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+SWAPPING_ORIENTATIONS = (5, 6, 7, 8)  # width and height are exchanged
+
+
+def get_orientation(image: Image) -> int:
+    return image.getexif().get(0x0112, 1)
+
+
+def upright_size(image: Image, orientation: int) -> Tuple[int, int]:
+    """Size of ``image`` once transposed following its orientation"""
+
+    return image.size[::-1] if orientation in SWAPPING_ORIENTATIONS else image.size
+
+
+def downscale(image: Image, size: Tuple[int, int], orientation: int = 1) -> Image:
+    """Downscaled (and upright) copy of ``image``, of ``size`` (once transposed following its orientation).
+
+    If ``image`` is not loaded yet, a JPEG is decoded at a lower scale (down to 1/8, see ``Image.draft()``), then
+    it is reduced by an integer factor before being resampled (see ``Image.reduce()``), so that the full resolution
+    image never lies in memory. The orientation is applied last, on the small image.
+    """
+
+    if orientation in SWAPPING_ORIENTATIONS:
+        size = size[::-1]
+
+    image.draft(image.mode, size)
+    image = image.resize(size, Image.LANCZOS, reducing_gap=Thumbnailer.REDUCING_GAP)
+
+    if orientation in TRANSPOSITIONS:
+        image = image.transpose(TRANSPOSITIONS[orientation])
+
+    return image
+
 
 class Thumbnailer:
     """
@@ -230,6 +328,8 @@ class Thumbnailer:
     Ensure that the image will have exactly the specified size, by resizing then cropping the original one.
     """
 
+    REDUCING_GAP = 3.0  # the image is reduced by an integer factor down to that many times the final size
+
     def __init__(
             self,
             width: int,
@@ -240,20 +340,12 @@ class Thumbnailer:
         self.ratio = width / height
 
     def transform(self, image: Image) -> Image:
+        """Thumbnail of ``image``, which is drafted if it is not loaded yet (see ``downscale()``)"""
 
-        # rotate file based on the exif tag, if any
-        try:
-            rot = image._getexif()[0x0112]
-        except KeyError:
-            rot = 0
-
-        rotate = {3: 180, 6: 270, 8: 90}
-
-        if rot in rotate:
-            image = image.rotate(rotate[rot], expand=True)
+        orientation = get_orientation(image)
 
-        # get the new size and resize
-        size = image.size
+        # get the new size (of the upright image) and resize
+        size = upright_size(image, orientation)
         ratio = size[0] / size[1]
 
         if ratio > self.ratio:  # then the height is used
@@ -261,7 +353,7 @@ class Thumbnailer:
         else:
             new_size = self.width, int(self.width / ratio)
 
-        image = image.resize(new_size)
+        image = downscale(image, new_size, orientation)
 
         # crop
         if ratio > self.ratio:
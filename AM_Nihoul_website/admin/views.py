@@ -8,26 +8,27 @@ from flask_uploads import UploadNotAllowed
 from PIL import Image
 from bs4 import BeautifulSoup
 
+import sqlalchemy
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
 
 from werkzeug.datastructures import FileStorage
 
-import base64
 import io
+import os
 from datetime import datetime
 import re
 import subprocess
 
 import AM_Nihoul_website
-from AM_Nihoul_website import db, User, limiter, pictures_set
-from AM_Nihoul_website.admin.utils import Thumbnailer
+from AM_Nihoul_website import db, User, limiter, pictures_set, thumbnails, uploads, uploads_set
 from AM_Nihoul_website.base_views import FormView, BaseMixin, RenderTemplateView, ObjectManagementMixin, \
     DeleteObjectView
 from AM_Nihoul_website.admin.forms import LoginForm, PageEditForm, CategoryEditForm, UploadForm, NewsletterEditForm, \
     NewsletterPublishForm, MenuEditForm, AlbumEditForm, PictureUploadForm, BriefEditForm, \
     FeaturedEditForm
 from AM_Nihoul_website.visitor.models import Page, Category, UploadedFile, NewsletterRecipient, Newsletter, Email, \
-    MenuEntry, EmailImageAttachment, Album, Picture, MenuType, Brief, Featured
+    MenuEntry, EmailImageAttachment, Album, Picture, MenuType, Brief, Featured, EmailCampaign, Blob
 
 admin_blueprint = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -426,6 +427,32 @@ class FilesView(AdminBaseMixin, FormView):
 admin_blueprint.add_url_rule('/fichiers.html', view_func=FilesView.as_view('files'))
 
 
+class FilesDropzoneUpload(FilesView):
+    def get(self, *args, **kwargs):
+        return jsonify(**{'status': 'error', 'msg': 'GET'}), 403
+
+    def form_valid(self, form):
+        data = form.file_uploaded.data
+
+        try:
+            if uploads.is_chunk(flask.request.form):
+                data = uploads.receive_chunk(data, flask.request.form, uploads_set)
+                if data is None:  # wait for the other chunks
+                    return jsonify(**{'status': 'ok'}), 200
+
+            u = FilesView.upload_file(data, form.description.data)
+        except (UploadNotAllowed, uploads.ChunkError) as e:
+            return jsonify(**{'status': 'error', 'msg': str(e)}), 400
+
+        db.session.add(u)
+        db.session.commit()
+
+        return jsonify(**{'status': 'ok'}), 200
+
+
+admin_blueprint.add_url_rule('/fichiers-upload.html', view_func=FilesDropzoneUpload.as_view('files-dropzone-upload'))
+
+
 class UploadBase64(AdminBaseMixin, MethodView):
     """Upload an image as base64 encoded string"""
 
@@ -435,43 +462,22 @@ class UploadBase64(AdminBaseMixin, MethodView):
 
         context = flask.request.args.get('context', 'textarea')
 
-        if 'image' not in flask.request.form:
-            return jsonify(success=False, reason='missing `image` field'), 400
-
-        content = flask.request.form['image']
+        # the image is decoded as the request is read, unless the form was already parsed
+        if flask.request.mimetype == 'application/x-www-form-urlencoded':
+            pieces = uploads.iter_urlencoded_field(flask.request.stream, 'image')
+        else:
+            content = flask.request.form.get('image', '')
+            pieces = (content[i:i + uploads.COPY_BUFFER] for i in range(0, len(content), uploads.COPY_BUFFER))
 
-        if content[0:5] == 'data:':
-            pos = content.find(',')
-            info = content[5:pos].split(';')
+        try:
+            data = uploads.receive_data_uri(
+                pieces, '{}_{}'.format(context, datetime.now().strftime('%Y_%m_%d-%H-%M-%S')))
 
-            if info[1] != 'base64':
-                return jsonify(success=False, reason='not base64'), 400
-            if 'image/' not in info[0]:
-                return jsonify(success=False, reason='mime does not starts with `image/'), 400
-            mime = info[0]
-            ext = mime[mime.find('/') + 1:]
-            content = content[pos + 1:]
-        else:
-            return jsonify(success=False, reason='no data information'), 400
-
-        im = base64.b64decode(content)
-        source_fp = io.BytesIO(im)
-
-        # if image is larger than a given size, use jpg instead
-        if len(im) > current_app.config['UPLOAD_CONVERT_TO_JPG']:
-            image = Image.open(io.BytesIO(im))
-            source_fp = io.BytesIO()
-            image = image.convert('RGB')  # strip transparency
-            image.save(source_fp, format='jpeg')
-            ext = 'jpg'
-            source_fp.seek(0)  # rewind
-
-        data = FileStorage(
-            stream=source_fp,
-            content_type=mime,
-            name='image',
-            filename='{}_{}.{}'.format(context, datetime.now().strftime('%Y_%m_%d-%H-%M-%S'), ext)
-        )
+            # if image is larger than a given size, use jpg instead (and downscale it if it is too large)
+            data = uploads.shrink_image(
+                data, current_app.config['UPLOAD_CONVERT_TO_JPG'], current_app.config['UPLOAD_MAX_DIMENSION'])
+        except uploads.DataURIError as e:
+            return jsonify(success=False, reason=str(e)), 400
 
         try:
             u = FilesView.upload_file(data, 'Uploadé pour une infolettre')
@@ -528,6 +534,54 @@ admin_blueprint.add_url_rule(
     view_func=NewsletterRecipientDelete.as_view('newsletter-recipient-delete'))
 
 
+class EmailsFailedView(AdminBaseMixin, RenderTemplateView):
+    template_name = 'admin/emails-failed.html'
+
+    def get_context_data(self, *args, **kwargs):
+        ctx = super().get_context_data(*args, **kwargs)
+
+        ctx['emails'] = Email.query\
+            .options(joinedload(Email.recipient))\
+            .filter(Email.sent.is_(False))\
+            .filter(Email.failed.is_(True))\
+            .order_by(Email.id.desc())\
+            .all()
+
+        return ctx
+
+
+admin_blueprint.add_url_rule('/emails-echec.html', view_func=EmailsFailedView.as_view('emails-failed'))
+
+
+class EmailRetryView(AdminBaseMixin, ObjectManagementMixin, MethodView):
+    methods = ['GET']
+    model = Email
+
+    def get(self, *args, **kwargs):
+        self.get_object_or_abort(*args, **kwargs)
+        self.object.retry()
+
+        db.session.add(self.object)
+        db.session.commit()
+
+        flask.flash('L\'email "{}" sera renvoyé.'.format(self.object.title))
+        return flask.redirect(flask.url_for('admin.emails-failed'))
+
+
+admin_blueprint.add_url_rule('/email-renvoi-<int:id>.html', view_func=EmailRetryView.as_view('email-retry'))
+
+
+class EmailDelete(AdminBaseMixin, DeleteObjectView):
+    model = Email
+
+    def post_deletion(self, obj):
+        self.success_url = flask.url_for('admin.emails-failed')
+        flask.flash('Email "{}" supprimé.'.format(obj.title))
+
+
+admin_blueprint.add_url_rule('/email-suppression-<int:id>.html', view_func=EmailDelete.as_view('email-delete'))
+
+
 class NewslettersView(AdminBaseMixin, FormView):
     template_name = 'admin/newsletters.html'
     form_class = NewsletterPublishForm
@@ -722,6 +776,19 @@ class NewsletterPublishView(AdminBaseMixin, ObjectManagementMixin, FormView):
         else:
             return g.group('begin') + 'src="{}"'.format(g.group('path')) + g.group('end')
 
+    def render_body(self, content: str) -> str:
+        """Render the email, with placeholders for the recipient"""
+
+        return flask.render_template(
+            'newsletter/newsletter.html',
+            **{
+                'site_name': AM_Nihoul_website.WEBPAGE_INFO['site_name'],
+                'newsletter': self.object,
+                'transformed_content': content,
+                **EmailCampaign.placeholders()
+            }
+        )
+
     def form_valid(self, form):
         self.success_url = flask.url_for('admin.newsletters')
         if not self.object.draft:
@@ -751,37 +818,44 @@ class NewsletterPublishView(AdminBaseMixin, ObjectManagementMixin, FormView):
                 lambda g: NewsletterPublishView.replace_image(g, possible_attachments, actual_attachments), content)
 
             db.session.add(self.object)
-            db.session.commit()
 
-            # schedule emailing
-            recipients = NewsletterRecipient.query.filter(NewsletterRecipient.confirmed.is_(True)).all()
-            emails = []
-            for r in recipients:
-                e = Email.create(
-                    'Infolettre: {}'.format(self.object.title),
-                    flask.render_template(
-                        'newsletter/newsletter.html',
-                        **{
-                            'site_name': AM_Nihoul_website.WEBPAGE_INFO['site_name'],
-                            'newsletter': self.object,
-                            'transformed_content': content,
-                            'recipient': r,
-                        }
-                    ),
-                    r.id)
-                emails.append(e)
-                db.session.add(e)
+            # schedule emailing: the content is shared, only the variables depend on the recipient
+            title = 'Infolettre: {}'.format(self.object.title)
+            campaign = EmailCampaign.create(title, self.render_body(content), self.object.id)
+            db.session.add(campaign)
+            db.session.flush()
+
+            recipients = db.session.execute(
+                sqlalchemy.select(NewsletterRecipient.id, NewsletterRecipient.name, NewsletterRecipient.hash)
+                .where(NewsletterRecipient.confirmed.is_(True))
+                .order_by(NewsletterRecipient.id)
+            ).all()
+
+            if len(recipients) > 0:
+                email_ids = db.session.scalars(
+                    sqlalchemy.insert(Email).returning(Email.id, sort_by_parameter_order=True),
+                    [{
+                        'title': title,
+                        'campaign_id': campaign.id,
+                        'variables': {
+                            'recipient_name': r.name,
+                            'unsubscribe_link': flask.url_for(
+                                'visitor.newsletter-unsubscribe', id=r.id, hash=r.hash, _external=True)
+                        },
+                        'recipient_id': r.id,
+                        'sent': False
+                    } for r in recipients]
+                ).all()
+
+                # add attachments
+                if len(actual_attachments) > 0:
+                    db.session.execute(
+                        sqlalchemy.insert(EmailImageAttachment),
+                        [{'email_id': e, 'image_id': a.id} for e in email_ids for a in actual_attachments]
+                    )
 
             db.session.commit()
 
-            # add attachments
-            if len(actual_attachments) > 0:
-                for e in emails:
-                    for a in actual_attachments:
-                        db.session.add(EmailImageAttachment.create(e.id, a.id))
-
-                db.session.commit()
-
             flask.flash('Infolettre "{}" publiée.'.format(self.object.title))
 
         return super().form_valid(form)
@@ -946,7 +1020,7 @@ class AlbumView(AdminBaseMixin, ObjectManagementMixin, FormView):
         ctx = super().get_context_data(*args, **kwargs)
 
         ctx['album'] = self.object
-        ctx['pictures'] = sorted(self.object.pictures, key=lambda k: k.date_taken)
+        ctx['pictures'] = self.object.ordered_pictures().options(selectinload(Picture.blob)).all()
         ctx['total_size'] = sum(f.picture_size for f in ctx['pictures'])
 
         return ctx
@@ -971,19 +1045,25 @@ class AlbumView(AdminBaseMixin, ObjectManagementMixin, FormView):
         filename = '{}.{}'.format(basename, ext)
         filename_thumb = '{}_thumb.{}'.format(basename, ext)
 
-        # save image:
-        r_filename = pictures_set.save(data, name=filename)
+        # receive image:
+        filename = uploads.get_name(pictures_set, filename)
+        data = uploads.receive(data)
+
+        try:  # only reads the header, the thumbnail is generated later
+            with Image.open(data.path) as image:
+                image_format = image.format
+        except OSError:
+            image_format = None
 
-        # create thumbnail:
-        image = Thumbnailer(*current_app.config['PICTURE_THUMB_SIZE'])\
-            .transform(Image.open(pictures_set.path(r_filename)))
+        if image_format is None:
+            os.remove(data.path)
+            raise UploadNotAllowed("Ce fichier n'est pas une image")
 
-        thumb_fp = io.BytesIO()
-        image.save(thumb_fp, format='jpeg', quality=85, optimize=True)
-        thumb_fp.seek(0)  # rewind
+        blob = Blob.store(pictures_set, data, filename)
 
+        # reserve the name of the thumbnail
         data_thumb = FileStorage(
-            stream=thumb_fp,
+            stream=io.BytesIO(),
             content_type='image/jpeg',
             name='thumbnail',
             filename=filename_thumb
@@ -992,16 +1072,13 @@ class AlbumView(AdminBaseMixin, ObjectManagementMixin, FormView):
         r_filename_thumb = pictures_set.save(data_thumb, name=filename_thumb)
 
         # create object
-        try:
-            date_taken = datetime.strptime(image.getexif()[306], '%Y:%m:%d %H:%M:%S')
-        except KeyError:
-            date_taken = datetime.now()
-
         picture = Picture.create(
-            filename=r_filename,
+            filename=filename,
             filename_thumb=r_filename_thumb,
             album=self.object,
-            date_taken=date_taken
+            date_taken=datetime.now(),
+            thumbnail_pending=True,
+            blob=blob
         )
 
         return picture
@@ -1016,6 +1093,8 @@ class AlbumView(AdminBaseMixin, ObjectManagementMixin, FormView):
         db.session.add(picture)
         db.session.commit()
 
+        thumbnails.submit(picture)
+
         self.success_url = flask.url_for('admin.album', id=self.object.id)
         return super().form_valid(form)
 
@@ -1028,14 +1107,23 @@ class AlbumDropzoneUpload(AlbumView):
         return jsonify(**{'status': 'error', 'msg': 'GET'}), 403
 
     def form_valid(self, form):
+        data = form.file_uploaded.data
+
         try:
-            picture = self.upload_picture(form.file_uploaded.data)
-        except UploadNotAllowed as e:
+            if uploads.is_chunk(flask.request.form):
+                data = uploads.receive_chunk(data, flask.request.form, pictures_set)
+                if data is None:  # wait for the other chunks
+                    return jsonify(**{'status': 'ok'}), 200
+
+            picture = self.upload_picture(data)
+        except (UploadNotAllowed, uploads.ChunkError) as e:
             return jsonify(**{'status': 'error', 'msg': str(e)}), 400
 
         db.session.add(picture)
         db.session.commit()
 
+        thumbnails.submit(picture)  # in the background, so that the next file can be sent
+
         return jsonify(**{'status': 'ok'}), 200
 
 
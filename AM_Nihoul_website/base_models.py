@@ -1,6 +1,14 @@
+import datetime
+
 from AM_Nihoul_website import db
 
 
+def utcnow() -> datetime.datetime:
+    """Current date, from the same clock as ``CURRENT_TIMESTAMP`` (UTC), which fills the dates of the models"""
+
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
 class BaseModel(db.Model):
     __abstract__ = True
 
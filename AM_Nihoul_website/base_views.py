@@ -1,10 +1,24 @@
+import collections
+import datetime
+import hashlib
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlencode
+
 import flask
 from flask.views import MethodView
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import event
+from werkzeug.http import is_resource_modified
+from sqlalchemy.orm import Session, object_session
 
 import AM_Nihoul_website
 from AM_Nihoul_website import db
+from AM_Nihoul_website.response_cache import ResponseCache, response_cache, tags_of
 from AM_Nihoul_website.visitor.forms import NewsletterForm
-from AM_Nihoul_website.visitor.models import MenuType
+from AM_Nihoul_website.visitor.models import MenuType, MenuEntry, Category, Page
 
 
 class RenderTemplateView(MethodView):
@@ -149,6 +163,120 @@ class DeleteObjectView(ObjectManagementMixin, DeleteView):
         return self._get_object(*args, **kwargs)
 
 
+# --- Navigation
+NavigationMenuEntry = collections.namedtuple('NavigationMenuEntry', ['id', 'text', 'url', 'highlight', 'position'])
+NavigationPage = collections.namedtuple('NavigationPage', ['id', 'title', 'slug'])
+ContactPage = collections.namedtuple('ContactPage', ['id', 'title', 'slug', 'content'])
+Navigation = collections.namedtuple('Navigation', [
+    'main_menu', 'secondary_menu', 'bottom_menu', 'contact_page', 'date_built', 'date_modified', 'digest'])
+
+
+class NavigationCache:
+    """Process-level cache of the navigation data (menus, bottom menu and contact page).
+
+    The data is stored as plain tuples (so that it survives the end of the session that fetched it) and is
+    invalidated whenever a ``MenuEntry``, a ``Category`` or a ``Page`` is committed by this process.
+    Since other processes are not notified, it also expires after ``NAVIGATION_CACHE_TIMEOUT`` seconds.
+    """
+
+    EXTENSION_NAME = 'navigation_cache'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def _storage(self) -> dict:
+        return flask.current_app.extensions.setdefault(self.EXTENSION_NAME, {})
+
+    def get(self) -> Navigation:
+        storage = self._storage()
+        timeout = flask.current_app.config['NAVIGATION_CACHE_TIMEOUT']
+
+        with self.lock:
+            navigation = storage.get('navigation')
+            if navigation is None or (timeout is not None and time.time() - navigation.date_built > timeout):
+                navigation = storage['navigation'] = self.build()
+
+        return navigation
+
+    def invalidate(self):
+        with self.lock:
+            self._storage().pop('navigation', None)
+
+    @staticmethod
+    def build() -> Navigation:
+        """Fetch everything (in three queries)"""
+
+        dates_modified = []
+
+        # menus
+        main_menu, secondary_menu = [], []
+        for m in MenuEntry.ordered_items().all():
+            entry = NavigationMenuEntry(m.id, m.text, m.url, m.highlight, m.position)
+            (main_menu if m.position is MenuType.main else secondary_menu).append(entry)
+            dates_modified.append(m.date_modified)
+
+        # bottom menu
+        pages = {}
+        contact_page = None
+        contact_page_id = flask.current_app.config['PAGES']['contact_page']
+
+        # (only the content of the contact page is displayed, thus kept)
+        query = Page.query\
+            .with_entities(
+                Page.id, Page.title, Page.slug, Page.category_id, Page.date_modified,
+                db.case((Page.id == contact_page_id, Page.content)).label('content'))\
+            .filter(db.or_(Page.category_id.isnot(None), Page.id == contact_page_id))
+
+        for p in query.all():
+            dates_modified.append(p.date_modified)
+
+            if p.id == contact_page_id:
+                contact_page = ContactPage(p.id, p.title, p.slug, p.content)
+
+            if p.category_id is not None:
+                pages.setdefault(p.category_id, []).append(NavigationPage(p.id, p.title, p.slug))
+
+        bottom_menu = {}
+        for c in Category.ordered_items().filter(Category.visible.is_(True)):
+            if c.id in pages:
+                bottom_menu[c.name] = pages[c.id]
+                dates_modified.append(c.date_modified)
+
+        # since deletions are not visible in the dates, also make a digest of the content
+        digest = hashlib.sha1(repr((main_menu, secondary_menu, bottom_menu, contact_page)).encode()).hexdigest()
+
+        return Navigation(
+            main_menu, secondary_menu, bottom_menu, contact_page,
+            time.time(), max((d for d in dates_modified if d is not None), default=None), digest)
+
+
+navigation_cache = NavigationCache()
+
+
+def _navigation_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['navigation_changed'] = True
+
+
+for model in (MenuEntry, Category, Page):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, event_name, _navigation_changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_navigation_after_commit(session):
+    """Drop the navigation cache once a change to the navigation is committed"""
+
+    if session.info.pop('navigation_changed', False) and flask.has_app_context():
+        navigation_cache.invalidate()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_navigation_after_rollback(session, previous_transaction):
+    session.info.pop('navigation_changed', None)
+
+
 # --- Other mixins
 class BaseMixin:
     """Add a few variables to the page context"""
@@ -160,38 +288,137 @@ class BaseMixin:
         ctx = super().get_context_data(*args, **kwargs)
         ctx.update(**AM_Nihoul_website.WEBPAGE_INFO)
 
-        from AM_Nihoul_website.visitor.models import Page, Category, MenuEntry
+        # menus and contact (cached)
+        navigation = navigation_cache.get()
 
-        # menu above
-        ctx['secondary_menu'] = MenuEntry.ordered_items().filter(MenuEntry.position.is_(MenuType.secondary))
+        ctx['secondary_menu'] = navigation.secondary_menu
+        ctx['main_menu'] = navigation.main_menu
+        ctx['bottom_menu'] = navigation.bottom_menu
+        ctx['contact_page'] = navigation.contact_page
 
-        # top menu
-        ctx['main_menu'] = MenuEntry.ordered_items().filter(MenuEntry.position.is_(MenuType.main))
+        # newsletter form
+        ctx['newsletter_form'] = NewsletterForm()
 
-        # bottom menu
-        categories = Category.ordered_items().filter(Category.visible.is_(True))
-        pages = Page.query.filter(Page.category_id.isnot(None)).all()
+        return ctx
 
-        cats = {}
 
-        for p in pages:
-            cid = p.category_id
-            if cid is not None:
-                if cid not in cats:
-                    cats[cid] = []
-                cats[cid].append(p)
+class CachedResponseMixin:
+    """Serve the page from ``response_cache`` to anonymous visitors.
 
-        bottom_menu = {}
-        for c in categories:
-            if c.id in cats:
-                bottom_menu[c.name] = cats[c.id]
+    The entry is tagged with ``cache_tags``, the tables of the navigation and the row in ``self.object``, if any.
+    It is keyed by the path and the arguments of the query string in ``cache_query_args`` (the others do not change
+    the page, and would only fill the cache).
+    Since the CSRF token of the forms is bound to the session, it is replaced by a fresh one when serving.
+    """
 
-        ctx['bottom_menu'] = bottom_menu
+    cache_tags = ()
+    cache_query_args = ()
 
-        # newsletter form
-        ctx['newsletter_form'] = NewsletterForm()
+    def get_cache_key(self) -> str:
+        args = [(name, value) for name in self.cache_query_args for value in flask.request.args.getlist(name)]
+        return flask.request.path + ('?' + urlencode(args) if args else '')
 
-        # contact
-        ctx['contact_page'] = Page.query.get(flask.current_app.config['PAGES']['contact_page'])
+    def get_cache_tags(self):
+        tags = {MenuEntry.__tablename__, Category.__tablename__, Page.__tablename__}
+        tags.update(self.cache_tags)
 
-        return ctx
+        obj = getattr(self, 'object', None)
+        if obj is not None:
+            tags.update(tags_of(obj))
+
+        return tags
+
+    @staticmethod
+    def use_cache():
+        return flask.current_app.config['RESPONSE_CACHE'] is not None \
+            and flask.request.method == 'GET' \
+            and not current_user.is_authenticated \
+            and not flask.session.get('_flashes')
+
+    def dispatch_request(self, *args, **kwargs):
+        if not self.use_cache():
+            return super().dispatch_request(*args, **kwargs)
+
+        key = self.get_cache_key()
+        cached = response_cache.get(key)
+
+        if cached is not None:
+            body, mimetype = cached
+            if ResponseCache.CSRF_PLACEHOLDER in body:
+                body = body.replace(ResponseCache.CSRF_PLACEHOLDER, generate_csrf())
+
+            return flask.Response(body, mimetype=mimetype)
+
+        response = flask.make_response(super().dispatch_request(*args, **kwargs))
+
+        if response.status_code == 200:
+            body = response.get_data(as_text=True)
+
+            csrf_token = flask.g.get(flask.current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+            if csrf_token:
+                body = body.replace(csrf_token, ResponseCache.CSRF_PLACEHOLDER)
+
+            response_cache.set(key, body, response.mimetype, self.get_cache_tags())
+
+        return response
+
+
+class ConditionalResponseMixin:
+    """Answer ``304 Not Modified`` (without rendering anything) if the client already has the current version.
+
+    The ETag is built from ``get_validators()``, the navigation, the user, and the CSRF token of the session
+    (which expires after ``WTF_CSRF_TIME_LIMIT``, so it is part of the ETag as well).
+    ``Last-Modified`` is the latest date among the validators and the navigation.
+    """
+
+    def get_validators(self, *args, **kwargs) -> list:
+        """Values which, when changed, change the page (by default, the object, after checking it)"""
+
+        self.get_object_or_abort(*args, **kwargs)
+        return [self.object.id, self.object.date_modified]
+
+    @staticmethod
+    def make_etag(validators: list) -> str:
+        config = flask.current_app.config
+        time_limit = config.get('WTF_CSRF_TIME_LIMIT', 3600)
+
+        parts = [
+            navigation_cache.get().digest,
+            current_user.get_id(),
+            flask.session.get(config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')),
+            int(time.time() // time_limit) if time_limit else None
+        ] + validators
+
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+    @staticmethod
+    def make_last_modified(validators: list) -> Optional[datetime.datetime]:
+        dates = [d for d in validators + [navigation_cache.get().date_modified] if isinstance(d, datetime.datetime)]
+        if len(dates) == 0:
+            return
+
+        # dates are stored in UTC (``CURRENT_TIMESTAMP`` in SQLite)
+        return max(dates).replace(tzinfo=datetime.timezone.utc)
+
+    def dispatch_request(self, *args, **kwargs):
+        if flask.request.method != 'GET' or flask.session.get('_flashes'):
+            return super().dispatch_request(*args, **kwargs)
+
+        validators = self.get_validators(*args, **kwargs)
+        last_modified = self.make_last_modified(validators)
+
+        if not is_resource_modified(
+                flask.request.environ, etag=self.make_etag(validators), last_modified=last_modified):
+            response = flask.Response(status=304)
+        else:
+            response = flask.make_response(super().dispatch_request(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        # the session may have changed (new CSRF token), so compute the ETag again
+        response.set_etag(self.make_etag(validators))
+        response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+        return response
@@ -1,15 +1,25 @@
 from datetime import datetime
+import collections
+import concurrent.futures
+import contextlib
+import dataclasses
 import logging
 import os
 import pathlib
 import base64
+import signal
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional
 
 from flask import current_app
+from sqlalchemy.orm import joinedload, selectinload
 
 import AM_Nihoul_website
-from AM_Nihoul_website import db
-from AM_Nihoul_website.visitor.models import NewsletterRecipient, Email
-from AM_Nihoul_website.admin.utils import Gmail, Message
+from AM_Nihoul_website import db, thumbnails, uploads
+from AM_Nihoul_website.visitor.models import NewsletterRecipient, Email, EmailImageAttachment
+from AM_Nihoul_website.admin.utils import AttachmentCache, Gmail, Message
+from AM_Nihoul_website.base_models import utcnow
 
 logging.basicConfig(level=AM_Nihoul_website.LOGLEVEL, format='%(asctime)s (%(levelname)s) %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,12 +27,19 @@ logger = logging.getLogger(__name__)
 
 BASE = pathlib.Path(__file__).parent.parent
 
+CLIENT_EXTENSION_NAME = 'bot_mail_client'
+client_lock = threading.Lock()
+
 
 class FakeMailClient:
     OUT = 'fake_mail_out.txt'
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.path = os.path.join(current_app.config['DATA_DIRECTORY'], self.OUT)
 
     def send(self, message: Message, **kwargs):
-        with open(os.path.join(current_app.config['DATA_DIRECTORY'], self.OUT), 'a') as f:
+        with self.lock, open(self.path, 'a') as f:
             f.write('**********\nSUBJECT: {}\nTO: {}\nON: {}\n**********\n{}\n'.format(
                 message.subject, message.recipient, datetime.now(), message.msg_html))
 
@@ -35,72 +52,338 @@ class FakeMailClient:
             f.write('*********\n')
 
 
-def bot_iteration():
+class SendingQuota:
+    """Number of emails that can be sent in the last minute, shared by the iterations of the bot"""
+
+    EXTENSION_NAME = 'bot_sending_quota'
+
+    def __init__(self, per_minute: Optional[int]):
+        self.per_minute = per_minute
+        self.sent = collections.deque()
+
+    @classmethod
+    def get(cls) -> 'SendingQuota':
+        per_minute = current_app.config['BOT_EMAILS_PER_MINUTE']
+        quota = current_app.extensions.get(cls.EXTENSION_NAME)
+        if quota is None or quota.per_minute != per_minute:
+            quota = current_app.extensions[cls.EXTENSION_NAME] = cls(per_minute)
+
+        return quota
+
+    def available(self) -> Optional[int]:
+        """Number of emails that can be sent right now (``None`` if there is no limit)"""
+
+        if self.per_minute is None:
+            return
+
+        limit = time.monotonic() - 60
+        while len(self.sent) > 0 and self.sent[0] <= limit:
+            self.sent.popleft()
+
+        return max(0, self.per_minute - len(self.sent))
+
+    def record(self, n: int = 1):
+        now = time.monotonic()
+        self.sent.extend([now] * n)
+
+
+class RecipientDeleted(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class DeliveryStats:
+    sent: int = 0
+    failures: int = 0
+    postponed: int = 0
+    duration: float = .0
+
+    @property
+    def per_minute(self) -> float:
+        return self.sent / self.duration * 60 if self.duration > 0 else .0
+
+
+def get_client():
+    """Get the mail client, created at first use and then kept (along with its connections) by the app"""
+
+    with client_lock:
+        mail_client = current_app.extensions.get(CLIENT_EXTENSION_NAME)
+        if mail_client is None:
+            if current_app.config['USE_FAKE_MAIL_SENDER']:
+                mail_client = FakeMailClient()
+            else:
+                mail_client = Gmail()
+
+            current_app.extensions[CLIENT_EXTENSION_NAME] = mail_client
+
+        return mail_client
+
+
+def forget_client():
+    """The client is rebuilt at next use"""
+
+    with client_lock:
+        current_app.extensions.pop(CLIENT_EXTENSION_NAME, None)
+
+
+def make_message(e: Email, attachment_cache: Optional[AttachmentCache] = None) -> Message:
+    data = {
+        'sender': current_app.config['NEWSLETTER_SENDER_EMAIL'],
+        'recipient': e.recipient.email,
+        'subject': e.title,
+        'msg_html': e.get_content(),
+        'reply_to': current_app.config['NEWSLETTER_SENDER_EMAIL']
+    }
+
+    if 'NEWSLETTER_REPLY_TO_EMAIL' in current_app.config \
+            and current_app.config['NEWSLETTER_REPLY_TO_EMAIL'] is not None:
+        data['reply_to'] = current_app.config['NEWSLETTER_REPLY_TO_EMAIL']
+
+    message = Message(**data, attachment_cache=attachment_cache)
+
+    # attach logo
+    message.add_html_attachment(
+        BASE / current_app.config['NEWSLETTER_LOGO'], cid='newsletter-logo')
+
+    # attach others, if any
+    for attachment in e.image_attachments:
+        f = attachment.image
+        message.add_html_attachment(pathlib.Path(f.path()), cid=f.file_name)
+
+    return message
+
+
+def email_queue(
+        page_size: int,
+        limit: Optional[int] = None,
+        quota: Optional[SendingQuota] = None,
+        stop: Optional[threading.Event] = None
+) -> Iterator[List[Email]]:
+    """Claim and yield the unsent emails (at most ``limit``, within ``quota``) by pages (ordered by id), with
+    everything that is needed to send them (recipient, campaign, attachments and their files) loaded in a constant
+    number of queries per page.
+
+    The emails of a page that are not sent once the next one is requested (or the queue is closed) are released.
+    Stops early if ``stop`` is set.
+    """
+
+    while limit is None or limit > 0:
+        size = page_size if limit is None else min(page_size, limit)
+
+        if quota is not None:
+            available = quota.available()
+            if available is not None and available < size:
+                logger.info('email:: quota reached, the other emails are postponed')
+                size = available
+
+        if size == 0 or (stop is not None and stop.is_set()):
+            return
+
+        token = Email.claim(size, current_app.config['BOT_LEASE'])
+        if token is None:
+            return
+
+        try:
+            page = Email.claimed(token)\
+                .options(
+                    joinedload(Email.recipient),
+                    selectinload(Email.campaign),
+                    selectinload(Email.image_attachments).joinedload(EmailImageAttachment.image))\
+                .all()
+
+            yield page
+        finally:
+            Email.release(token)
+
+        if limit is not None:
+            limit -= len(page)
+
+
+def deliver(client, batches: Iterable[List[Email]]) -> DeliveryStats:
+    """Send the emails with a pool of ``BOT_WORKERS`` threads, batch after batch (each one is committed).
+
+    Only the sending happens in the threads: the messages are prepared (and the emails updated) in this one,
+    which owns the database session.
+
+    An email which cannot be sent is retried later (with an exponential backoff), until ``BOT_MAX_ATTEMPTS``.
+    The delivery stops after a batch if Gmail throttles us (the throttled emails are postponed by
+    ``BOT_THROTTLE_DELAY``, which does not count as an attempt), and on authentication errors (which are raised).
+    """
+
+    stats = DeliveryStats()
+    attachment_cache = AttachmentCache()
+    quota = SendingQuota.get()  # the batches must respect it
+    start = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=current_app.config['BOT_WORKERS']) as executor:
+        for batch in batches:
+            futures = {}
+            for e in batch:
+                if e.recipient is None:  # unsubscribed (or deleted) meanwhile, no need to try again
+                    record_failure(e, RecipientDeleted('the recipient was deleted'), stats, permanent=True)
+                    continue
+
+                try:
+                    futures[executor.submit(client.send, make_message(e, attachment_cache))] = e
+                except Exception as exc:
+                    record_failure(e, exc, stats)
+
+            auth_error, throttled = None, False
+            for future in concurrent.futures.as_completed(futures):
+                e = futures[future]
+                try:
+                    future.result()
+                except Exception as exc:
+                    if Gmail.is_auth_error(exc):
+                        auth_error = exc  # not the fault of the email, which is released
+                    elif Gmail.is_rate_limit_error(exc):
+                        throttled = True  # neither
+                        postpone(e, exc, stats)
+                    else:
+                        record_failure(e, exc, stats)
+
+                    continue
+
+                logger.info('email:: sent `{}` to {} (id={}, recipient.id={})'.format(
+                    e.title, describe_recipient(e), e.id, e.recipient_id))
+
+                e.mark_sent()
+                db.session.add(e)
+                stats.sent += 1
+                quota.record()
+
+            db.session.commit()
+
+            if auth_error is not None:
+                logger.warning('email:: authentication failed, the client will be rebuilt')
+                forget_client()
+                raise auth_error
+
+            if throttled:
+                logger.warning('email:: throttled, the other emails are postponed')
+                break
+
+    stats.duration = time.monotonic() - start
+    logger.info('email:: sent {} email(s) in {:.1f}s ({:.1f}/min), {} failure(s), {} postponed'.format(
+        stats.sent, stats.duration, stats.per_minute, stats.failures, stats.postponed))
+
+    return stats
+
+
+def describe_recipient(e: Email) -> str:
+    return e.recipient.get_scrambled_email() if e.recipient is not None else '(deleted recipient)'
+
+
+def record_failure(e: Email, error: Exception, stats: DeliveryStats, permanent: bool = False):
+    max_attempts = 1 if permanent else current_app.config['BOT_MAX_ATTEMPTS']
+    e.record_failure(error, max_attempts, current_app.config['BOT_RETRY_DELAY'])
+    db.session.add(e)
+    stats.failures += 1
+
+    if e.failed:
+        logger.error('email:: failed to send `{}` to {} (id={}), giving up after {} attempts: {}'.format(
+            e.title, describe_recipient(e), e.id, e.attempts, e.last_error))
+    else:
+        logger.warning('email:: failed to send `{}` to {} (id={}), next attempt at {}: {}'.format(
+            e.title, describe_recipient(e), e.id, e.next_attempt, e.last_error))
+
+
+def postpone(e: Email, error: Exception, stats: DeliveryStats):
+    e.postpone(error, current_app.config['BOT_THROTTLE_DELAY'])
+    db.session.add(e)
+    stats.postponed += 1
+
+    logger.warning('email:: throttled while sending `{}` to {} (id={}), next attempt at {}'.format(
+        e.title, describe_recipient(e), e.id, e.next_attempt))
+
+
+def bot_iteration(stop: Optional[threading.Event] = None) -> Optional[DeliveryStats]:
     """The bot handles:
 
     1. Remove newsletter recipients that did not confirm their inscription after ``REMOVE_RECIPIENT_DELTA``
-    2. Send emails
+    2. Generate the thumbnails that are still pending after ``THUMBNAIL_TIMEOUT``
+    3. Remove the chunks of the uploads that were not completed after ``CHUNKED_UPLOAD_TIMEOUT``
+    4. Send emails (see ``deliver()``), until ``stop`` is set (if any)
+
+    Returns the statistics of the delivery, if any.
     """
 
     logger.debug('bot_iteration:: tick')
 
     # remove recipients
     with current_app.app_context():
-        recipients = NewsletterRecipient.query\
-            .filter(NewsletterRecipient.confirmed.is_(False))\
-            .filter(
-                NewsletterRecipient.date_created <= datetime.now() - current_app.config['REMOVE_RECIPIENTS_DELTA'])\
-            .all()
+        num_recipients, num_emails = NewsletterRecipient.remove_unconfirmed(
+            utcnow() - current_app.config['REMOVE_RECIPIENTS_DELTA'])
 
-        for r in recipients:
-            logger.info('clean-recipients:: removed {} (id={})'.format(r.get_scrambled_email(), r.id))
-            db.session.delete(r)
+        db.session.commit()  # even if nothing was removed, so that the database is not locked meanwhile
+        if num_recipients > 0:
+            logger.info('clean-recipients:: removed {} recipient(s) and {} unsent email(s)'.format(
+                num_recipients, num_emails))
+
+        # generate thumbnails (which must not prevent the rest)
+        try:
+            num_thumbnails = thumbnails.generate_stale(utcnow() - current_app.config['THUMBNAIL_TIMEOUT'])
+        except Exception:
+            db.session.rollback()
+            logger.exception('thumbnails:: cannot generate the pending thumbnails')
+        else:
+            if num_thumbnails > 0:
+                logger.info('thumbnails:: generated {} pending thumbnail(s)'.format(num_thumbnails))
+
+        # remove chunks
+        num_uploads = uploads.remove_stale(datetime.now() - current_app.config['CHUNKED_UPLOAD_TIMEOUT'])
+        if num_uploads > 0:
+            logger.info('clean-uploads:: removed {} incomplete upload(s)'.format(num_uploads))
 
         # send emails
-        emails = Email.query\
-            .filter(Email.sent.is_(False))\
-            .all()
+        if db.session.query(Email.query.filter(Email.sendable(datetime.now())).exists()).scalar():
+            queue = email_queue(
+                current_app.config['BOT_BATCH_SIZE'],
+                current_app.config['BOT_EMAILS_PER_ITERATION'],
+                SendingQuota.get(),
+                stop)
+
+            with contextlib.closing(queue):
+                return deliver(get_client(), queue)
 
-        if len(emails) > 0:
-            # get client
-            if current_app.config['USE_FAKE_MAIL_SENDER']:
-                client = FakeMailClient()
-            else:
-                client = Gmail()
 
-            # go for it
-            for e in emails:
+class Worker:
+    """Run the bot out of the web process, until SIGINT or SIGTERM (the current batch is finished first).
 
-                data = {
-                    'sender': current_app.config['NEWSLETTER_SENDER_EMAIL'],
-                    'recipient': e.recipient.email,
-                    'subject': e.title,
-                    'msg_html': e.content,
-                    'reply_to': current_app.config['NEWSLETTER_SENDER_EMAIL']
-                }
+    It wakes up as soon as the database is changed by another process (e.g., a newsletter is published), or after
+    ``interval`` seconds otherwise. Many workers can run at the same time, since the emails are claimed.
+    """
 
-                if 'NEWSLETTER_REPLY_TO_EMAIL' in current_app.config \
-                        and current_app.config['NEWSLETTER_REPLY_TO_EMAIL'] is not None:
-                    data['reply_to'] = current_app.config['NEWSLETTER_REPLY_TO_EMAIL']
+    def __init__(self, interval: float, poll_interval: float):
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.stop = threading.Event()
 
-                message = Message(**data)
+    def shutdown(self, *args):
+        if not self.stop.is_set():
+            logger.info('worker:: stopping')
+            self.stop.set()
 
-                # attach logo
-                message.add_html_attachment(
-                    BASE / current_app.config['NEWSLETTER_LOGO'], cid='newsletter-logo')
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, self.shutdown)
+            signal.signal(signal.SIGTERM, self.shutdown)
 
-                # attach others, if any
-                for attachment in e.attachments():
-                    f = attachment.image
-                    message.add_html_attachment(pathlib.Path(f.path()), cid=f.file_name)
+        logger.info('worker:: started')
 
-                # send
-                client.send(message)
-                logger.info('email:: sent `{}` to {} (id={}, recipient.id={})'.format(
-                    e.title, e.recipient.get_scrambled_email(), e.id, e.recipient.id))
+        # `PRAGMA data_version` changes when another connection commits
+        with db.engine.connect() as connection:
+            last_version, last_iteration = None, None
+            while not self.stop.is_set():
+                version = connection.exec_driver_sql('PRAGMA data_version').scalar()
+                quota_available = SendingQuota.get().available() != 0
 
-                e.sent = True
-                db.session.add(e)
+                if last_iteration is None or time.monotonic() - last_iteration >= self.interval \
+                        or (version != last_version and quota_available):
+                    bot_iteration(self.stop)
+                    last_version = connection.exec_driver_sql('PRAGMA data_version').scalar()
+                    last_iteration = time.monotonic()
 
-        if len(recipients) > 0 or len(emails) > 0:
-            db.session.commit()
+                self.stop.wait(self.poll_interval)
+
+        logger.info('worker:: stopped')
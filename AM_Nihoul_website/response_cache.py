@@ -0,0 +1,302 @@
+"""
+Cache of the rendered pages, for anonymous visitors.
+
+Each entry is tagged with the tables (``page``) or rows (``page:3``) that were used to render it.
+When a row is committed, the entries tagged with its table or itself are purged.
+"""
+
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from typing import Iterable, List, Optional, Tuple
+
+import flask
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from AM_Nihoul_website.base_models import BaseModel
+
+
+class MemoryStorage:
+    """Keep (at most ``max_entries``) entries in the memory of the process, the least recently used being evicted.
+
+    The keys of each tag are indexed, so that purging does not go through all the entries.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()  # from the least recently used
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+
+            body, mimetype, tags, expires = entry
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                return
+
+            self.entries.move_to_end(key)
+            return body, mimetype
+
+    def set(self, key: str, body: str, mimetype: str, tags: Iterable[str], expires: Optional[float]):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            tags = frozenset(tags)
+            self.entries[key] = (body, mimetype, tags, expires)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+
+            while self.max_entries is not None and len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def purge(self, tags: Iterable[str]):
+        with self.lock:
+            for tag in set(tags):
+                for key in list(self.tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def _remove(self, key: str):
+        for tag in self.entries.pop(key)[2]:
+            keys = self.tags[tag]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.tags[tag]
+
+
+class FileSystemStorage:
+    """Keep (at most ``max_entries``) entries in a directory, so that they are shared by all processes.
+
+    Each entry is a body file (``<hash>.html``) and a metadata file (``<hash>.json``), which is touched when the
+    entry is used (the least recently used are evicted). The entries of each tag are listed in ``tags/<hash>``
+    (one line appended by entry, which is atomic), so that purging only reads the lists of the tags.
+    """
+
+    def __init__(self, directory: pathlib.Path, max_entries: Optional[int] = None):
+        self.directory = directory
+        self.tags_directory = directory / 'tags'
+        self.max_entries = max_entries
+
+    @staticmethod
+    def _name(value: str) -> str:
+        return hashlib.sha1(value.encode()).hexdigest()
+
+    def _paths(self, name: str) -> Tuple[pathlib.Path, pathlib.Path]:
+        return self.directory / '{}.html'.format(name), self.directory / '{}.json'.format(name)
+
+    def _write(self, path: pathlib.Path, content: str):
+        """Write in a temporary file, then rename it, so that readers never see a partial file"""
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+
+        os.replace(tmp_path, path)
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        body_path, meta_path = self._paths(self._name(key))
+
+        try:
+            with meta_path.open() as f:
+                meta = json.load(f)
+            with body_path.open() as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return
+
+        if meta['key'] != key:
+            return
+
+        if meta['expires'] is not None and meta['expires'] < time.time():
+            self._remove(body_path, meta_path)
+            return
+
+        try:
+            os.utime(meta_path)
+        except OSError:  # removed meanwhile
+            pass
+
+        return body, meta['mimetype']
+
+    def set(self, key: str, body: str, mimetype: str, tags: Iterable[str], expires: Optional[float]):
+        self.tags_directory.mkdir(parents=True, exist_ok=True)
+        name = self._name(key)
+        body_path, meta_path = self._paths(name)
+
+        # listed first, so that a purge in the meantime does not miss it
+        tags = list(tags)
+        for tag in tags:
+            self._list(tag, name)
+
+        self._write(body_path, body)
+        self._write(meta_path, json.dumps({'key': key, 'mimetype': mimetype, 'tags': tags, 'expires': expires}))
+
+        self._evict()
+
+    def purge(self, tags: Iterable[str]):
+        for tag in set(tags):
+            for name in self._take_list(tag):
+                self._remove(*self._paths(name))
+
+    def clear(self):
+        if self.directory.exists():
+            shutil.rmtree(self.tags_directory, ignore_errors=True)
+            for path in self.directory.iterdir():
+                path.unlink(missing_ok=True)
+
+    def _list(self, tag: str, name: str):
+        """Add the entry ``name`` to the list of ``tag``, which is compacted when it gets (much) longer than
+        the number of entries
+        """
+
+        path = self.tags_directory / self._name(tag)
+        with path.open('a') as f:
+            f.write('{}\n'.format(name))
+            size = f.tell()
+
+        if self.max_entries is not None and size > 2 * self.max_entries * (len(name) + 1):
+            names = self._take_list(tag)
+            with path.open('a') as f:
+                f.writelines('{}\n'.format(n) for n in set(names) if self._paths(n)[1].exists())
+
+    def _take_list(self, tag: str) -> List[str]:
+        """Get (and remove) the list of ``tag``"""
+
+        path = self.tags_directory / self._name(tag)
+        taken = path.with_name('{}.{}.taken'.format(path.name, uuid.uuid4()))
+
+        try:
+            os.rename(path, taken)
+        except FileNotFoundError:
+            return []
+
+        with taken.open() as f:
+            names = [line.strip() for line in f if line.strip()]
+
+        taken.unlink()
+        return names
+
+    def _evict(self):
+        """Remove the least recently used entries, if there are more than ``max_entries``"""
+
+        if self.max_entries is None:
+            return
+
+        with os.scandir(self.directory) as it:
+            metas = [e for e in it if e.name.endswith('.json')]
+
+        if len(metas) <= self.max_entries:
+            return
+
+        def last_used(e: os.DirEntry) -> float:
+            try:
+                return e.stat().st_mtime
+            except OSError:
+                return 0
+
+        metas.sort(key=last_used)
+        for e in metas[:len(metas) - self.max_entries]:
+            meta_path = pathlib.Path(e.path)
+            self._remove(meta_path.with_suffix('.html'), meta_path)
+
+    @staticmethod
+    def _remove(*paths: pathlib.Path):
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+
+class ResponseCache:
+    """Get the storage of the current app, as defined by ``RESPONSE_CACHE``
+    (``None`` to disable, ``'memory'`` or ``'filesystem'``)
+    """
+
+    EXTENSION_NAME = 'response_cache'
+    CSRF_PLACEHOLDER = '%%CSRF_TOKEN%%'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @property
+    def storage(self):
+        config = flask.current_app.config
+        if config['RESPONSE_CACHE'] is None:
+            return
+
+        with self.lock:
+            if self.EXTENSION_NAME not in flask.current_app.extensions:
+                if config['RESPONSE_CACHE'] == 'memory':
+                    storage = MemoryStorage(config['RESPONSE_CACHE_MAX_ENTRIES'])
+                elif config['RESPONSE_CACHE'] == 'filesystem':
+                    storage = FileSystemStorage(
+                        config['DATA_DIRECTORY'] / 'cache', config['RESPONSE_CACHE_MAX_ENTRIES'])
+                else:
+                    raise ValueError('RESPONSE_CACHE={}'.format(config['RESPONSE_CACHE']))
+
+                flask.current_app.extensions[self.EXTENSION_NAME] = storage
+
+        return flask.current_app.extensions[self.EXTENSION_NAME]
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        return self.storage.get(key)
+
+    def set(self, key: str, body: str, mimetype: str, tags: Iterable[str]):
+        timeout = flask.current_app.config['RESPONSE_CACHE_TIMEOUT']
+        self.storage.set(key, body, mimetype, tags, time.time() + timeout if timeout is not None else None)
+
+    def purge(self, tags: Iterable[str]):
+        if self.storage is not None:
+            self.storage.purge(tags)
+
+    def clear(self):
+        if self.storage is not None:
+            self.storage.clear()
+
+
+response_cache = ResponseCache()
+
+
+def tags_of(obj: BaseModel) -> Tuple[str, str]:
+    """Tags of the table and the row of ``obj``"""
+
+    return obj.__tablename__, '{}:{}'.format(obj.__tablename__, obj.id)
+
+
+@event.listens_for(BaseModel, 'after_insert', propagate=True)
+@event.listens_for(BaseModel, 'after_update', propagate=True)
+@event.listens_for(BaseModel, 'after_delete', propagate=True)
+def receive_change(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('response_cache_tags', set()).update(tags_of(target))
+
+
+@event.listens_for(Session, 'after_commit')
+def purge_after_commit(session):
+    """Purge the entries fed by the committed rows"""
+
+    tags = session.info.pop('response_cache_tags', None)
+    if tags and flask.has_app_context():
+        response_cache.purge(tags)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_tags_after_rollback(session, previous_transaction):
+    session.info.pop('response_cache_tags', None)
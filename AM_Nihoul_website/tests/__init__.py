@@ -16,6 +16,7 @@ class TestFlask(TestCase):
         self.data_files_directory = pathlib.Path(tempfile.mkdtemp())
         Config.DATA_DIRECTORY = self.data_files_directory
         Config.LAUNCH_BOT = False
+        Config.THUMBNAIL_WORKERS = 0
 
         # create test app app
         self.app = create_app(False)
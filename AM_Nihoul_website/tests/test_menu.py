@@ -99,6 +99,31 @@ class TestMenus(TestFlask):
         self.assertEqual(c.text, text)
         self.assertEqual(c.url, url)
 
+    def test_menu_edit_seen_by_visitor_ok(self):
+        old_url = self.menu_3.url
+
+        # the navigation is cached at the first visit ...
+        response = self.client.get(flask.url_for('visitor.albums'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(old_url, response.get_data(as_text=True))
+
+        text = 'xyz'
+        url = 'http://x.com/b2.html'
+
+        response = self.client.post(flask.url_for('admin.menus'), data={
+            'text': text,
+            'url': url,
+            'position': MenuType.secondary.value,
+            'id_menu': self.menu_3.id,
+        }, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+
+        # ... but invalidated by the modification
+        response = self.client.get(flask.url_for('visitor.albums'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(old_url, response.get_data(as_text=True))
+        self.assertIn(url, response.get_data(as_text=True))
+
     def test_menu_edit_not_admin_ko(self):
         text = 'xyz'
         url = 'http://x.com/b2.html'
@@ -1,10 +1,21 @@
 import flask
+import sqlalchemy
 
+from datetime import datetime, timedelta
+import io
 import os
+import struct
+import time
+import uuid
+import zlib
+
+from PIL import Image
 
 from AM_Nihoul_website.tests import TestFlask
-from AM_Nihoul_website.visitor.models import Album, Picture
-from AM_Nihoul_website import db
+from AM_Nihoul_website.admin.utils import Thumbnailer
+from AM_Nihoul_website.base_models import utcnow
+from AM_Nihoul_website.visitor.models import Album, Blob, Picture, PictureVariant
+from AM_Nihoul_website import db, bot, thumbnails, uploads
 
 
 class TestsAlbum(TestFlask):
@@ -181,6 +192,299 @@ class TestsPicture(TestFlask):
         self.assertFalse(os.path.exists(p.path()))
         self.assertFalse(os.path.exists(p.path_thumb()))
 
+    def test_picture_immutable_url_ok(self):
+        p = self.upload_pic('whatever.jpg', self.file, self.album_1)
+
+        url = p.url()
+        self.assertIn('/{}/'.format(uploads.BLOBS_DIRECTORY), url)  # named after the content
+        self.assertNotEqual(url, p.url_thumb())
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.headers.get('ETag'))
+        self.assertTrue(response.cache_control.public)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, self.app.config['PICTURES_MAX_AGE'])
+        response.close()
+
+        # unversioned URLs (other than the ones named after the content) are revalidated
+        url_thumb = p.url_thumb()
+        self.assertIn('?v=', url_thumb)
+
+        response = self.client.get(url_thumb.split('?')[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.cache_control.immutable)
+        response.close()
+
+    def test_upload_thumbnail_in_background_ok(self):
+        self.app.config['THUMBNAIL_WORKERS'] = 1
+
+        response = self.client.post(
+            flask.url_for('admin.album-dropzone-upload', id=self.album_1.id), data={
+                'file_uploaded': (open(self.file, 'rb'), 'whatever.jpg')
+            })
+        self.assertEqual(response.status_code, 200)
+
+        p = Picture.query.order_by(Picture.id.desc()).first()
+        self.assertTrue(p.thumbnail_pending)
+        self.assertEqual(p.url_thumb(), p.url())  # the original, in the meantime
+
+        pool = thumbnails.ThumbnailPool.get()
+        self.assertEqual(len(pool.wait()), 1)
+        pool.shutdown()
+
+        p = db.session.get(Picture, p.id, populate_existing=True)
+        self.assertFalse(p.thumbnail_pending)
+        self.assertNotEqual(p.url_thumb(), p.url())
+        self.assertGreater(os.path.getsize(p.path_thumb()), 0)
+        self.assertEqual(p.picture_size, os.path.getsize(p.path()) + os.path.getsize(p.path_thumb()))
+
+    def test_stale_thumbnail_generated_by_bot_ok(self):
+        p = self.upload_pic('whatever.jpg', self.file, self.album_1)
+        self.assertFalse(p.thumbnail_pending)
+
+        # the thumbnail was lost
+        open(p.path_thumb(), 'wb').close()
+        p.thumbnail_pending = True
+        db.session.add(p)
+        db.session.commit()
+
+        db.session.execute(
+            sqlalchemy.update(Picture).values(date_modified=utcnow() - self.app.config['THUMBNAIL_TIMEOUT']))
+        db.session.commit()
+
+        bot.bot_iteration()
+
+        p = db.session.get(Picture, p.id, populate_existing=True)
+        self.assertFalse(p.thumbnail_pending)
+        self.assertGreater(os.path.getsize(p.path_thumb()), 0)
+
+    def test_stale_thumbnail_failing_not_retried_ok(self):
+        p = self.upload_pic('whatever.jpg', self.file, self.album_1)
+
+        # the original is broken (PIL raises something else than `OSError`)
+        p.thumbnail_pending = True
+        db.session.add(p)
+        db.session.commit()
+
+        db.session.execute(
+            sqlalchemy.update(Picture).values(date_modified=utcnow() - self.app.config['THUMBNAIL_TIMEOUT']))
+        db.session.commit()
+
+        def broken(*args, **kwargs):
+            raise Image.DecompressionBombError('too large')
+
+        previous, thumbnails.make_thumbnail = thumbnails.make_thumbnail, broken
+        try:
+            self.assertEqual(thumbnails.generate_stale(utcnow()), 0)
+        finally:
+            thumbnails.make_thumbnail = previous
+
+        p = db.session.get(Picture, p.id, populate_existing=True)
+        self.assertTrue(p.thumbnail_pending)  # the original is displayed
+        self.assertIn('DecompressionBombError', p.thumbnail_error)
+
+        # not tried again by the bot ...
+        self.assertEqual(thumbnails.generate_stale(utcnow()), 0)
+
+        # ... but rebuilt
+        result = self.app.test_cli_runner().invoke(args=['pictures', 'rebuild', '--workers', '1'])
+        self.assertIn('1 picture(s) rebuilt, 0 failure(s)', result.output)
+
+        p = db.session.get(Picture, p.id, populate_existing=True)
+        self.assertFalse(p.thumbnail_pending)
+        self.assertIsNone(p.thumbnail_error)
+
+    def test_pending_thumbnail_not_stale_ok(self):
+        p = self.upload_pic('whatever.jpg', self.file, self.album_1)
+
+        # pending right now (`date_modified` is set by the database)
+        p.thumbnail_pending = True
+        db.session.add(p)
+        db.session.commit()
+
+        # `date_modified` is in UTC, whatever the local time is
+        previous_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Etc/GMT-2'  # UTC+2
+        time.tzset()
+
+        try:
+            self.assertEqual(thumbnails.generate_stale(utcnow() - self.app.config['THUMBNAIL_TIMEOUT']), 0)
+            bot.bot_iteration()
+        finally:
+            if previous_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = previous_tz
+            time.tzset()
+
+        p = db.session.get(Picture, p.id, populate_existing=True)
+        self.assertTrue(p.thumbnail_pending)
+
+    def test_upload_not_an_image_ko(self):
+        response = self.client.post(
+            flask.url_for('admin.album', id=self.album_1.id), data={
+                'file_uploaded': (io.BytesIO(b'not an image'), 'whatever.jpg')
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Picture.query.count(), self.num_pictures)
+        self.assertFalse(os.path.exists(self.app.config['UPLOADED_PICTURES_DEST']))
+        self.assertEqual(os.listdir(self.data_files_directory / uploads.CHUNKS_DIRECTORY), [])
+
+    def test_picture_variants_ok(self):
+        self.app.config['PICTURE_VARIANTS_WIDTHS'] = (200, 800, 1600)  # the picture is 959px wide
+
+        p = self.upload_pic('whatever.png', self.file2, self.album_1)
+        self.assertEqual(
+            sorted((v.width, v.format) for v in p.variants),
+            [(200, 'jpeg'), (200, 'webp'), (800, 'jpeg'), (800, 'webp')])
+
+        for v in p.variants:
+            self.assertTrue(os.path.exists(v.path()))
+            self.assertEqual(v.file_size, os.path.getsize(v.path()))
+            self.assertEqual(v.height, round(688 * v.width / 959))
+
+        self.assertEqual(p.picture_size, sum(
+            os.path.getsize(f) for f in [p.path(), p.path_thumb()] + [v.path() for v in p.variants]))
+
+        srcset = p.srcset('webp')
+        self.assertIn('.webp?v={} 200w'.format(p.version()), srcset)
+        self.assertIn('.webp?v={} 800w'.format(p.version()), srcset)
+        self.assertEqual(p.url_largest(), p.get_variants('jpeg')[-1].url())
+
+        response = self.client.get(p.url_largest())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/jpeg')
+        response.close()
+
+        response = self.client.get(flask.url_for('visitor.album', id=self.album_1.id, slug=self.album_1.slug))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('data-srcset="{}"'.format(p.srcset()), response.get_data(as_text=True))
+
+        # variants are removed with the picture
+        paths = [v.path() for v in p.variants]
+        response = self.client.delete(flask.url_for('admin.picture-delete', id=p.id))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(PictureVariant.query.count(), 0)
+
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def test_picture_no_variants_ok(self):
+        p = self.upload_pic('whatever.jpg', self.file, self.album_1)  # smaller than any variant
+
+        self.assertEqual(len(p.variants), 0)
+        self.assertEqual(p.srcset(), '')
+        self.assertEqual(p.url_largest(), p.url())
+
+    def test_rebuild_ok(self):
+        p1 = self.upload_pic('whatever.jpg', self.file, self.album_1)
+        p2 = self.upload_pic('whatever.png', self.file2, self.album_1)
+        previous_variants = [v.path() for v in p2.variants]
+        self.assertEqual(len(previous_variants), 2)  # 800px
+
+        # up to date
+        self.assertEqual(list(thumbnails.rebuild(1)), [])
+
+        # change settings
+        self.app.config['PICTURE_THUMB_SIZE'] = (200, 150)
+        self.app.config['PICTURE_VARIANTS_WIDTHS'] = (100, 400)
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['pictures', 'rebuild', '--workers', '1'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('2 picture(s) rebuilt, 0 failure(s)', result.output)
+
+        for p in (p1, p2):
+            p = db.session.get(Picture, p.id, populate_existing=True)
+            self.assertEqual(p.thumbnail_settings, thumbnails.get_settings())
+
+            with Image.open(p.path_thumb()) as thumbnail:
+                self.assertEqual(thumbnail.size, (200, 150))
+
+            self.assertEqual(sorted(set(v.width for v in p.variants)), [100, 400] if p.id == p2.id else [100])
+            self.assertEqual(p.picture_size, sum(
+                os.path.getsize(f) for f in [p.path(), p.path_thumb()] + [v.path() for v in p.variants]))
+
+        for path in previous_variants:
+            self.assertFalse(os.path.exists(path))
+
+        # ... which is done once
+        result = runner.invoke(args=['pictures', 'rebuild', '--workers', '1'])
+        self.assertIn('0 picture(s) rebuilt', result.output)
+
+    def test_rebuild_failure_ok(self):
+        p1 = self.upload_pic('whatever.jpg', self.file, self.album_1)
+        p2 = self.upload_pic('whatever.png', self.file2, self.album_1)
+
+        # the first one is now a decompression bomb (which is not an `OSError`)
+        def chunk(type_, data):
+            return struct.pack('>I', len(data)) + type_ + data + struct.pack('>I', zlib.crc32(type_ + data))
+
+        with open(p1.path(), 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n')
+            f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', 10 ** 5, 10 ** 5, 8, 2, 0, 0, 0)))
+            f.write(chunk(b'IDAT', b'') + chunk(b'IEND', b''))
+
+        self.app.config['PICTURE_THUMB_SIZE'] = (200, 150)
+
+        # the others are rebuilt anyway
+        result = self.app.test_cli_runner().invoke(args=['pictures', 'rebuild', '--workers', '1'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('1 picture(s) rebuilt, 1 failure(s)', result.output)
+
+        self.assertNotEqual(
+            db.session.get(Picture, p1.id, populate_existing=True).thumbnail_settings, thumbnails.get_settings())
+        self.assertEqual(
+            db.session.get(Picture, p2.id, populate_existing=True).thumbnail_settings, thumbnails.get_settings())
+
+    def test_rebuild_dates_ok(self):
+        p = self.upload_pic('whatever.jpg', self.file, self.album_1)
+        self.app.config['PICTURE_THUMB_SIZE'] = (200, 150)
+
+        # the dates are in UTC (as `CURRENT_TIMESTAMP`), whatever the local time is
+        previous_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Etc/GMT-2'  # UTC+2
+        time.tzset()
+
+        try:
+            list(thumbnails.rebuild(1))
+        finally:
+            if previous_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = previous_tz
+            time.tzset()
+
+        p = db.session.get(Picture, p.id, populate_existing=True)
+        self.assertEqual(p.thumbnail_settings, thumbnails.get_settings())
+        for date in [p.date_modified] + [v.date_created for v in p.variants]:
+            self.assertLess(abs(date - utcnow()), timedelta(minutes=1))
+
+    def test_upload_picture_chunks_ok(self):
+        with open(self.file2, 'rb') as f:
+            content = f.read()
+
+        chunk_size = len(content) // 2 + 1
+        url = flask.url_for('admin.album-dropzone-upload', id=self.album_1.id)
+        data = dict(dzuuid=str(uuid.uuid4()), dztotalfilesize=len(content), dztotalchunkcount=2)
+
+        for index in range(2):
+            response = self.client.post(url, data=dict(
+                file_uploaded=(io.BytesIO(content[index * chunk_size:(index + 1) * chunk_size]), 'chunked.png'),
+                dzchunkindex=index,
+                dzchunkbyteoffset=index * chunk_size,
+                **data))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Picture.query.count(), self.num_pictures + index)
+
+        p = Picture.query.order_by(Picture.id.desc()).first()
+        self.assertEqual(p.picture_name, 'chunked.png')
+        self.assertFalse(p.thumbnail_pending)
+
+        with open(p.path(), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
     def test_upload_same_name_different_files_ok(self):
         fname = 'whatever.jpg'
         p1 = self.upload_pic(fname, self.file, self.album_1)
@@ -188,7 +492,21 @@ class TestsPicture(TestFlask):
 
         self.assertEqual(p1.picture_name, fname)
         self.assertNotEqual(p2.picture_name, fname)
-        self.assertNotEqual(p1.path(), p2.path())
+        self.assertNotEqual(p1.path_thumb(), p2.path_thumb())
+
+        # ... but the same content, which is stored once
+        self.assertEqual(p1.blob_id, p2.blob_id)
+        self.assertEqual(p1.path(), p2.path())
+        self.assertEqual(self.db_session.get(Blob, p1.blob_id).refcount, 2)
+
+        # which is kept until the last one is deleted
+        self.client.delete(flask.url_for('admin.picture-delete', id=p1.id))
+        self.assertTrue(os.path.exists(p2.path()))
+        self.assertEqual(self.db_session.get(Blob, p1.blob_id, populate_existing=True).refcount, 1)
+
+        self.client.delete(flask.url_for('admin.picture-delete', id=p2.id))
+        self.assertFalse(os.path.exists(p2.path()))
+        self.assertIsNone(self.db_session.get(Blob, p1.blob_id, populate_existing=True))
 
     def test_upload_not_admin_ko(self):
         self.logout()
@@ -276,9 +594,139 @@ class TestsPicture(TestFlask):
         response = self.client.get(flask.url_for('visitor.album', id=self.album_1.id, slug=self.album_1.slug))
         self.assertEqual(response.status_code, 200)
 
+    def count_queries(self, url: str) -> int:
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        return len([s for s in statements if s.startswith('SELECT')])
+
+    def test_albums_previews_ok(self):
+        pictures = [self.upload_pic('test{}.jpg'.format(i), self.file, self.album_1) for i in range(4)]
+        p5 = self.upload_pic('test5.jpg', self.file, self.album_2)
+
+        # the last one was taken first
+        db.session.execute(sqlalchemy.update(Picture).where(Picture.id == pictures[-1].id).values(
+            date_taken=datetime(2000, 1, 1)))
+        db.session.commit()
+
+        albums = Album.ordered_with_previews()
+        self.assertEqual([a.id for a in albums], [self.album_2.id, self.album_1.id])
+        self.assertEqual([p.id for p in albums[1].previews], [pictures[3].id, pictures[0].id, pictures[1].id])
+        self.assertEqual([p.id for p in albums[0].previews], [p5.id])
+        self.assertEqual(albums[1].get_thumbnail().id, pictures[3].id)
+
+        # the number of queries does not depend on the number of albums (as admin, the page is not cached)
+        self.album_2.thumbnail = p5
+        db.session.add(self.album_2)
+        db.session.commit()
+
+        num_queries = self.count_queries(flask.url_for('visitor.albums'))
+
+        for i in range(3):
+            album = Album.create('Other album {}'.format(i))
+            album.thumbnail = pictures[i]
+            db.session.add(album)
+            db.session.commit()
+            self.upload_pic('other{}.jpg'.format(i), self.file2, album)
+
+        self.assertEqual(self.count_queries(flask.url_for('visitor.albums')), num_queries)
+
+    def test_visitor_view_pages_ok(self):
+        self.app.config['ALBUM_PAGE_SIZE'] = 2
+
+        pictures = [self.upload_pic('test{}.jpg'.format(i), self.file, self.album_1) for i in range(3)]
+        self.logout()
+
+        url = flask.url_for('visitor.album', id=self.album_1.id, slug=self.album_1.slug, _external=False)
+        url_json = flask.url_for('visitor.album-pictures', id=self.album_1.id, slug=self.album_1.slug, _external=False)
+
+        # first page, with a link to the next one
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        content = response.get_data(as_text=True)
+
+        for p in pictures[:2]:
+            self.assertIn(p.url_thumb(), content)
+        self.assertNotIn(pictures[2].url_thumb(), content)
+        self.assertIn(url + '?page=2', content)
+        self.assertIn(url_json + '?page=2', content)
+
+        # second (and last) page
+        response = self.client.get(url + '?page=2')
+        self.assertEqual(response.status_code, 200)
+        content = response.get_data(as_text=True)
+        self.assertIn(pictures[2].url_thumb(), content)
+        self.assertNotIn(pictures[0].url_thumb(), content)
+        self.assertNotIn(url_json, content)
+
+        response = self.client.get(url + '?page=3')
+        self.assertEqual(response.status_code, 404)
+
+        # JSON, for the lightbox
+        response = self.client.get(url_json + '?page=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([p['thumb'] for p in response.json['pictures']], [pictures[2].url_thumb()])
+        self.assertEqual(response.json['pictures'][0]['src'], pictures[2].url_largest())
+        self.assertIsNone(response.json['next'])
+
+        response = self.client.get(url_json)
+        self.assertEqual(len(response.json['pictures']), 2)
+        self.assertEqual(response.json['next'], url_json + '?page=2')
+
+        response = self.client.get(
+            flask.url_for('visitor.album-pictures', id=self.album_1.id, slug=self.album_1.slug + 'x'))
+        self.assertEqual(response.status_code, 404)
+
     def test_visitor_view_wrong_slug_ko(self):
         response = self.client.get(flask.url_for('visitor.album', id=self.album_1.id, slug=self.album_1.slug))
         self.assertEqual(response.status_code, 200)
 
         response = self.client.get(flask.url_for('visitor.album', id=self.album_1.id, slug=self.album_1.slug + 'x'))
         self.assertEqual(response.status_code, 404)
+
+
+class TestsThumbnailer(TestFlask):
+
+    def make_jpeg(self, width: int, height: int, orientation: int = 1) -> io.BytesIO:
+        """Left half is red and right half is blue (before the orientation is applied)"""
+
+        image = Image.new('RGB', (width, height), 'blue')
+        image.paste('red', (0, 0, width // 2, height))
+
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+
+        fp = io.BytesIO()
+        image.save(fp, format='jpeg', exif=exif)
+        fp.seek(0)
+
+        return fp
+
+    def test_thumbnail_ok(self):
+        with Image.open(self.make_jpeg(3000, 2000)) as image:
+            thumbnail = Thumbnailer(400, 300).transform(image)
+
+            self.assertEqual(image.size, (750, 500))  # decoded at 1/4
+
+        self.assertEqual(thumbnail.size, (400, 300))
+        self.assertGreater(thumbnail.getpixel((10, 150))[0], 200)  # red on the left
+        self.assertGreater(thumbnail.getpixel((390, 150))[2], 200)  # blue on the right
+
+    def test_thumbnail_orientation_ok(self):
+        with Image.open(self.make_jpeg(3000, 2000, orientation=6)) as image:  # rotated by 90° clockwise
+            thumbnail = Thumbnailer(400, 300).transform(image)
+
+            self.assertEqual(image.size, (750, 500))
+
+        self.assertEqual(thumbnail.size, (400, 300))
+        self.assertGreater(thumbnail.getpixel((200, 10))[0], 200)  # red on top
+        self.assertGreater(thumbnail.getpixel((200, 290))[2], 200)  # blue at the bottom
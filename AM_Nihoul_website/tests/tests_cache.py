@@ -0,0 +1,227 @@
+import datetime
+import time
+
+import flask
+import sqlalchemy
+
+from AM_Nihoul_website import db
+from AM_Nihoul_website.response_cache import FileSystemStorage, MemoryStorage, ResponseCache
+from AM_Nihoul_website.visitor.models import Brief, Album
+from AM_Nihoul_website.tests import TestFlask
+
+
+class TestResponseCache(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        self.app.config['RESPONSE_CACHE'] = 'memory'
+
+        self.brief = Brief.create('test', '', 'first content', visible=True)
+        db.session.add(self.brief)
+        db.session.commit()
+
+        self.visitor = self.app.test_client(use_cookies=True)
+        self.url = flask.url_for('visitor.brief-view', id=self.brief.id, slug=self.brief.slug)
+
+    def visit(self, url, client=None):
+        """Visit as an anonymous visitor (in a separate app context, so that nothing is shared in `flask.g`)"""
+
+        with self.app.app_context():
+            return (client or self.visitor).get(url).get_data(as_text=True)
+
+    @staticmethod
+    def change_silently(model, obj_id, **values):
+        """Change an object without the ORM noticing it (so that the cache is not purged)"""
+
+        db.session.execute(sqlalchemy.update(model).where(model.id == obj_id).values(**values))
+        db.session.commit()
+        db.session.expire_all()
+
+    def test_cached_ok(self):
+        self.assertIn('first content', self.visit(self.url))
+
+        self.change_silently(Brief, self.brief.id, content='second content', summarized_content='second content')
+
+        # still the cached version
+        self.assertIn('first content', self.visit(self.url))
+
+        # ... but not for an admin
+        self.login()
+        response = self.client.get(self.url)
+        self.assertIn('second content', response.get_data(as_text=True))
+
+    def test_purged_on_edit_ok(self):
+        self.assertIn('first content', self.visit(self.url))
+
+        self.login()
+        response = self.client.post(flask.url_for('admin.brief-edit', id=self.brief.id, slug=self.brief.slug), data={
+            'title': self.brief.title,
+            'content': 'second content',
+            'summary': 'a summary'
+        }, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+
+        self.assertIn('second content', self.visit(self.url))
+
+    def test_purge_is_precise_ok(self):
+        album = Album.create('an album')
+        db.session.add(album)
+        db.session.commit()
+
+        albums_url = flask.url_for('visitor.albums')
+        self.assertIn('an album', self.visit(albums_url))
+        self.assertIn('first content', self.visit(self.url))
+
+        self.change_silently(Album, album.id, title='another album')
+        self.change_silently(Brief, self.brief.id, content='second content', summarized_content='second content')
+
+        # a brief only purges the pages that use briefs
+        other_brief = Brief.create('other', '', 'other content', visible=True)
+        db.session.add(other_brief)
+        db.session.commit()
+
+        self.assertIn('an album', self.visit(albums_url))
+        self.assertIn('second content', self.visit(self.url))
+
+    def test_filesystem_ok(self):
+        self.app.config['RESPONSE_CACHE'] = 'filesystem'
+        self.app.extensions.pop(ResponseCache.EXTENSION_NAME)
+
+        self.assertIn('first content', self.visit(self.url))
+        self.assertTrue(any((self.data_files_directory / 'cache').iterdir()))
+
+        self.change_silently(Brief, self.brief.id, content='second content', summarized_content='second content')
+        self.assertIn('first content', self.visit(self.url))
+
+        self.brief.content = 'third content'
+        db.session.add(self.brief)
+        db.session.commit()
+
+        self.assertIn('third content', self.visit(self.url))
+
+    def test_storage_bounded_ok(self):
+        for storage in (MemoryStorage(2), FileSystemStorage(self.data_files_directory / 'other', 2)):
+            storage.set('a', 'body a', 'text/html', ['page', 'page:1'], None)
+            storage.set('b', 'body b', 'text/html', ['page', 'brief'], None)
+            storage.set('c', 'body c', 'text/html', ['brief'], None)
+
+            # the least recently used was evicted
+            self.assertIsNone(storage.get('a'))
+            self.assertEqual(storage.get('b'), ('body b', 'text/html'))
+
+            if isinstance(storage, FileSystemStorage):  # (the mtime is used)
+                time.sleep(.01)
+
+            self.assertEqual(storage.get('c'), ('body c', 'text/html'))
+            storage.get('b')
+            storage.set('d', 'body d', 'text/html', ['page'], None)
+            self.assertIsNone(storage.get('c'))
+
+            # purge by tag
+            storage.purge(['page'])
+            self.assertIsNone(storage.get('b'))
+            self.assertIsNone(storage.get('d'))
+
+    def test_query_string_not_in_key_ok(self):
+        for i in range(3):
+            self.assertIn('first content', self.visit('{}?x={}'.format(self.url, i)))
+
+        entries = self.app.extensions[ResponseCache.EXTENSION_NAME].entries
+        self.assertEqual(len(entries), 1)
+
+        # ... unless the page uses it
+        album = Album.create('an album')
+        db.session.add(album)
+        db.session.commit()
+
+        url = flask.url_for('visitor.album', id=album.id, slug=album.slug, _external=False)
+        self.visit(url + '?page=1&x=1')
+        self.assertEqual(len(entries), 2)
+        self.assertTrue(any(key.endswith('.html?page=1') for key in entries))
+
+    def test_csrf_token_not_shared_ok(self):
+        self.app.config['WTF_CSRF_ENABLED'] = True
+
+        first_body = self.visit(self.url)
+        second_body = self.visit(self.url, client=self.app.test_client(use_cookies=True))
+
+        self.assertNotIn(ResponseCache.CSRF_PLACEHOLDER, second_body)
+        self.assertIn('csrf_token', second_body)
+        self.assertNotEqual(first_body, second_body)
+
+
+class TestConditionalResponse(TestFlask):
+
+    def setUp(self):
+        super().setUp()
+
+        self.brief = Brief.create('test', '', 'first content', visible=True)
+        db.session.add(self.brief)
+        db.session.commit()
+
+        self.visitor = self.app.test_client(use_cookies=True)
+        self.url = flask.url_for('visitor.brief-view', id=self.brief.id, slug=self.brief.slug)
+
+    def visit(self, url, **headers):
+        with self.app.app_context():
+            return self.visitor.get(url, headers=headers)
+
+    @staticmethod
+    def edit(obj, **values):
+        """Edit ``obj`` (``date_modified`` has a resolution of one second, so move it forward)"""
+
+        for key, value in values.items():
+            setattr(obj, key, value)
+
+        obj.date_modified = obj.date_modified + datetime.timedelta(seconds=1)
+        db.session.add(obj)
+        db.session.commit()
+
+    def test_not_modified_ok(self):
+        response = self.visit(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.headers.get('ETag'))
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+
+        response = self.visit(self.url, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(as_text=True), '')
+
+        response = self.visit(self.url, **{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # edit the brief
+        self.edit(self.brief, content='second content')
+
+        response = self.visit(self.url, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('second content', response.get_data(as_text=True))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_next_brief_changes_etag_ok(self):
+        response = self.visit(self.url)
+        etag = response.headers['ETag']
+
+        # the page links to the next brief
+        other_brief = Brief.create('other', '', 'other content', visible=True)
+        db.session.add(other_brief)
+        db.session.commit()
+
+        url = flask.url_for('visitor.brief-view', id=other_brief.id, slug=other_brief.slug)
+        etag_other = self.visit(url).headers['ETag']
+
+        self.edit(self.brief, content='second content')
+
+        self.assertEqual(self.visit(self.url, **{'If-None-Match': etag}).status_code, 200)
+        self.assertEqual(self.visit(url, **{'If-None-Match': etag_other}).status_code, 200)
+
+    def test_not_shared_with_admin_ok(self):
+        etag = self.visit(self.url).headers['ETag']
+
+        self.login()
+        response = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
@@ -1,7 +1,8 @@
 import flask
 
 from AM_Nihoul_website import db
-from AM_Nihoul_website.visitor.models import Category
+from AM_Nihoul_website.base_views import navigation_cache
+from AM_Nihoul_website.visitor.models import Category, Page
 from AM_Nihoul_website.tests import TestFlask
 
 
@@ -169,3 +170,19 @@ class TestCategories(TestFlask):
         self.assertEqual(response.status_code, 302)
 
         self.assertTrue(db.session.get(Category, self.category.id).visible)
+
+    def test_navigation_ok(self):
+        page = Page.create('page', 'long content', category_id=self.category.id)
+        contact = Page.create('contact', 'the address')
+        db.session.add_all([page, contact])
+        db.session.commit()
+
+        self.app.config['PAGES'] = dict(self.app.config['PAGES'], contact_page=contact.id)
+        navigation = navigation_cache.build()
+
+        # the content is only kept for the contact page
+        self.assertEqual(navigation.bottom_menu[self.category.name], [(page.id, page.title, page.slug)])
+        self.assertEqual(navigation.contact_page.content, 'the address')
+
+        response = self.client.get(flask.url_for('visitor.page-view', id=page.id, slug=page.slug))
+        self.assertIn('the address', response.get_data(as_text=True))
@@ -1,8 +1,20 @@
 import flask
 import os
 import base64
+import io
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import urlencode
 
-from AM_Nihoul_website.visitor.models import UploadedFile
+from PIL import Image
+
+from werkzeug.datastructures import FileStorage
+
+from AM_Nihoul_website import db, uploads
+from AM_Nihoul_website.visitor.models import Blob, UploadedFile
 from AM_Nihoul_website.tests import TestFlask
 
 
@@ -101,6 +113,269 @@ class TestFiles(TestFlask):
 
         self.app_context.pop()
 
+    def test_upload_api_downscale_ok(self):
+        self.app.config['UPLOAD_MAX_DIMENSION'] = 500
+
+        with open(self.file2, 'rb') as f:
+            b64str = base64.b64encode(f.read()).decode('utf-8')
+
+        response = self.client.post(flask.url_for('admin.image-base64'), data={
+            'image': 'data:image/png;base64,' + b64str,
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['success'])
+
+        u = UploadedFile.query.order_by(UploadedFile.id.desc()).first()
+        self.assertEqual(u.possible_mime, 'image/png')  # not large enough to be converted
+
+        with Image.open(u.path()) as image:
+            self.assertEqual(image.size, (500, round(688 * 500 / 959)))
+
+        # nothing is left behind
+        self.assertEqual(os.listdir(self.data_files_directory / uploads.CHUNKS_DIRECTORY), [])
+
+    def test_upload_api_ko(self):
+        url = flask.url_for('admin.image-base64')
+
+        for data, reason in [
+            ({'other': 'x'}, 'missing `image` field'),
+            ({'image': 'image/png;base64,AAAA'}, 'no data information'),
+            ({'image': 'data:image/png;utf-8,AAAA'}, 'not base64'),
+            ({'image': 'data:text/plain;base64,AAAA'}, 'mime does not starts with `image/'),
+            ({'image': 'data:image/png;base64,AAAAA'}, 'incorrect padding'),
+        ]:
+            response = self.client.post(url, data=data)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json['reason'], reason)
+
+        self.assertEqual(UploadedFile.query.count(), self.num_uploads)
+        self.assertEqual(os.listdir(self.data_files_directory / uploads.CHUNKS_DIRECTORY), [])
+
+    def test_iter_urlencoded_field_ok(self):
+        body = urlencode({'before': 'a&b=c', 'image': 'data:image/png;base64,AB+/CD==', 'after': 'x'}).encode()
+
+        for block_size in (1, 2, 3, 1024):  # escape sequences are cut
+            self.assertEqual(
+                ''.join(uploads.iter_urlencoded_field(io.BytesIO(body), 'image', block_size)),
+                'data:image/png;base64,AB+/CD==')
+
+        self.assertEqual(list(uploads.iter_urlencoded_field(io.BytesIO(body), 'missing', 3)), [])
+
+    def send_chunks(self, url: str, path: str, fname: str, chunk_size: int, order=None, **data):
+        """Send the file at ``path`` by chunks, as Dropzone does, in ``order`` (if any)"""
+
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+        dzuuid = str(uuid.uuid4())
+
+        responses = []
+        for index in (order if order is not None else range(len(chunks))):
+            responses.append(self.client.post(url, data=dict(
+                file_uploaded=(io.BytesIO(chunks[index]), fname),
+                dzuuid=dzuuid,
+                dzchunkindex=index,
+                dztotalfilesize=len(content),
+                dzchunksize=chunk_size,
+                dztotalchunkcount=len(chunks),
+                dzchunkbyteoffset=index * chunk_size,
+                **data)))
+
+        return responses, content
+
+    def test_upload_chunks_ok(self):
+        url = flask.url_for('admin.files-dropzone-upload')
+
+        num_chunks = os.path.getsize(self.file2) // 5000 + 1
+        self.assertGreater(num_chunks, 4)
+
+        # the second chunk is sent again (as after a dropped connection), and the last one comes before the third
+        responses, content = self.send_chunks(
+            url, self.file2, 'big.png', 5000, order=[0, 1, 1, num_chunks - 1] + list(range(2, num_chunks - 1)),
+            description='big')
+
+        for response in responses:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json['status'], 'ok')
+
+        self.assertEqual(UploadedFile.query.count(), self.num_uploads + 1)
+
+        u = UploadedFile.query.order_by(UploadedFile.id.desc()).first()
+        self.assertEqual(u.base_file_name, 'big.png')
+        self.assertEqual(u.description, 'big')
+        self.assertEqual(u.file_size, len(content))
+        self.assertEqual(u.possible_mime, 'image/png')
+
+        with open(u.path(), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+        # nothing is left behind
+        self.assertEqual(os.listdir(self.data_files_directory / uploads.CHUNKS_DIRECTORY), [])
+
+    def test_upload_chunks_not_allowed_ko(self):
+        responses, _ = self.send_chunks(flask.url_for('admin.files-dropzone-upload'), self.file2, 'big.exe', 10000)
+
+        self.assertEqual(responses[0].status_code, 400)
+        self.assertEqual(UploadedFile.query.count(), self.num_uploads)
+        self.assertFalse(os.path.exists(self.data_files_directory / uploads.CHUNKS_DIRECTORY))  # nothing was written
+
+    def test_upload_chunks_too_large_ko(self):
+        url = flask.url_for('admin.files-dropzone-upload')
+        data = dict(dzuuid=str(uuid.uuid4()), dzchunkindex=0, dztotalchunkcount=2, dzchunkbyteoffset=0)
+        directory = self.data_files_directory / uploads.CHUNKS_DIRECTORY
+
+        # the declared size is above the limit
+        response = self.client.post(url, data=dict(
+            file_uploaded=(io.BytesIO(b'x' * 10), 'big.png'),
+            dztotalfilesize=self.app.config['CHUNKED_UPLOAD_MAX_SIZE'] + 1,
+            **data))
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(os.path.exists(directory))  # nothing was written
+
+        # the chunk goes past the declared size
+        self.send_chunks(url, self.file2, 'big.png', 10000, order=[0])
+        response = self.client.post(url, data=dict(
+            file_uploaded=(io.BytesIO(b'x' * 20), 'big.png'), dztotalfilesize=10, **data))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(os.listdir(directory)), 2)  # only the other upload is left
+        self.assertFalse(os.path.exists(directory / '{}.part'.format(data['dzuuid'])))
+
+    def test_remove_stale_chunks_ok(self):
+        responses, _ = self.send_chunks(
+            flask.url_for('admin.files-dropzone-upload'), self.file2, 'big.png', 10000, order=[0, 1])
+        self.assertEqual(responses[-1].status_code, 200)
+
+        directory = self.data_files_directory / uploads.CHUNKS_DIRECTORY
+        self.assertEqual(len(os.listdir(directory)), 2)  # chunks and their index
+
+        self.assertEqual(uploads.remove_stale(datetime.now() - self.app.config['CHUNKED_UPLOAD_TIMEOUT']), 0)
+
+        past = time.time() - self.app.config['CHUNKED_UPLOAD_TIMEOUT'].total_seconds() - 60
+        for name in os.listdir(directory):
+            os.utime(directory / name, (past, past))
+
+        self.assertEqual(uploads.remove_stale(datetime.now() - self.app.config['CHUNKED_UPLOAD_TIMEOUT']), 1)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_upload_same_content_ok(self):
+        for fname in ('tmp.jpg', 'other.jpg'):
+            response = self.client.post(
+                flask.url_for('admin.files'), data={'file_uploaded': (open(self.file, 'rb'), fname)})
+            self.assertEqual(response.status_code, 302)
+
+        u1, u2 = UploadedFile.query.order_by(UploadedFile.id.desc()).limit(2).all()
+        self.assertNotEqual(u1.file_name, u2.file_name)
+
+        # stored once
+        self.assertEqual(u1.blob_id, u2.blob_id)
+        self.assertEqual(u1.path(), u2.path())
+        self.assertEqual(u1.blob.refcount, 2)
+        self.assertEqual(len(os.listdir(self.app.config['UPLOADED_UPLOADS_DEST'])), 1)  # `blobs/`
+
+        # ... with the same ETag
+        etags = [
+            self.client.get(flask.url_for('visitor.upload-view', id=u.id, filename=u.file_name)).headers['ETag']
+            for u in (u1, u2)
+        ]
+        self.assertEqual(etags[0], etags[1])
+
+        # the file is removed with the last one
+        self.client.delete(flask.url_for('admin.file-delete', id=u1.id))
+        self.assertTrue(os.path.exists(u2.path()))
+        self.assertEqual(db.session.get(Blob, u2.blob_id, populate_existing=True).refcount, 1)
+
+        self.client.delete(flask.url_for('admin.file-delete', id=u2.id))
+        self.assertFalse(os.path.exists(u2.path()))
+        self.assertIsNone(db.session.get(Blob, u2.blob_id, populate_existing=True))
+
+    def test_upload_same_content_concurrently_ok(self):
+        barrier = threading.Barrier(2)
+        errors = []
+
+        def upload(fname):
+            with self.app.app_context(), open(self.file, 'rb') as f:
+                storage = FileStorage(stream=f, filename=fname)
+                barrier.wait()
+                try:
+                    db.session.add(UploadedFile.create(storage, fname))
+                    db.session.commit()
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=upload, args=(fname, )) for fname in ('tmp.jpg', 'other.jpg')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        u1, u2 = UploadedFile.query.order_by(UploadedFile.id.desc()).limit(2).all()
+        self.assertEqual(u1.blob_id, u2.blob_id)
+        self.assertEqual(u1.blob.refcount, 2)
+        self.assertTrue(os.path.exists(u1.path()))
+
+    def test_upload_same_name_ok(self):
+        files = []
+        for path in (self.file, self.file2, self.file):
+            with open(path, 'rb') as f:
+                u = UploadedFile.create(FileStorage(stream=f, filename='tmp.jpg'), 'tmp.jpg')
+                db.session.add(u)
+                db.session.commit()
+                files.append(u)
+
+        # the name is not reused, even by the same content
+        self.assertEqual([u.file_name for u in files], ['tmp.jpg', 'tmp_1.jpg', 'tmp_2.jpg'])
+        self.assertEqual(files[0].blob_id, files[2].blob_id)
+
+    def test_deduplicate_ok(self):
+        # files uploaded before the blob store
+        directory = self.app.config['UPLOADED_UPLOADS_DEST']
+        os.makedirs(directory)
+
+        legacy = []
+        for fname in ('a.jpg', 'b.jpg'):
+            shutil.copy(self.file, directory / fname)
+            u = UploadedFile()
+            u.base_file_name = u.file_name = fname
+            u.file_size = os.path.getsize(self.file)
+            u.possible_mime = 'image/jpeg'
+            db.session.add(u)
+            legacy.append(u)
+
+        db.session.commit()
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['deduplicate'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn(
+            '2 uploaded_file stored by content, {} bytes saved'.format(os.path.getsize(self.file)), result.output)
+
+        u1, u2 = (db.session.get(UploadedFile, u.id, populate_existing=True) for u in legacy)
+        self.assertIsNotNone(u1.blob)
+        self.assertEqual(u1.blob_id, u2.blob_id)
+
+        # the previous paths are kept (for the previous URLs), as links to the blob
+        for fname in ('a.jpg', 'b.jpg'):
+            self.assertTrue(os.path.samefile(directory / fname, u1.path()))
+
+        response = self.client.get(flask.url_for('visitor.upload-view', id=u2.id, filename=u2.file_name))
+        self.assertEqual(response.status_code, 200)
+
+        # nothing left
+        result = runner.invoke(args=['deduplicate'])
+        self.assertIn('0 uploaded_file stored by content', result.output)
+
+        # the previous path is removed with the file
+        self.client.delete(flask.url_for('admin.file-delete', id=u1.id))
+        self.assertFalse(os.path.exists(directory / 'a.jpg'))
+        self.assertTrue(os.path.exists(directory / 'b.jpg'))
+
+        self.client.delete(flask.url_for('admin.file-delete', id=u2.id))
+        self.assertFalse(os.path.exists(directory / 'b.jpg'))
+        self.assertFalse(os.path.exists(u2.path()))
+
     def test_visitor_view_ok(self):
         # upload file first (as admin)
         desc = 'a description'
@@ -133,6 +408,45 @@ class TestFiles(TestFlask):
         self.assertEqual(content, response.data)
         self.assertEqual(response.headers.get('Content-Disposition'), 'attachment; filename={}'.format(u.file_name))
 
+    def test_visitor_view_range_ok(self):
+        with open(self.file, 'rb') as f:
+            content = f.read()
+
+        with open(self.file, 'rb') as f:
+            u = UploadedFile.create(FileStorage(f, 'tmp.jpg'), 'tmp.jpg')
+        db.session.add(u)
+        db.session.commit()
+
+        url = flask.url_for('visitor.upload-view', id=u.id, filename=u.file_name)
+
+        # ranges
+        response = self.client.get(url, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, content[10:20])
+        self.assertEqual(response.headers.get('Content-Range'), 'bytes 10-19/{}'.format(len(content)))
+
+        # conditional
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.headers.get('ETag'))
+
+        response = self.client.get(url, headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_visitor_view_x_accel_redirect_ok(self):
+        self.app.config['X_ACCEL_REDIRECT_PREFIX'] = '/protected/'
+
+        with open(self.file, 'rb') as f:
+            u = UploadedFile.create(FileStorage(f, 'tmp.jpg'), 'tmp.jpg')
+        db.session.add(u)
+        db.session.commit()
+
+        response = self.client.get(flask.url_for('visitor.upload-view', id=u.id, filename=u.file_name))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers.get('X-Accel-Redirect'), '/protected/{}'.format(u.blob.file_name))
+        self.assertEqual(response.headers.get('Content-Disposition'), 'attachment; filename={}'.format(u.file_name))
+
     def test_upload_not_admin_ko(self):
         self.assertEqual(UploadedFile.query.count(), self.num_uploads)
         self.logout()
@@ -1,16 +1,24 @@
+import base64
 import flask
 import datetime
 import os
 import pathlib
+import threading
+import time
 from bs4 import BeautifulSoup
+from googleapiclient.errors import HttpError
+import httplib2
+import sqlalchemy
+from markupsafe import escape
 
 from werkzeug.datastructures import FileStorage
 
 import AM_Nihoul_website
 from AM_Nihoul_website.tests import TestFlask
-from AM_Nihoul_website import db, bot
-from AM_Nihoul_website.visitor.models import NewsletterRecipient, Email, Newsletter, UploadedFile, EmailImageAttachment
-from AM_Nihoul_website.admin.utils import Message
+from AM_Nihoul_website import db, bot, thumbnails
+from AM_Nihoul_website.visitor.models import NewsletterRecipient, Email, Newsletter, UploadedFile, \
+    EmailImageAttachment, EmailCampaign, EmailArchive
+from AM_Nihoul_website.admin.utils import AttachmentCache, Message
 from AM_Nihoul_website.visitor.utils import make_summary
 
 
@@ -36,6 +44,30 @@ class TestFakeMailClient(TestFlask):
             self.assertIn(message.recipient, f_content)
             self.assertIn(message.msg_plain, f_content)
 
+    def test_attachment_cache_ok(self):
+        cache = AttachmentCache()
+        logo = bot.BASE / self.app.config['NEWSLETTER_LOGO']
+
+        messages = []
+        for i in range(2):
+            message = Message(
+                recipient='test{}@xyz.com'.format(i), sender='me@xyz.com', msg_html='test', attachment_cache=cache)
+            message.add_html_attachment(logo, cid='newsletter-logo')
+            messages.append(message)
+
+        # encoded once, but used by both
+        self.assertIs(messages[0].html_attachments[0], messages[1].html_attachments[0])
+        self.assertEqual(len(cache.attachments), 1)
+
+        for message in messages:
+            raw = base64.urlsafe_b64decode(message.prepare()['raw']).decode()
+            self.assertIn('<newsletter-logo>', raw)
+
+        # ... unless the cid differs
+        message = Message(recipient='test@xyz.com', sender='me@xyz.com', msg_html='test', attachment_cache=cache)
+        message.add_html_attachment(logo, cid='other')
+        self.assertIsNot(message.html_attachments[0], messages[0].html_attachments[0])
+
 
 class TestNewsletterRecipient(TestFlask):
 
@@ -179,6 +211,34 @@ class TestNewsletterRecipient(TestFlask):
             self.assertEqual(self.num_recipients - 1, NewsletterRecipient.query.count())
             self.assertIsNone(self.db_session.get(NewsletterRecipient, self.subscribed_first_step.id))
 
+    def test_removed_by_bot_with_emails_ok(self):
+        old_date = datetime.datetime.now() - self.app.config['REMOVE_RECIPIENTS_DELTA'] - datetime.timedelta(seconds=1)
+        stale = [NewsletterRecipient.create('stale {}'.format(i), 's{}@yz.com'.format(i)) for i in range(3)]
+        db.session.add_all(stale)
+        db.session.commit()
+
+        db.session.execute(sqlalchemy.update(NewsletterRecipient).where(
+            NewsletterRecipient.id.in_([r.id for r in stale])).values(date_created=old_date))
+
+        queued = Email.create('confirm', 'test', recipient_id=stale[0].id)
+        other = Email.create('other', 'test', recipient_id=self.subscribed.id)
+        db.session.add_all([queued, other])
+        db.session.commit()
+
+        num_emails = Email.query.count()
+        queued_id, other_id = queued.id, other.id
+
+        with self.app.app_context():
+            self.assertEqual(NewsletterRecipient.remove_unconfirmed(
+                datetime.datetime.now() - self.app.config['REMOVE_RECIPIENTS_DELTA']), (3, 1))
+            db.session.commit()
+
+        db.session.expire_all()
+        self.assertEqual(NewsletterRecipient.query.count(), self.num_recipients)
+        self.assertEqual(Email.query.count(), num_emails - 1)
+        self.assertIsNone(db.session.get(Email, queued_id))
+        self.assertIsNotNone(db.session.get(Email, other_id))
+
     def test_not_removed_by_bot_above_limit_ok(self):
         self.assertEqual(self.num_recipients, NewsletterRecipient.query.count())
 
@@ -191,6 +251,38 @@ class TestNewsletterRecipient(TestFlask):
         db.session.add(n)
         self.assertIsNotNone(n)
 
+    def test_not_removed_by_bot_not_locked_ok(self):
+        in_transaction = []
+
+        def generate_stale(before):
+            # the deletes (even of nothing) are committed before
+            in_transaction.append(db.session.connection().connection.dbapi_connection.in_transaction)
+            return 0
+
+        previous, thumbnails.generate_stale = thumbnails.generate_stale, generate_stale
+        try:
+            bot.bot_iteration()
+        finally:
+            thumbnails.generate_stale = previous
+
+        self.assertEqual(in_transaction, [False])
+
+    def test_sent_by_bot_despite_thumbnails_ok(self):
+        e = Email.create('test', 'test', recipient_id=self.subscribed.id)
+        db.session.add(e)
+        db.session.commit()
+
+        def generate_stale(before):
+            raise RuntimeError('broken')
+
+        previous, thumbnails.generate_stale = thumbnails.generate_stale, generate_stale
+        try:
+            stats = bot.bot_iteration()
+        finally:
+            thumbnails.generate_stale = previous
+
+        self.assertEqual(stats.sent, 1)
+
     def test_not_removed_by_bot_confirmed_ok(self):
         self.assertEqual(self.num_recipients, NewsletterRecipient.query.count())
 
@@ -230,6 +322,405 @@ class TestNewsletterRecipient(TestFlask):
             self.assertIn(self.subscribed_first_step.email, content)
             self.assertIn(self.image.base_file_name, content)
 
+    def test_sent_by_bot_within_quota(self):
+        self.app.config.update(BOT_EMAILS_PER_MINUTE=3, BOT_BATCH_SIZE=2, BOT_WORKERS=2)
+
+        emails = [Email.create('test {}'.format(i), 'test', recipient_id=self.subscribed.id) for i in range(5)]
+        db.session.add_all(emails)
+        db.session.commit()
+
+        # only 3 are sent
+        stats = bot.bot_iteration()
+        self.assertEqual(stats.sent, 3)
+        self.assertGreater(stats.per_minute, 0)
+
+        with self.app.app_context():
+            self.assertEqual(Email.query.filter(Email.sent.is_(True)).count(), 3)
+
+        # ... and the others have to wait
+        stats = bot.bot_iteration()
+        self.assertEqual(stats.sent, 0)
+
+        with self.app.app_context():
+            self.assertEqual(Email.query.filter(Email.sent.is_(True)).count(), 3)
+
+        with open(os.path.join(self.data_files_directory, bot.FakeMailClient.OUT)) as f:
+            self.assertEqual(f.read().count('SUBJECT: test'), 3)
+
+    def test_client_reused_by_bot(self):
+        db.session.add(Email.create('test', 'test', recipient_id=self.subscribed.id))
+        db.session.commit()
+        bot.bot_iteration()
+
+        mail_client = bot.get_client()
+        self.assertIsInstance(mail_client, bot.FakeMailClient)
+
+        db.session.add(Email.create('test', 'test', recipient_id=self.subscribed.id))
+        db.session.commit()
+        bot.bot_iteration()
+
+        self.assertIs(bot.get_client(), mail_client)
+
+    def test_client_rebuilt_after_auth_error(self):
+        class FailingClient:
+            def send(self, message, **kwargs):
+                raise HttpError(httplib2.Response({'status': 401}), b'')
+
+        self.app.extensions[bot.CLIENT_EXTENSION_NAME] = FailingClient()
+
+        db.session.add(Email.create('test', 'test', recipient_id=self.subscribed.id))
+        db.session.commit()
+
+        with self.assertRaises(HttpError):
+            bot.bot_iteration()
+
+        self.assertIsInstance(bot.get_client(), bot.FakeMailClient)
+
+    def count_bot_queries(self) -> int:
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            bot.bot_iteration()
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+        return len([s for s in statements if s.startswith('SELECT')])
+
+    def test_bot_queries_do_not_depend_on_emails(self):
+        num_queries = []
+        for n in (2, 8):
+            emails = [Email.create('test', 'test', recipient_id=self.subscribed.id) for _ in range(n)]
+            db.session.add_all(emails)
+            db.session.commit()
+            db.session.add_all(EmailImageAttachment.create(e.id, self.image.id) for e in emails)
+            db.session.commit()
+
+            num_queries.append(self.count_bot_queries())
+
+            with self.app.app_context():
+                self.assertEqual(Email.query.filter(Email.sent.is_(False)).count(), 0)
+
+        self.assertEqual(num_queries[0], num_queries[1])
+
+    def test_sent_by_bot_per_iteration(self):
+        self.app.config.update(BOT_EMAILS_PER_ITERATION=3, BOT_BATCH_SIZE=2)
+
+        emails = [Email.create('test {}'.format(i), 'test', recipient_id=self.subscribed.id) for i in range(4)]
+        db.session.add_all(emails)
+        db.session.commit()
+
+        self.assertEqual(bot.bot_iteration().sent, 3)
+        self.assertEqual(bot.bot_iteration().sent, 1)
+
+        # the oldest first
+        with self.app.app_context():
+            self.assertTrue(self.db_session.get(Email, emails[2].id).sent)
+
+    def test_archive_emails_ok(self):
+        old_date = datetime.datetime.now() - self.app.config['ARCHIVE_EMAILS_DELTA'] - datetime.timedelta(days=1)
+
+        emails = [
+            Email.create('old', 'test', recipient_id=self.subscribed.id),
+            Email.create('recent', 'test', recipient_id=self.subscribed.id),
+            Email.create('unsent', 'test', recipient_id=self.subscribed.id),
+        ]
+
+        emails[0].sent = emails[1].sent = True
+        db.session.add_all(emails)
+        db.session.commit()
+
+        db.session.add(EmailImageAttachment.create(emails[0].id, self.image.id))
+        db.session.execute(sqlalchemy.update(Email).where(Email.id.in_([e.id for e in emails if e.title != 'recent']))
+                           .values(date_modified=old_date))
+        db.session.commit()
+
+        num_emails = Email.query.count()
+        result = self.app.test_cli_runner().invoke(args=['archive-emails'])
+        self.assertIn('1 email(s) archived', result.output)
+
+        db.session.expire_all()
+        self.assertEqual(Email.query.count(), num_emails - 1)
+        self.assertIsNone(db.session.get(Email, emails[0].id))
+        self.assertEqual(EmailImageAttachment.query.filter(EmailImageAttachment.email_id == emails[0].id).count(), 0)
+
+        archived = EmailArchive.query.all()
+        self.assertEqual([e.title for e in archived], ['old'])
+
+        # delete
+        db.session.execute(sqlalchemy.update(Email).where(Email.id == emails[1].id).values(date_modified=old_date))
+        db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['archive-emails', '--delete'])
+        self.assertIn('1 email(s) deleted', result.output)
+        self.assertEqual(EmailArchive.query.count(), 1)
+        self.assertEqual(Email.query.count(), num_emails - 2)
+
+    def test_archive_emails_utc_ok(self):
+        e = Email.create('recent', 'test', recipient_id=self.subscribed.id)
+        e.sent = True
+        db.session.add(e)
+        db.session.commit()
+
+        self.app.config['ARCHIVE_EMAILS_DELTA'] = datetime.timedelta(hours=1)
+
+        # `date_modified` is in UTC, whatever the local time is
+        previous_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Etc/GMT-2'  # UTC+2
+        time.tzset()
+
+        try:
+            result = self.app.test_cli_runner().invoke(args=['archive-emails'])
+        finally:
+            if previous_tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = previous_tz
+            time.tzset()
+
+        self.assertIn('0 email(s) archived', result.output)
+        self.assertIsNotNone(db.session.get(Email, e.id, populate_existing=True))
+
+    def test_claim_ok(self):
+        emails = [Email.create('test {}'.format(i), 'test', recipient_id=self.subscribed.id) for i in range(3)]
+        db.session.add_all(emails)
+        db.session.commit()
+
+        lease = datetime.timedelta(minutes=1)
+        token_1 = Email.claim(2, lease)
+        token_2 = Email.claim(2, lease)
+
+        self.assertEqual([e.id for e in Email.claimed(token_1)], [emails[0].id, emails[1].id])
+        self.assertEqual([e.id for e in Email.claimed(token_2)], [emails[2].id])
+        self.assertIsNone(Email.claim(2, lease))
+
+        # released
+        Email.release(token_1)
+        token_3 = Email.claim(2, lease)
+        self.assertEqual([e.id for e in Email.claimed(token_3)], [emails[0].id, emails[1].id])
+
+        # expired
+        db.session.execute(sqlalchemy.update(Email).where(Email.id == emails[2].id).values(
+            lease_until=datetime.datetime.now() - datetime.timedelta(seconds=1)))
+        db.session.commit()
+
+        token_4 = Email.claim(2, lease)
+        self.assertEqual([e.id for e in Email.claimed(token_4)], [emails[2].id])
+        self.assertEqual(Email.claimed(token_2).count(), 0)
+
+    def test_claimed_not_sent_by_bot(self):
+        e = Email.create('test', 'test', recipient_id=self.subscribed.id)
+        db.session.add(e)
+        db.session.commit()
+
+        token = Email.claim(1, datetime.timedelta(minutes=1))
+        self.assertIsNone(bot.bot_iteration())
+
+        Email.release(token)
+        self.assertEqual(bot.bot_iteration().sent, 1)
+
+    def test_worker_ok(self):
+        worker = bot.Worker(interval=60, poll_interval=.05)
+
+        def run():
+            with self.app.app_context():
+                worker.run()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+
+        try:
+            # wakes up on new emails
+            time.sleep(.2)
+            e = Email.create('test', 'test', recipient_id=self.subscribed.id)
+            db.session.add(e)
+            db.session.commit()
+
+            for _ in range(100):
+                db.session.expire_all()
+                if db.session.get(Email, e.id).sent:
+                    break
+                time.sleep(.05)
+
+            self.assertTrue(db.session.get(Email, e.id).sent)
+        finally:
+            worker.shutdown()
+            thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+
+    def test_failed_email_retried_ok(self):
+        self.app.config.update(BOT_MAX_ATTEMPTS=2, BOT_BATCH_SIZE=1)
+
+        class PoisonClient(bot.FakeMailClient):
+            def send(self, message, **kwargs):
+                if message.subject == 'poison':
+                    raise ValueError('bad address')
+
+                super().send(message, **kwargs)
+
+        self.app.extensions[bot.CLIENT_EXTENSION_NAME] = PoisonClient()
+
+        poison = Email.create('poison', 'test', recipient_id=self.subscribed.id)
+        other = Email.create('other', 'test', recipient_id=self.subscribed.id)
+        db.session.add_all([poison, other])
+        db.session.commit()
+
+        # the poison email does not block the other one
+        stats = bot.bot_iteration()
+        self.assertEqual((stats.sent, stats.failures), (1, 1))
+
+        db.session.expire_all()
+        self.assertTrue(db.session.get(Email, other.id).sent)
+
+        e = db.session.get(Email, poison.id)
+        self.assertEqual(e.attempts, 1)
+        self.assertIn('bad address', e.last_error)
+        self.assertGreater(e.next_attempt, datetime.datetime.now())
+        self.assertFalse(e.failed)
+
+        # not before the next attempt
+        self.assertIsNone(bot.bot_iteration())
+
+        # ... and then, gives up
+        db.session.execute(sqlalchemy.update(Email).where(Email.id == poison.id).values(
+            next_attempt=datetime.datetime.now() - datetime.timedelta(seconds=1)))
+        db.session.commit()
+
+        self.assertEqual(bot.bot_iteration().failures, 1)
+
+        db.session.expire_all()
+        e = db.session.get(Email, poison.id)
+        self.assertEqual(e.attempts, 2)
+        self.assertTrue(e.failed)
+        self.assertIsNone(Email.claim(1, datetime.timedelta(minutes=1)))
+
+        # visible in the admin, which can retry
+        self.login()
+        response = self.client.get(flask.url_for('admin.emails-failed'))
+        self.assertIn('bad address', response.get_data(as_text=True))
+
+        response = self.client.get(flask.url_for('admin.email-retry', id=poison.id))
+        self.assertEqual(response.status_code, 302)
+
+        db.session.expire_all()
+        e = db.session.get(Email, poison.id)
+        self.assertFalse(e.failed)
+        self.assertEqual(e.attempts, 0)
+
+    def test_recipient_deleted_while_queued_ok(self):
+        gone = NewsletterRecipient.create('test3', 'x3@yz.com', confirmed=True)
+        db.session.add(gone)
+        db.session.commit()
+
+        orphan = Email.create('test', 'test', recipient_id=gone.id)
+        other = Email.create('test', 'test', recipient_id=self.subscribed.id)
+        db.session.add_all([orphan, other])
+        db.session.commit()
+
+        # unsubscribes before the emails are sent
+        response = self.client.get(flask.url_for('visitor.newsletter-unsubscribe', id=gone.id, hash=gone.hash))
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(db.session.get(NewsletterRecipient, gone.id))
+
+        stats = bot.bot_iteration()
+        self.assertEqual((stats.sent, stats.failures), (1, 1))
+
+        db.session.expire_all()
+        self.assertTrue(db.session.get(Email, other.id).sent)
+
+        # not tried again
+        e = db.session.get(Email, orphan.id)
+        self.assertTrue(e.failed)
+        self.assertFalse(e.sent)
+        self.assertIn('RecipientDeleted', e.last_error)
+
+        # nothing left to send
+        self.assertIsNone(bot.bot_iteration())
+
+    def test_nothing_to_send_ok(self):
+        failed = Email.create('test', 'test', recipient_id=self.subscribed.id)
+        failed.failed = True
+        postponed = Email.create('test', 'test', recipient_id=self.subscribed.id)
+        postponed.next_attempt = datetime.datetime.now() + datetime.timedelta(minutes=5)
+        db.session.add_all([failed, postponed])
+        db.session.commit()
+
+        # not even a client
+        self.assertIsNone(bot.bot_iteration())
+        self.assertNotIn(bot.CLIENT_EXTENSION_NAME, self.app.extensions)
+
+    def test_throttled_bot_stops(self):
+        self.app.config.update(BOT_BATCH_SIZE=1)
+
+        class ThrottledClient:
+            def send(self, message, **kwargs):
+                raise HttpError(httplib2.Response({'status': 429}), b'')
+
+        self.app.extensions[bot.CLIENT_EXTENSION_NAME] = ThrottledClient()
+
+        db.session.add_all([Email.create('test', 'test', recipient_id=self.subscribed.id) for _ in range(3)])
+        db.session.commit()
+
+        stats = bot.bot_iteration()
+        self.assertEqual((stats.sent, stats.failures, stats.postponed), (0, 0, 1))
+
+        # postponed, but not counted as an attempt
+        e = Email.query.filter(Email.last_error.is_not(None)).one()
+        self.assertEqual(e.attempts, 0)
+        self.assertFalse(e.failed)
+        self.assertGreater(e.next_attempt, datetime.datetime.now() + self.app.config['BOT_RETRY_DELAY'])
+
+    def test_throttled_not_failed_ok(self):
+        self.app.config.update(BOT_MAX_ATTEMPTS=2, BOT_THROTTLE_DELAY=datetime.timedelta(0))
+
+        class ThrottledClient:
+            def send(self, message, **kwargs):
+                raise HttpError(httplib2.Response({'status': 429}), b'')
+
+        self.app.extensions[bot.CLIENT_EXTENSION_NAME] = ThrottledClient()
+
+        e = Email.create('test', 'test', recipient_id=self.subscribed.id)
+        db.session.add(e)
+        db.session.commit()
+
+        # more than `BOT_MAX_ATTEMPTS` times
+        for _ in range(3):
+            stats = bot.bot_iteration()
+            self.assertEqual(stats.postponed, 1)
+
+        e = db.session.get(Email, e.id, populate_existing=True)
+        self.assertFalse(e.failed)
+        self.assertEqual(e.attempts, 0)
+        self.assertIn('HttpError', e.last_error)
+
+        # ... then sent
+        del self.app.extensions[bot.CLIENT_EXTENSION_NAME]
+        stats = bot.bot_iteration()
+        self.assertEqual(stats.sent, 1)
+
+    def test_campaign_sent_by_bot(self):
+        campaign = EmailCampaign.create('test', '<p>Hello {}</p>'.format(EmailCampaign.placeholder('recipient_name')))
+        db.session.add(campaign)
+        db.session.commit()
+
+        e = Email.create(
+            'test', None, recipient_id=self.subscribed.id, campaign_id=campaign.id,
+            variables={'recipient_name': '<b>test</b>'})
+        db.session.add(e)
+        db.session.commit()
+
+        bot.bot_iteration()
+
+        with self.app.app_context():
+            self.assertTrue(self.db_session.get(Email, e.id).sent)
+
+        with open(os.path.join(self.data_files_directory, bot.FakeMailClient.OUT)) as f:
+            self.assertIn('<p>Hello &lt;b&gt;test&lt;/b&gt;</p>', f.read())
+
 
 class TestNewsletter(TestFlask):
 
@@ -547,8 +1038,8 @@ class TestNewsletter(TestFlask):
         e = Email.query.order_by(Email.id.desc()).first()
         self.assertEqual(e.recipient, self.subscribed)
 
-        self.assertIn(n.title, e.content)
-        self.assertIn(n.content, e.content)
+        self.assertIn(n.title, e.get_content())
+        self.assertIn(n.content, e.get_content())
 
     def test_publish_newsletter_with_image_ok(self):
         self.assertTrue(self.draft_newsletter_with_image.draft)
@@ -572,7 +1063,37 @@ class TestNewsletter(TestFlask):
         self.assertEqual(attachments[0].image.id, self.image.id)
 
         # check cid is actually used
-        self.assertIn('cid:{}'.format(self.image.file_name), e.content)
+        self.assertIn('cid:{}'.format(self.image.file_name), e.get_content())
+
+    def test_publish_newsletter_many_recipients_ok(self):
+        others = [NewsletterRecipient.create('<other {}>'.format(i), 'o{}@yz.com'.format(i), confirmed=True)
+                  for i in range(3)]
+        db.session.add_all(others)
+        db.session.commit()
+
+        response = self.client.post(
+            flask.url_for('admin.newsletter-publish', id=self.draft_newsletter_with_image.id), data={'confirm': True})
+
+        self.assertEqual(response.status_code, 302)
+
+        # one email per confirmed recipient, each with its own name, link and attachments
+        emails = Email.query.order_by(Email.id.desc()).limit(len(others) + 1).all()
+        self.assertEqual(self.num_email + len(others) + 1, Email.query.count())
+        self.assertEqual({e.recipient_id for e in emails}, {self.subscribed.id} | {r.id for r in others})
+
+        for e in emails:
+            r = e.recipient
+            self.assertIn('Bonjour {},'.format(escape(r.name)), e.get_content())
+            self.assertIn(flask.url_for(
+                'visitor.newsletter-unsubscribe', id=r.id, hash=r.hash, _external=True), e.get_content())
+            self.assertNotIn('%%', e.get_content())
+
+            self.assertEqual([a.image_id for a in e.attachments()], [self.image.id])
+
+        # ... but the content is only stored once
+        self.assertEqual(EmailCampaign.query.count(), 1)
+        self.assertEqual({e.campaign_id for e in emails}, {EmailCampaign.query.first().id})
+        self.assertTrue(all(e.content is None for e in emails))
 
     def test_publish_newsletter_summary_ok(self):
         # add summary
@@ -600,7 +1121,7 @@ class TestNewsletter(TestFlask):
         self.assertEqual(self.num_email + 1, Email.query.count())
         e = Email.query.order_by(Email.id.desc()).first()
 
-        soup = BeautifulSoup(e.content, 'html.parser')
+        soup = BeautifulSoup(e.get_content(), 'html.parser')
         self.assertIsNone(soup.find('summary'))
         summary_list = soup.find('ul', class_='summary')
         self.assertIsNotNone(summary_list)
@@ -429,6 +429,49 @@ class TestPage(TestFlask):
         self.assertEqual(len(a_tags), len(titles))
         self.assertEqual([a.string for a in a_tags], titles)
 
+    def test_summary_stored_ok(self):
+        content = '<summary></summary> <h3>a first</h3>'
+
+        p = Page.create('test', content)
+        db.session.add(p)
+        db.session.commit()
+
+        self.assertIsNotNone(p.summarized_content)
+        self.assertIn('class="summary"', p.summarized_content)
+        self.assertEqual(p.content_with_summary(), p.summarized_content)
+
+        # edited content is also handled
+        response = self.client.post(flask.url_for('admin.page-edit', id=p.id, slug=p.slug), data={
+            'title': p.title,
+            'content': 'no summary',
+            'category': -1,
+            'next': -1
+        }, follow_redirects=False)
+        self.assertEqual(response.status_code, 302)
+
+        p = self.db_session.get(Page, p.id)
+        self.assertEqual(p.summarized_content, 'no summary')
+
+    def test_summaries_command_ok(self):
+        p = Page.create('test', '<summary></summary> <h3>a first</h3>')
+        db.session.add(p)
+        db.session.commit()
+
+        # mimic a page that was there before the column
+        Page.query.update({Page.summarized_content: None})
+        db.session.commit()
+        db.session.refresh(p)
+
+        self.assertIsNone(p.summarized_content)
+        self.assertIn('class="summary"', p.content_with_summary())  # fallback
+
+        result = self.app.test_cli_runner().invoke(args=['summaries'])
+        self.assertEqual(result.exit_code, 0)
+
+        db.session.refresh(p)
+        self.assertIsNotNone(p.summarized_content)
+        self.assertIn('class="summary"', p.summarized_content)
+
     def test_visitor_hidden_page_ko(self):
         title = 'a special title'
         content = 'test with a very special content: "pôtichat"!'
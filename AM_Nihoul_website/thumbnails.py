@@ -0,0 +1,403 @@
+"""
+Thumbnails of the pictures (and their variants, see ``PictureVariant``), generated by a pool of
+``THUMBNAIL_WORKERS`` processes rather than in the upload request.
+
+Until its thumbnail is written, a picture is pending (and its original is displayed instead).
+The pictures that stay pending for more than ``THUMBNAIL_TIMEOUT`` (e.g., the web process was restarted) are handled
+by the bot.
+"""
+
+import collections
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import sqlalchemy
+from flask import current_app
+from PIL import Image
+
+from AM_Nihoul_website import db, pictures_set
+from AM_Nihoul_website.admin.utils import Thumbnailer, downscale, get_orientation, upright_size
+from AM_Nihoul_website.base_models import utcnow
+from AM_Nihoul_website.response_cache import response_cache
+from AM_Nihoul_website.visitor.models import Blob, Picture, PictureVariant
+
+logger = logging.getLogger(__name__)
+
+
+def save(image: Image, path: str, format_: str):
+    """Save ``image``, so that readers never see a partial file"""
+
+    if format_ == 'jpeg':
+        options = dict(quality=85, optimize=True, progressive=True)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+    else:
+        options = dict(quality=80, method=4)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+
+    path_tmp = '{}.tmp'.format(path)
+    image.save(path_tmp, format=format_, **options)
+    os.replace(path_tmp, path)
+
+
+def make_thumbnail(
+        path: str,
+        path_thumb: str,
+        width: int,
+        height: int,
+        directory: Optional[str] = None,
+        variants: Iterable[Tuple[int, str, str]] = ()
+) -> Tuple[Optional[datetime], List[Tuple[int, int, str, str]]]:
+    """Write the thumbnail of the picture at ``path``, as well as its variants (``(width, format, file_name)``,
+    in ``directory``) which are narrower than the picture.
+
+    Return the date it was taken (if found in its EXIF) and the variants that were written
+    (``(width, height, format, file_name)``). Runs in another process, so it only deals with plain values.
+    """
+
+    written = []
+
+    # the thumbnail is decoded at its own (low) scale
+    with Image.open(path) as image:
+        try:
+            date_taken = datetime.strptime(image.getexif()[306], '%Y:%m:%d %H:%M:%S')
+        except (KeyError, ValueError):
+            date_taken = None
+
+        save(Thumbnailer(width, height).transform(image), path_thumb, 'jpeg')
+
+    widths = collections.defaultdict(list)
+    for variant_width, format_, file_name in variants:
+        widths[variant_width].append((format_, file_name))
+
+    if len(widths) > 0:
+        with Image.open(path) as image:
+            orientation = get_orientation(image)
+            original_width, original_height = upright_size(image, orientation)
+
+            # from the largest to the smallest, each one being downscaled from the previous one (which is upright)
+            for variant_width in sorted(widths, reverse=True):
+                if variant_width >= original_width:
+                    continue
+
+                image = downscale(
+                    image, (variant_width, max(1, round(original_height * variant_width / original_width))),
+                    orientation)
+                orientation = 1
+
+                for format_, file_name in widths[variant_width]:
+                    path_variant = os.path.join(directory, file_name)
+                    os.makedirs(os.path.dirname(path_variant), exist_ok=True)
+                    save(image, path_variant, format_)
+                    written.append((image.width, image.height, format_, file_name))
+
+    return date_taken, written
+
+
+def get_variants(picture: Picture) -> List[Tuple[int, str, str]]:
+    """Variants (``(width, format, file_name)``) to generate for ``picture`` (only its id is used), following the
+    configuration"""
+
+    return [
+        (width, format_, PictureVariant.get_file_name(picture, width, format_))
+        for width in current_app.config['PICTURE_VARIANTS_WIDTHS']
+        for format_ in current_app.config['PICTURE_VARIANTS_FORMATS']
+    ]
+
+
+def get_settings() -> str:
+    """Settings of the thumbnail and variants: when they change, the pictures must be rebuilt"""
+
+    return json.dumps([
+        current_app.config['PICTURE_THUMB_SIZE'],
+        current_app.config['PICTURE_VARIANTS_WIDTHS'],
+        current_app.config['PICTURE_VARIANTS_FORMATS']
+    ])
+
+
+def make_process_pool(workers: Optional[int]) -> concurrent.futures.ProcessPoolExecutor:
+    # not forked: the web process has threads (and connections)
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def generate(picture: Picture):
+    """Generate the thumbnail (and variants) of ``picture`` in this process (the caller commits)"""
+
+    date_taken, written = make_thumbnail(
+        picture.path(),
+        picture.path_thumb(),
+        *current_app.config['PICTURE_THUMB_SIZE'],
+        str(current_app.config['UPLOADED_PICTURES_DEST']),
+        get_variants(picture))
+
+    picture.thumbnail_done(date_taken, written, get_settings())
+
+
+def generate_stale(before: datetime) -> int:
+    """Generate the thumbnails still pending since ``before`` (in UTC, see ``utcnow()``), and return how many were.
+
+    Each picture is committed (thus, the database is not locked while the next one is decoded). The pictures that
+    fail keep the error, and are not tried again.
+    """
+
+    pictures = Picture.query\
+        .filter(Picture.thumbnail_pending.is_(True))\
+        .filter(Picture.thumbnail_error.is_(None))\
+        .filter(Picture.date_modified < before)\
+        .all()
+
+    generated = 0
+    for picture in pictures:
+        try:
+            generate(picture)
+            generated += 1
+        except Exception as e:  # e.g., a broken file, or a decompression bomb
+            logger.error('thumbnails:: cannot generate the thumbnail of picture (id={}): {}'.format(picture.id, e))
+            db.session.rollback()
+            picture.thumbnail_error = '{}: {}'.format(type(e).__name__, e)[:1000]
+
+        db.session.add(picture)
+        db.session.commit()
+
+    return generated
+
+
+def rebuild_task(task: tuple) -> Tuple[int, Optional[datetime], List[Tuple[int, int, str, str]], Optional[str]]:
+    """Run by the processes of ``rebuild()``: ``task`` is the id of the picture followed by the arguments of
+    ``make_thumbnail()``. Return the id, what ``make_thumbnail()`` returned, and the error (if any).
+    """
+
+    picture_id, *args = task
+
+    try:
+        date_taken, written = make_thumbnail(*args)
+    except Exception as e:  # not only `OSError` (e.g., a decompression bomb), which must not stop the others
+        return picture_id, None, [], '{}: {}'.format(type(e).__name__, e)
+
+    return picture_id, date_taken, written, None
+
+
+def rebuild(
+        workers: Optional[int] = None,
+        force: bool = False,
+        chunk_size: int = 200
+) -> Iterator[Tuple[int, int, int]]:
+    """Regenerate the thumbnail and variants of the pictures which were not generated with the current settings
+    (or all of them, if ``force``) with a pool of ``workers`` processes (as many as cores, by default).
+
+    The pictures are handled by chunks, each of them being committed (with bulk statements), so that it can be
+    interrupted and run again. Yield the number of pictures that were rebuilt, that failed, and the total, after
+    each chunk.
+    """
+
+    settings = get_settings()
+    thumb_size = current_app.config['PICTURE_THUMB_SIZE']
+    directory = str(current_app.config['UPLOADED_PICTURES_DEST'])
+
+    query = Picture.query\
+        .outerjoin(Blob, Picture.blob_id == Blob.id)\
+        .with_entities(
+            Picture.id,
+            sqlalchemy.func.coalesce(Blob.file_name, Picture.picture_name).label('original_name'),
+            Picture.picture_thumb_name)
+    if not force:
+        query = query.filter(sqlalchemy.or_(
+            Picture.thumbnail_settings.is_(None),
+            Picture.thumbnail_settings != settings,
+            Picture.thumbnail_pending.is_(True)))
+
+    rows = query.order_by(Picture.id).all()
+    total, done, failed = len(rows), 0, 0
+
+    with make_process_pool(workers) as executor:
+        for i in range(0, total, chunk_size):
+            chunk = dict((row.id, row) for row in rows[i:i + chunk_size])
+            tasks = [(
+                row.id,
+                pictures_set.path(row.original_name),
+                pictures_set.path(row.picture_thumb_name),
+                *thumb_size,
+                directory,
+                get_variants(row)
+            ) for row in chunk.values()]
+
+            results = []
+            for picture_id, date_taken, written, error in executor.map(rebuild_task, tasks):
+                if error is not None:
+                    logger.error('thumbnails:: cannot rebuild picture (id={}): {}'.format(picture_id, error))
+                    failed += 1
+                else:
+                    results.append((picture_id, date_taken, written))
+
+            apply_rebuilt(chunk, results, settings, directory)
+            done += len(results)
+
+            yield done, failed, total
+
+
+def apply_rebuilt(
+        rows: Dict[int, sqlalchemy.Row],
+        results: List[Tuple[int, Optional[datetime], List[Tuple[int, int, str, str]]]],
+        settings: str,
+        directory: str
+):
+    """Update the rebuilt pictures (and replace their variants) with bulk statements, then commit"""
+
+    ids = [picture_id for picture_id, _, _ in results]
+    existing = set(db.session.scalars(sqlalchemy.select(Picture.id).where(Picture.id.in_(ids))))
+
+    # remove the files of the variants that were not written again (or of the pictures deleted meanwhile)
+    written_files = set(v[3] for picture_id, _, written in results if picture_id in existing for v in written)
+    previous_files = db.session.scalars(
+        sqlalchemy.select(PictureVariant.file_name).where(PictureVariant.picture_id.in_(ids)))
+
+    to_remove = [f for f in previous_files if f not in written_files]
+    for picture_id, _, written in results:
+        if picture_id not in existing:
+            to_remove.extend([rows[picture_id].picture_thumb_name] + [v[3] for v in written])
+
+    for file_name in to_remove:
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    # replace the variants and update the pictures
+    now = utcnow()  # as CURRENT_TIMESTAMP
+    variants, pictures, pictures_dated = [], [], []
+
+    for picture_id, date_taken, written in results:
+        if picture_id not in existing:
+            continue
+
+        row = rows[picture_id]
+        picture_size = os.path.getsize(pictures_set.path(row.original_name)) \
+            + os.path.getsize(pictures_set.path(row.picture_thumb_name))
+
+        for width, height, format_, file_name in written:
+            file_size = os.path.getsize(os.path.join(directory, file_name))
+            picture_size += file_size
+            variants.append(dict(
+                picture_id=picture_id, width=width, height=height, format=format_, file_name=file_name,
+                file_size=file_size, date_created=now, date_modified=now))
+
+        values = dict(
+            id=picture_id, picture_size=picture_size, thumbnail_pending=False, thumbnail_settings=settings,
+            thumbnail_error=None, date_modified=now)
+
+        if date_taken is not None:
+            pictures_dated.append(dict(values, date_taken=date_taken))
+        else:
+            pictures.append(values)
+
+    db.session.execute(sqlalchemy.delete(PictureVariant).where(PictureVariant.picture_id.in_(list(existing))))
+
+    if len(variants) > 0:
+        db.session.execute(sqlalchemy.insert(PictureVariant), variants)
+
+    for values in (pictures, pictures_dated):
+        if len(values) > 0:
+            db.session.execute(sqlalchemy.update(Picture), values)
+
+    db.session.commit()
+
+    # bulk statements are not seen by the cache
+    response_cache.purge([Picture.__tablename__, PictureVariant.__tablename__])
+
+
+class ThumbnailPool:
+    """Processes that generate the thumbnails, shared by the requests of the app.
+
+    Each task is followed by a thread, which updates the picture once its thumbnail is written.
+    """
+
+    EXTENSION_NAME = 'thumbnail_pool'
+
+    def __init__(self, app, workers: int):
+        self.app = app
+        self.workers = workers
+        self.size = app.config['PICTURE_THUMB_SIZE']
+        self.directory = str(app.config['UPLOADED_PICTURES_DEST'])
+
+        self.processes = make_process_pool(workers)
+        self.threads = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> 'ThumbnailPool':
+        pool = current_app.extensions.get(cls.EXTENSION_NAME)
+        if pool is None:
+            pool = current_app.extensions[cls.EXTENSION_NAME] = cls(
+                current_app._get_current_object(), current_app.config['THUMBNAIL_WORKERS'])
+
+        return pool
+
+    def submit(self, picture: Picture) -> concurrent.futures.Future:
+        """Generate the thumbnail of ``picture`` (which must be committed)"""
+
+        future = self.threads.submit(
+            self.run, picture.id, picture.path(), picture.path_thumb(), get_variants(picture), get_settings())
+
+        with self.lock:
+            self.futures.add(future)
+
+        future.add_done_callback(self.forget)
+        return future
+
+    def run(self, picture_id: int, path: str, path_thumb: str, variants: List[Tuple[int, str, str]], settings: str):
+        try:
+            date_taken, written = self.processes.submit(
+                make_thumbnail, path, path_thumb, *self.size, self.directory, variants).result()
+        except Exception as e:
+            # the original is still displayed, and the bot will try again
+            logger.error('thumbnails:: cannot generate the thumbnail of picture (id={}): {}'.format(picture_id, e))
+            return
+
+        with self.app.app_context():
+            picture = db.session.get(Picture, picture_id)
+            if picture is None:  # deleted in the meantime
+                for p in [path_thumb] + [os.path.join(self.directory, v[3]) for v in written]:
+                    if os.path.exists(p):
+                        os.remove(p)
+                return
+
+            picture.thumbnail_done(date_taken, written, settings)
+            db.session.add(picture)
+            db.session.commit()
+
+    def forget(self, future: concurrent.futures.Future):
+        with self.lock:
+            self.futures.discard(future)
+
+    def wait(self) -> List[concurrent.futures.Future]:
+        """Wait for the thumbnails that are being generated"""
+
+        with self.lock:
+            futures = list(self.futures)
+
+        concurrent.futures.wait(futures)
+        return futures
+
+    def shutdown(self):
+        self.threads.shutdown(wait=True)
+        self.processes.shutdown(wait=True)
+
+
+def submit(picture: Picture):
+    """Generate the thumbnail of ``picture`` (which must be committed) in the background, or right now if
+    ``THUMBNAIL_WORKERS`` is 0 (then, the picture is committed again)"""
+
+    if current_app.config['THUMBNAIL_WORKERS'] > 0:
+        ThumbnailPool.get().submit(picture)
+    else:
+        generate(picture)
+        db.session.add(picture)
+        db.session.commit()
@@ -0,0 +1,398 @@
+"""
+Uploads which are written to disk as they come, then moved (not copied) to their upload set:
+
++ files sent by chunks (see the ``chunking`` option of Dropzone). The chunks are written at their place in
+  ``DATA_DIRECTORY/chunks/<uuid>.part`` (a chunk which is sent again, e.g., after a dropped connection, is simply
+  rewritten). The uploads which are not completed after ``CHUNKED_UPLOAD_TIMEOUT`` are removed by the bot.
++ images sent as a ``data:`` URI (pasted in the editor), which are decoded by pieces in the same directory, then
+  downscaled and converted if needed (see ``shrink_image()``).
+
+Once received, the files are stored by content, as ``<upload set>/blobs/<xx>/<sha256>.<ext>`` (see
+``visitor.models.Blob``): the same file, uploaded many times, is only stored once.
+"""
+
+import binascii
+import collections
+import hashlib
+import os
+import pathlib
+import re
+import shutil
+import time
+import uuid as uuid_
+from datetime import datetime
+from typing import BinaryIO, Iterable, Iterator, Mapping, Optional, Union
+from urllib.parse import unquote_to_bytes
+
+from flask import current_app
+from flask_uploads import UploadNotAllowed, UploadSet, extension, lowercase_ext
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+from AM_Nihoul_website.admin.utils import downscale, get_orientation, upright_size
+
+CHUNKS_DIRECTORY = 'chunks'
+BLOBS_DIRECTORY = 'blobs'
+UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+COPY_BUFFER = 64 * 1024
+MAX_DATA_URI_HEADER = 256
+
+CompletedUpload = collections.namedtuple('CompletedUpload', ['filename', 'path'])
+
+
+class ChunkError(Exception):
+    pass
+
+
+class DataURIError(Exception):
+    pass
+
+
+def is_chunk(form: Mapping[str, str]) -> bool:
+    return 'dzuuid' in form and 'dzchunkindex' in form
+
+
+def get_chunks_directory() -> pathlib.Path:
+    directory = pathlib.Path(current_app.config['DATA_DIRECTORY']) / CHUNKS_DIRECTORY
+    directory.mkdir(exist_ok=True)
+    return directory
+
+
+def receive_chunk(data: FileStorage, form: Mapping[str, str], upload_set: UploadSet) -> Optional[CompletedUpload]:
+    """Write the chunk ``data``, described by the Dropzone fields of ``form``, for a file of ``upload_set``.
+
+    Return the upload once all its chunks were received (only once, even if the last ones are received at the
+    same time).
+    """
+
+    try:
+        uuid = form['dzuuid']
+        index = int(form['dzchunkindex'])
+        count = int(form['dztotalchunkcount'])
+        offset = int(form['dzchunkbyteoffset'])
+        total_size = int(form['dztotalfilesize'])
+    except (KeyError, ValueError):
+        raise ChunkError('Morceau de fichier invalide')
+
+    if not UUID_RE.match(uuid) or not 0 <= index < count or not 0 <= offset <= total_size:
+        raise ChunkError('Morceau de fichier invalide')
+
+    if total_size > current_app.config['CHUNKED_UPLOAD_MAX_SIZE']:
+        raise ChunkError('Fichier trop grand')
+
+    # there is no need to receive the whole file to know that it will not be accepted
+    if not upload_set.extension_allowed(extension(data.filename)):
+        raise UploadNotAllowed()
+
+    directory = get_chunks_directory()
+    path = directory / '{}.part'.format(uuid)
+    path_index = directory / '{}.chunks'.format(uuid)
+
+    # stream the chunk at its place (the other chunks may be written at the same time), but not past the end
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'r+b') as f:
+        f.seek(offset)
+        fits = copy_at_most(data.stream, f, total_size - offset)
+
+    if not fits:
+        discard_chunks(uuid)
+        raise ChunkError('Morceau de fichier trop grand')
+
+    # ... then record it (appending a line is atomic)
+    with path_index.open('a') as f:
+        f.write('{}\n'.format(index))
+
+    with path_index.open() as f:
+        received = set(int(line) for line in f if line.strip())
+
+    if len(received) < count:
+        return
+
+    if path.stat().st_size != total_size:
+        discard_chunks(uuid)
+        raise ChunkError('Fichier incomplet')
+
+    # the first one to complete the file takes it
+    path_done = directory / '{}.done'.format(uuid)
+    try:
+        os.rename(path, path_done)
+    except FileNotFoundError:
+        return
+
+    path_index.unlink(missing_ok=True)
+    return CompletedUpload(data.filename, str(path_done))
+
+
+def copy_at_most(source: BinaryIO, destination: BinaryIO, size: int) -> bool:
+    """Copy ``source`` to ``destination``, unless it is larger than ``size`` (then, stop there and return ``False``)"""
+
+    while True:
+        block = source.read(min(COPY_BUFFER, size + 1))
+        if not block:
+            return True
+
+        if len(block) > size:
+            return False
+
+        destination.write(block)
+        size -= len(block)
+
+
+def discard_chunks(uuid: str):
+    """Remove what was received of the upload ``uuid``"""
+
+    directory = get_chunks_directory()
+    for suffix in ('part', 'chunks'):
+        (directory / '{}.{}'.format(uuid, suffix)).unlink(missing_ok=True)
+
+
+def get_name(upload_set: UploadSet, name: str) -> str:
+    """Name of a file of ``upload_set``, checked as ``UploadSet.save()`` would (raise ``UploadNotAllowed``)"""
+
+    basename = lowercase_ext(secure_filename(name))
+    if not basename or not upload_set.extension_allowed(extension(basename)):
+        raise UploadNotAllowed()
+
+    return basename
+
+
+def receive(data: Union[FileStorage, CompletedUpload]) -> CompletedUpload:
+    """Write ``data`` in the directory of the chunks, unless it is already there"""
+
+    if isinstance(data, CompletedUpload):
+        return data
+
+    path = get_chunks_directory() / '{}.part'.format(uuid_.uuid4())
+    with path.open('wb') as f:
+        shutil.copyfileobj(data.stream, f, COPY_BUFFER)
+
+    return CompletedUpload(data.filename, str(path))
+
+
+def get_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BUFFER), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def get_blob_name(digest: str, ext: str) -> str:
+    """Name (in its upload set) of the file of content ``digest``"""
+
+    return '{}/{}/{}.{}'.format(BLOBS_DIRECTORY, digest[:2], digest, ext)
+
+
+def move_to_blobs(upload_set: UploadSet, path: str, name: str) -> None:
+    """Move the file at ``path`` to the blobs of ``upload_set``, as ``name`` (see ``get_blob_name()``)"""
+
+    destination = upload_set.path(name)
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    os.replace(path, destination)
+
+
+def link(source: str, destination: str) -> None:
+    """Make ``destination`` a hard link to ``source`` (or a symbolic one, if not possible), replacing it at once"""
+
+    temporary = '{}.{}.part'.format(destination, uuid_.uuid4())
+    try:
+        os.link(source, temporary)
+    except OSError:
+        os.symlink(os.path.relpath(source, os.path.dirname(destination)), temporary)
+
+    os.replace(temporary, destination)
+
+
+def link_to_chunks(path: str) -> str:
+    """Link (or copy) the file at ``path`` in the directory of the chunks, so that it can be stored by content while
+    remaining at ``path``
+    """
+
+    chunk = str(get_chunks_directory() / '{}.part'.format(uuid_.uuid4()))
+    try:
+        os.link(path, chunk)
+    except OSError:
+        shutil.copyfile(path, chunk)
+
+    return chunk
+
+
+def remove_stale(before: datetime) -> int:
+    """Remove the chunks of the uploads which were not modified since ``before``, and return their number"""
+
+    directory = pathlib.Path(current_app.config['DATA_DIRECTORY']) / CHUNKS_DIRECTORY
+    if not directory.exists():
+        return 0
+
+    limit = time.mktime(before.timetuple())
+    uploads = set()
+
+    for path in directory.iterdir():
+        try:
+            if path.stat().st_mtime < limit:
+                path.unlink()
+                uploads.add(path.stem)
+        except FileNotFoundError:  # completed meanwhile
+            continue
+
+    return len(uploads)
+
+
+def iter_urlencoded_field(stream: BinaryIO, name: str, block_size: int = COPY_BUFFER) -> Iterator[str]:
+    """Yield the value of the field ``name`` of an urlencoded body, by (decoded) pieces, as it is read from
+    ``stream``. Yield nothing if there is no such field.
+    """
+
+    key, in_value, matching, rest = b'', False, False, b''
+
+    while True:
+        block = stream.read(block_size)
+        data, rest = rest + block, b''
+
+        while len(data) > 0:
+            if not in_value:
+                pos = min((p for p in (data.find(b'='), data.find(b'&')) if p >= 0), default=-1)
+                if pos < 0:
+                    key += data
+                    break
+
+                key += data[:pos]
+                if data[pos:pos + 1] == b'=':
+                    in_value, matching = True, unquote_to_bytes(key.replace(b'+', b' ')) == name.encode()
+
+                key, data = b'', data[pos + 1:]
+            else:
+                pos = data.find(b'&')
+                value = data if pos < 0 else data[:pos]
+
+                if pos < 0 and len(block) > 0:  # an escape sequence (``%XX``) may be cut
+                    cut = value.rfind(b'%', -2)
+                    if cut >= 0:
+                        value, rest = value[:cut], value[cut:]
+
+                if matching:
+                    yield unquote_to_bytes(value.replace(b'+', b' ')).decode('ascii', errors='replace')
+
+                if pos < 0:
+                    break
+
+                if matching:
+                    return
+
+                in_value, data = False, data[pos + 1:]
+
+        if len(block) == 0:
+            return
+
+
+def receive_data_uri(pieces: Iterable[str], filename: str) -> CompletedUpload:
+    """Decode the base64 ``data:`` URI of an image, given by pieces, into a file, as it comes.
+
+    The name of the upload is ``filename`` followed by an extension that depends on the mimetype.
+    """
+
+    header, path, f = '', None, None
+    rest = ''
+
+    try:
+        for piece in pieces:
+            if f is None:  # still in the header
+                header += piece
+                pos = header.find(',')
+                if pos < 0:
+                    if len(header) > MAX_DATA_URI_HEADER:
+                        raise DataURIError('no data information')
+                    continue
+
+                header, piece = header[:pos], header[pos + 1:]
+
+                if header[0:5] != 'data:':
+                    raise DataURIError('no data information')
+
+                info = header[5:].split(';')
+                if len(info) < 2 or info[1] != 'base64':
+                    raise DataURIError('not base64')
+                if 'image/' not in info[0]:
+                    raise DataURIError('mime does not starts with `image/')
+
+                mime = info[0]
+                filename = '{}.{}'.format(filename, mime[mime.find('/') + 1:])
+
+                path = get_chunks_directory() / '{}.part'.format(uuid_.uuid4())
+                f = path.open('wb')
+
+            # decode by groups of 4 characters
+            piece = rest + ''.join(piece.split())
+            n = len(piece) - len(piece) % 4
+            f.write(binascii.a2b_base64(piece[:n]))
+            rest = piece[n:]
+
+        if f is None:
+            raise DataURIError('no data information' if header else 'missing `image` field')
+
+        if rest:
+            raise DataURIError('incorrect padding')
+
+    except binascii.Error as e:
+        error = DataURIError(str(e))
+    except DataURIError as e:
+        error = e
+    else:
+        error = None
+    finally:
+        if f is not None:
+            f.close()
+
+    if error is not None:
+        if path is not None:
+            os.remove(path)
+        raise error
+
+    return CompletedUpload(filename, str(path))
+
+
+def shrink_image(upload: CompletedUpload, max_size: int, max_dimension: Optional[int]) -> CompletedUpload:
+    """Downscale the image of ``upload`` if it is larger than ``max_dimension`` (in pixels), and convert it to JPEG
+    if its file is larger than ``max_size`` (in bytes). The image is decoded from its file, at the lowest possible
+    scale.
+    """
+
+    too_large = os.path.getsize(upload.path) > max_size
+
+    try:
+        with Image.open(upload.path) as image:
+            orientation = get_orientation(image)
+            size = upright_size(image, orientation)
+            too_wide = max_dimension is not None and max(size) > max_dimension
+
+            if not too_large and not too_wide:
+                return upload
+
+            image_format = 'jpeg' if too_large else image.format
+
+            if too_wide:
+                ratio = max_dimension / max(size)
+                image = downscale(
+                    image, (max(1, round(size[0] * ratio)), max(1, round(size[1] * ratio))), orientation)
+
+            if image_format == 'jpeg':
+                image = image.convert('RGB')  # strip transparency
+
+            path = '{}.{}'.format(os.path.splitext(upload.path)[0], 'shrunk')
+            image.save(path, format=image_format)
+    except (OSError, Image.DecompressionBombError):
+        if not too_large:  # kept as is
+            return upload
+
+        os.remove(upload.path)
+        raise DataURIError('invalid file')
+
+    os.remove(upload.path)
+
+    filename = upload.filename
+    if image_format == 'jpeg':
+        filename = '{}.jpg'.format(os.path.splitext(filename)[0])
+
+    return CompletedUpload(filename, path)
@@ -4,13 +4,16 @@ import secrets
 import slugify
 import datetime
 
-from typing import List, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import sqlalchemy.orm
+from flask_uploads import UploadSet, extension
+from markupsafe import escape
 from sqlalchemy import event
+from sqlalchemy.dialects import sqlite
 from sqlalchemy_utils.types.choice import ChoiceType
 
-from AM_Nihoul_website import db, uploads_set, pictures_set
+from AM_Nihoul_website import db, uploads, uploads_set, pictures_set
 from AM_Nihoul_website.base_models import BaseModel
 from AM_Nihoul_website.visitor.utils import make_summary
 
@@ -105,9 +108,21 @@ class TextMixin:
     slug = db.Column(db.VARCHAR(150), nullable=False)
     summary = db.Column(db.Text, default='', nullable=False)
 
+    # `content` with the summary, computed when `content` is set (see `receive_text_content_set()`)
+    summarized_content = db.Column(db.Text)
+
     def content_with_summary(self, link_page: str = ''):
+        if link_page == '' and self.summarized_content is not None:
+            return self.summarized_content
+
         return make_summary(self.content, link_page)
 
+    def update_summarized_content(self, content: str = None):
+        if content is None:
+            content = self.content
+
+        self.summarized_content = make_summary(content) if content is not None else None
+
 
 class Page(TextMixin, BaseModel):
     """Page
@@ -142,6 +157,104 @@ def receive_page_title_set(target, value, oldvalue, initiator):
     target.slug = slugify.slugify(value)
 
 
+class Blob(BaseModel):
+    """File of an upload set, named after its content, and shared by the objects which have the same content
+    (see ``uploads.py``). It is removed with the last of them.
+    """
+
+    __table_args__ = (
+        db.UniqueConstraint('upload_set', 'digest', name='uq_blob_upload_set_digest'),
+    )
+
+    upload_set = db.Column(db.VARCHAR(length=20), nullable=False)
+    digest = db.Column(db.VARCHAR(length=64), nullable=False)  # sha256
+    file_name = db.Column(db.VARCHAR(length=150), nullable=False)  # in the upload set
+    file_size = db.Column(db.Integer)
+    refcount = db.Column(db.Integer, default=0, nullable=False)
+
+    UPLOAD_SETS = {s.name: s for s in (uploads_set, pictures_set)}
+
+    @classmethod
+    def store(cls, upload_set: UploadSet, upload: uploads.CompletedUpload, name: str) -> 'Blob':
+        """Store the file of ``upload`` (which is moved or removed) and count one more reference to it.
+        ``name`` gives the extension of the file, if it is not stored yet.
+
+        The row is inserted or incremented at once (thus, the same content uploaded at the same time is only counted
+        twice), and the database is then locked until the end of the transaction, so that the blob cannot be released
+        meanwhile.
+        """
+
+        digest = uploads.get_digest(upload.path)
+        file_name = uploads.get_blob_name(digest, extension(name))
+
+        statement = sqlite.insert(cls).values(
+            upload_set=upload_set.name,
+            digest=digest,
+            file_name=file_name,
+            file_size=os.path.getsize(upload.path),
+            refcount=1
+        )
+
+        id_, refcount = db.session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.upload_set, cls.digest],
+                set_={'refcount': cls.refcount + 1, 'date_modified': db.func.current_timestamp()})
+            .returning(cls.id, cls.refcount)).one()
+
+        blob = db.session.get(cls, id_, populate_existing=True)
+        if refcount == 1:
+            uploads.move_to_blobs(upload_set, upload.path, blob.file_name)
+        else:  # already stored
+            os.remove(upload.path)
+
+        return blob
+
+    @classmethod
+    def release(cls, connection: sqlalchemy.engine.Connection, id_: int):
+        """One reference less (during a flush, thus with ``connection``): the file is removed with the last one"""
+
+        table = cls.__table__
+        connection.execute(table.update().where(table.c.id == id_).values(refcount=table.c.refcount - 1))
+
+        row = connection.execute(
+            sqlalchemy.select(table.c.upload_set, table.c.file_name).where(table.c.id == id_, table.c.refcount <= 0))\
+            .first()
+
+        if row is not None:
+            connection.execute(table.delete().where(table.c.id == id_))
+
+            path = cls.UPLOAD_SETS[row.upload_set].path(row.file_name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def release_previous(cls, connection: sqlalchemy.engine.Connection, id_: int, column: sqlalchemy.Column, name: str):
+        """Remove ``name``, the previous path of a file stored before the blob store (see ``flask deduplicate``), if
+        it is a link to the blob ``id_`` which no longer belongs to any object (during a flush, with ``connection``)
+        """
+
+        table = cls.__table__
+        row = connection.execute(sqlalchemy.select(table.c.upload_set, table.c.file_name).where(table.c.id == id_))\
+            .first()
+
+        if row is None:
+            return
+
+        upload_set = cls.UPLOAD_SETS[row.upload_set]
+        path, previous = upload_set.path(row.file_name), upload_set.path(name)
+        if not os.path.exists(path) or not os.path.exists(previous) or not os.path.samefile(path, previous):
+            return
+
+        if connection.execute(sqlalchemy.select(column).where(column == name)).first() is None:
+            os.remove(previous)
+
+    def path(self):
+        return self.UPLOAD_SETS[self.upload_set].path(self.file_name)
+
+    def url(self):
+        return self.UPLOAD_SETS[self.upload_set].url(self.file_name)
+
+
 class UploadedFile(BaseModel):
     base_file_name = db.Column(db.VARCHAR(length=150), nullable=False)
     file_name = db.Column(db.VARCHAR(length=150), nullable=False)
@@ -149,6 +262,11 @@ class UploadedFile(BaseModel):
     possible_mime = db.Column(db.VARCHAR(length=150), nullable=False)
     description = db.Column(db.Text())
 
+    # `file_name` only names the file, which is stored by content (unless it was uploaded before, then `blob` is
+    # `None` and the file is `file_name`)
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id', name='fk_uploaded_file_blob_id'))
+    blob = db.relationship('Blob', uselist=False)
+
     @staticmethod
     def get_mimetype(path):
         """Get the mimetype of a file, using either libmagic or the mimetypes module when libmagic is not available."""
@@ -173,15 +291,37 @@ class UploadedFile(BaseModel):
     def create(cls, uploaded, filename, description=None):
         o = cls()
         o.base_file_name = uploaded.filename
-        o.file_name = uploads_set.save(uploaded, name=filename)
-        o.file_size = os.path.getsize(o.path())
+        o.file_name = cls.get_unique_name(uploads.get_name(uploads_set, filename))
+        o.blob = Blob.store(uploads_set, uploads.receive(uploaded), o.file_name)
+        o.file_size = o.blob.file_size
         o.possible_mime = UploadedFile.get_mimetype(o.path())
         o.description = description
 
         return o
 
+    @classmethod
+    def get_unique_name(cls, name: str) -> str:
+        """Suffix ``name`` (as ``UploadSet.resolve_conflict()`` does) until no other file has it, since it is also
+        used as the ``cid`` of the images in the emails"""
+
+        stem, ext = os.path.splitext(name)
+        count = 0
+        while db.session.query(cls.query.filter(cls.file_name == name).exists()).scalar():
+            count += 1
+            name = '{}_{}{}'.format(stem, count, ext)
+
+        return name
+
     def path(self):
-        return uploads_set.path(self.file_name)
+        if self.blob is None:
+            return uploads_set.path(self.file_name)
+
+        return self.blob.path()
+
+    def path_in_set(self) -> str:
+        """Path of the file, relative to the upload set"""
+
+        return self.file_name if self.blob is None else self.blob.file_name
 
     def get_fa_icon(self):
         icons = {
@@ -211,16 +351,23 @@ class UploadedFile(BaseModel):
         return icons[self.possible_mime] if self.possible_mime in icons else 'fas fa-file'
 
 
-@event.listens_for(UploadedFile, 'before_delete')
-def before_delete_uploaded_file(mapper, connect, target):
-    """Remove file before deletion from BDD"""
-    if os.path.exists(target.path()):
+@event.listens_for(UploadedFile, 'after_delete')
+def after_delete_uploaded_file(mapper, connect, target):
+    """Release the file after deletion from BDD (or remove it, if it is not shared)"""
+    if target.blob_id is not None:
+        Blob.release_previous(connect, target.blob_id, UploadedFile.file_name, target.file_name)
+        Blob.release(connect, target.blob_id)
+    elif os.path.exists(target.path()):
         os.remove(target.path())
 
 
 class NewsletterRecipient(BaseModel):
     """Recipient of the newsletter"""
 
+    __table_args__ = (
+        db.Index('ix_newsletter_recipient_confirmed_date_created', 'confirmed', 'date_created'),
+    )
+
     name = db.Column(db.VARCHAR(length=150), nullable=False)
     email = db.Column(db.Text(), nullable=False)
     hash = db.Column(db.VARCHAR(length=150), nullable=False)
@@ -236,6 +383,26 @@ class NewsletterRecipient(BaseModel):
 
         return o
 
+    @classmethod
+    def remove_unconfirmed(cls, before: datetime.datetime) -> Tuple[int, int]:
+        """Delete the recipients that did not confirm their inscription, created before ``before``, along with their
+        unsent emails. Returns the number of recipients and emails. The caller commits.
+        """
+
+        recipients = sqlalchemy.select(cls.id).where(cls.confirmed.is_(False)).where(cls.date_created <= before)
+        emails = sqlalchemy.select(Email.id).where(Email.sent.is_(False)).where(Email.recipient_id.in_(recipients))
+
+        db.session.execute(
+            sqlalchemy.delete(EmailImageAttachment).where(EmailImageAttachment.email_id.in_(emails)))
+
+        num_emails = db.session.execute(
+            sqlalchemy.delete(Email).where(Email.sent.is_(False)).where(Email.recipient_id.in_(recipients))).rowcount
+
+        num_recipients = db.session.execute(
+            sqlalchemy.delete(cls).where(cls.confirmed.is_(False)).where(cls.date_created <= before)).rowcount
+
+        return num_recipients, num_emails
+
     def get_scrambled_email(self):
         n = len(self.name) % 3
         s = self.email.split('@')
@@ -270,33 +437,223 @@ def receive_newsletter_title_set(target, value, oldvalue, initiator):
         target.slug = slugify.slugify(value)
 
 
-class Email(BaseModel):
+class EmailCampaign(BaseModel):
+    """Content shared by many emails (e.g., a newsletter), with placeholders for what depends on the recipient
+    (see ``VARIABLES``)"""
+
+    VARIABLES = ('recipient_name', 'unsubscribe_link')
+
     title = db.Column(db.VARCHAR(length=150), nullable=False)
     content = db.Column(db.Text(), nullable=False)
+
+    newsletter_id = db.Column(db.Integer, db.ForeignKey('newsletter.id'))
+    newsletter = db.relationship('Newsletter')
+
+    @classmethod
+    def create(cls, title, content, newsletter_id=None):
+        o = cls()
+        o.title = title
+        o.content = content
+        o.newsletter_id = newsletter_id
+
+        return o
+
+    @staticmethod
+    def placeholder(variable: str) -> str:
+        return '%%{}%%'.format(variable.upper())
+
+    @classmethod
+    def placeholders(cls) -> Dict[str, str]:
+        """To render the content"""
+
+        return dict((v, cls.placeholder(v)) for v in cls.VARIABLES)
+
+    def fill(self, variables: Dict[str, str]) -> str:
+        """Replace the placeholders of the content by the (escaped) value of ``variables``"""
+
+        content = self.content
+        for variable in self.VARIABLES:
+            content = content.replace(self.placeholder(variable), str(escape(variables.get(variable, ''))))
+
+        return content
+
+
+class Email(BaseModel):
+    """Either has its own ``content``, or is part of a ``campaign`` (and has ``variables`` to fill it).
+
+    The unsent emails are indexed, as long as they are selected with ``Email.sent.is_(False)``.
+    To be sent, they are first claimed for a while (see ``claim()``), so that they are only sent once, even with
+    many bots. When sending fails, they are retried later (see ``record_failure()``), until they are ``failed``.
+    """
+
+    __table_args__ = (
+        db.Index('ix_email_unsent', 'id', sqlite_where=db.text('sent IS 0')),
+    )
+
+    title = db.Column(db.VARCHAR(length=150), nullable=False)
+    content = db.Column(db.Text())
     sent = db.Column(db.Boolean(), default=False, nullable=False)
 
     recipient_id = db.Column(db.Integer, db.ForeignKey('newsletter_recipient.id'))
     recipient = db.relationship('NewsletterRecipient')
 
+    campaign_id = db.Column(db.Integer, db.ForeignKey('email_campaign.id'))
+    campaign = db.relationship('EmailCampaign')
+    variables = db.Column(db.JSON())
+
+    lease_token = db.Column(db.VARCHAR(length=32))
+    lease_until = db.Column(db.DateTime)
+
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt = db.Column(db.DateTime)
+    failed = db.Column(db.Boolean(), default=False, nullable=False)
+    last_error = db.Column(db.Text())
+
     @classmethod
-    def create(cls, title, content, recipient_id):
+    def create(cls, title, content, recipient_id, campaign_id=None, variables=None):
         o = cls()
         o.title = title
         o.content = content
         o.recipient_id = recipient_id
+        o.campaign_id = campaign_id
+        o.variables = variables
 
         return o
 
+    def get_content(self) -> str:
+        if self.campaign_id is not None:
+            return self.campaign.fill(self.variables or {})
+
+        return self.content
+
     def query_attachments(self) -> sqlalchemy.orm.Query:
         return EmailImageAttachment.query.filter(EmailImageAttachment.email_id.is_(self.id))
 
     def attachments(self) -> List['EmailImageAttachment']:
         return self.query_attachments().all()
 
+    @classmethod
+    def sendable(cls, now: datetime.datetime) -> sqlalchemy.ColumnElement:
+        """Condition on the emails which can be sent at ``now``: unsent, not failed, not postponed, and that nobody
+        claimed (or whose claim expired)
+        """
+
+        return db.and_(
+            cls.sent.is_(False),
+            cls.failed.is_(False),
+            db.or_(cls.lease_until.is_(None), cls.lease_until < now),
+            db.or_(cls.next_attempt.is_(None), cls.next_attempt <= now))
+
+    @classmethod
+    def claim(cls, n: int, duration: datetime.timedelta) -> Optional[str]:
+        """Claim the (at most) ``n`` oldest emails which can be sent (see ``sendable()``) for ``duration``, and
+        commit. Returns the token to get them (see ``claimed()``), or ``None`` if there is none.
+        """
+
+        now = datetime.datetime.now()
+        token = secrets.token_hex(16)
+
+        available = sqlalchemy.select(cls.id)\
+            .where(cls.sendable(now))\
+            .order_by(cls.id)\
+            .limit(n)
+
+        # a single statement, so that SQLite prevents two claims of the same email
+        result = db.session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.id.in_(available))
+            .values(lease_token=token, lease_until=now + duration)
+            .execution_options(synchronize_session=False))
+
+        db.session.commit()
+
+        return token if result.rowcount > 0 else None
+
+    @classmethod
+    def claimed(cls, token: str) -> sqlalchemy.orm.Query:
+        return cls.query.filter(cls.sent.is_(False)).filter(cls.lease_token == token).order_by(cls.id)
+
+    @classmethod
+    def release(cls, token: str):
+        """Release the emails of ``token`` which are not sent, and commit"""
+
+        db.session.execute(
+            sqlalchemy.update(cls)
+            .where(cls.sent.is_(False))
+            .where(cls.lease_token == token)
+            .values(lease_token=None, lease_until=None)
+            .execution_options(synchronize_session=False))
+
+        db.session.commit()
+
+    def mark_sent(self):
+        self.sent = True
+        self.lease_token = None
+        self.lease_until = None
+
+    def record_failure(self, error: Exception, max_attempts: int, delay: datetime.timedelta):
+        """Retry after ``delay``, doubled after each attempt, unless there was already ``max_attempts``"""
+
+        self.attempts += 1
+        self.last_error = '{}: {}'.format(type(error).__name__, error)[:1000]
+        self.lease_token = None
+        self.lease_until = None
+
+        if self.attempts >= max_attempts:
+            self.failed = True
+            self.next_attempt = None
+        else:
+            self.next_attempt = datetime.datetime.now() + delay * 2 ** (self.attempts - 1)
+
+    def postpone(self, error: Exception, delay: datetime.timedelta):
+        """Retry after ``delay``, without counting an attempt (e.g., when throttled, which is not its fault)"""
+
+        self.last_error = '{}: {}'.format(type(error).__name__, error)[:1000]
+        self.lease_token = None
+        self.lease_until = None
+        self.next_attempt = datetime.datetime.now() + delay
+
+    def retry(self):
+        """Try again (e.g., after it ``failed``)"""
+
+        self.failed = False
+        self.attempts = 0
+        self.next_attempt = None
+
+    @classmethod
+    def archive(cls, before: datetime.datetime, delete: bool = False) -> int:
+        """Move the emails sent before ``before`` to ``EmailArchive`` (or just ``delete`` them),
+        and return their number. The caller commits.
+        """
+
+        condition = db.and_(cls.sent.is_(True), cls.date_modified <= before)
+        emails = sqlalchemy.select(cls.id).where(condition)
+
+        if not delete:
+            columns = ['title', 'content', 'recipient_id', 'campaign_id', 'variables', 'date_created', 'date_modified']
+            db.session.execute(
+                sqlalchemy.insert(EmailArchive).from_select(
+                    columns, sqlalchemy.select(*(getattr(cls, c) for c in columns)).where(condition)))
+
+        db.session.execute(
+            sqlalchemy.delete(EmailImageAttachment).where(EmailImageAttachment.email_id.in_(emails)))
+
+        return db.session.execute(sqlalchemy.delete(cls).where(condition)).rowcount
+
+
+class EmailArchive(BaseModel):
+    """Email sent a while ago, moved out of the ``email`` table (see ``Email.archive()``)"""
+
+    title = db.Column(db.VARCHAR(length=150), nullable=False)
+    content = db.Column(db.Text())
+    recipient_id = db.Column(db.Integer)
+    campaign_id = db.Column(db.Integer)
+    variables = db.Column(db.JSON())
+
 
 class EmailImageAttachment(BaseModel):
     email_id = db.Column(db.Integer, db.ForeignKey('email.id'))
-    email = db.relationship('Email', uselist=False)
+    email = db.relationship('Email', uselist=False, backref=db.backref('image_attachments', cascade='all,delete'))
     image_id = db.Column(db.Integer, db.ForeignKey('uploaded_file.id'))
     image = db.relationship('UploadedFile', uselist=False)
 
@@ -343,11 +700,22 @@ class MenuEntry(OrderableMixin, BaseModel):
 
 
 class Picture(BaseModel):
+    __table_args__ = (
+        db.Index('ix_picture_album_id_date_taken', 'album_id', 'date_taken'),
+    )
+
     date_taken = db.Column(db.DateTime, default=db.func.current_timestamp())
 
     picture_name = db.Column(db.VARCHAR(length=150), nullable=False)
     picture_thumb_name = db.Column(db.VARCHAR(length=150), nullable=False)
     picture_size = db.Column(db.Integer)
+    thumbnail_pending = db.Column(db.Boolean, default=False, nullable=False)  # generated out of the request
+    thumbnail_settings = db.Column(db.Text)  # the thumbnail and variants were generated with them
+    thumbnail_error = db.Column(db.Text)  # then, the bot does not try again (`flask pictures rebuild` does)
+
+    # the original is stored by content (see `UploadedFile`)
+    blob_id = db.Column(db.Integer, db.ForeignKey('blob.id', name='fk_picture_blob_id'))
+    blob = db.relationship('Blob', uselist=False)
 
     album_id = db.Column(db.Integer, db.ForeignKey('album.id'))
     album = db.relationship(
@@ -359,11 +727,15 @@ class Picture(BaseModel):
             filename: str,
             filename_thumb: str,
             album: Union['Album', int],
-            date_taken: Union[int, datetime.datetime]
+            date_taken: Union[int, datetime.datetime],
+            thumbnail_pending: bool = False,
+            blob: Optional[Blob] = None
     ):
         o = cls()
         o.picture_name = filename
+        o.blob = blob
         o.picture_thumb_name = filename_thumb
+        o.thumbnail_pending = thumbnail_pending
         o.picture_size = os.path.getsize(o.path()) + os.path.getsize(o.path_thumb())
 
         if type(album) is Album:
@@ -376,30 +748,146 @@ class Picture(BaseModel):
         return o
 
     def path(self):
-        return pictures_set.path(self.picture_name)
+        if self.blob is None:
+            return pictures_set.path(self.picture_name)
+
+        return self.blob.path()
 
     def path_thumb(self):
         return pictures_set.path(self.picture_thumb_name)
 
+    def version(self) -> str:
+        """Changes when the files are rewritten, so that the URLs can be cached forever"""
+
+        return '{}-{}'.format(self.id, int(self.date_modified.timestamp()) if self.date_modified else 0)
+
     def url(self):
-        return pictures_set.url(self.picture_name)
+        if self.blob is None:
+            return '{}?v={}'.format(pictures_set.url(self.picture_name), self.version())
+
+        return self.blob.url()  # named after its content, thus never changes
 
     def url_thumb(self):
-        return pictures_set.url(self.picture_thumb_name)
+        if self.thumbnail_pending:  # the original will do, in the meantime
+            return self.url()
 
+        return '{}?v={}'.format(pictures_set.url(self.picture_thumb_name), self.version())
 
-@event.listens_for(Picture, 'before_delete')
-def before_delete_picture(mapper, connect, target):
-    """Remove file before deletion from BDD"""
-    pic = pictures_set.path(target.picture_name)
-    if os.path.exists(pic):
-        os.remove(pic)
+    def get_variants(self, format_: str = 'jpeg') -> List['PictureVariant']:
+        """Variants in a given format, from the smallest to the largest"""
+
+        return sorted((v for v in self.variants if v.format == format_), key=lambda v: v.width)
+
+    def srcset(self, format_: str = 'jpeg') -> str:
+        """Value of the ``srcset`` attribute (empty if there is no variant, then the original is used)"""
+
+        return ', '.join('{} {}w'.format(v.url(), v.width) for v in self.get_variants(format_))
+
+    def url_largest(self, format_: str = 'jpeg') -> str:
+        """URL of the largest variant, or of the original if there is none"""
+
+        variants = self.get_variants(format_)
+        return variants[-1].url() if len(variants) > 0 else self.url()
+
+    def thumbnail_done(
+            self,
+            date_taken: Optional[datetime.datetime] = None,
+            variants: List[Tuple[int, int, str, str]] = (),
+            settings: Optional[str] = None
+    ):
+        """The thumbnail and the variants (``(width, height, format, file_name)``) were written with ``settings``,
+        with the date found in the EXIF of the original (if any). The variants that were not written again are
+        removed.
+        """
+
+        self.thumbnail_pending = False
+        self.thumbnail_settings = settings
+        self.thumbnail_error = None
+
+        existing = dict(((v.width, v.format), v) for v in self.variants)
+        for width, height, format_, file_name in variants:
+            variant = existing.pop((width, format_), None)
+            if variant is None:
+                self.variants.append(PictureVariant.create(width, height, format_, file_name))
+            else:
+                variant.update(height, file_name)
+
+        for variant in existing.values():
+            self.variants.remove(variant)
+
+        self.picture_size = os.path.getsize(self.path()) + os.path.getsize(self.path_thumb()) \
+            + sum(v.file_size for v in self.variants)
+
+        if date_taken is not None:
+            self.date_taken = date_taken
+
+
+@event.listens_for(Picture, 'after_delete')
+def after_delete_picture(mapper, connect, target):
+    """Release (or remove) the original and remove the thumbnail after deletion from BDD"""
+    if target.blob_id is not None:
+        Blob.release_previous(connect, target.blob_id, Picture.picture_name, target.picture_name)
+        Blob.release(connect, target.blob_id)
+    elif os.path.exists(pictures_set.path(target.picture_name)):
+        os.remove(pictures_set.path(target.picture_name))
 
     thumb = pictures_set.path(target.picture_thumb_name)
     if os.path.exists(thumb):
         os.remove(thumb)
 
 
+class PictureVariant(BaseModel):
+    """Smaller version of a picture (with the same ratio), picked by the browser through ``srcset``"""
+
+    MIMETYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+    EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+
+    picture_id = db.Column(db.Integer, db.ForeignKey('picture.id'), nullable=False, index=True)
+    picture = db.relationship(
+        'Picture', uselist=False, backref=db.backref('variants', cascade='all,delete-orphan'))
+
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    format = db.Column(db.VARCHAR(length=10), nullable=False)
+    file_name = db.Column(db.VARCHAR(length=150), nullable=False)
+    file_size = db.Column(db.Integer)
+
+    @classmethod
+    def create(cls, width: int, height: int, format_: str, file_name: str):
+        o = cls()
+        o.width = width
+        o.format = format_
+        o.update(height, file_name)
+
+        return o
+
+    @classmethod
+    def get_file_name(cls, picture: Picture, width: int, format_: str) -> str:
+        return 'variants/{}_{}.{}'.format(picture.id, width, cls.EXTENSIONS[format_])
+
+    def update(self, height: int, file_name: str):
+        self.height = height
+        self.file_name = file_name
+        self.file_size = os.path.getsize(self.path())
+
+    def path(self):
+        return pictures_set.path(self.file_name)
+
+    def url(self):
+        return '{}?v={}'.format(pictures_set.url(self.file_name), self.picture.version())
+
+    def mimetype(self) -> str:
+        return self.MIMETYPES[self.format]
+
+
+@event.listens_for(PictureVariant, 'before_delete')
+def before_delete_picture_variant(mapper, connect, target):
+    """Remove file before deletion from BDD"""
+    path = pictures_set.path(target.file_name)
+    if os.path.exists(path):
+        os.remove(path)
+
+
 class Album(OrderableMixin, BaseModel):
     title = db.Column(db.Text(), nullable=False)
     description = db.Column(db.Text(), nullable=False)
@@ -408,6 +896,8 @@ class Album(OrderableMixin, BaseModel):
     thumbnail_id = db.Column(db.Integer, db.ForeignKey('picture.id'))
     thumbnail = db.relationship('Picture', uselist=False, foreign_keys=[thumbnail_id], post_update=True)
 
+    previews = None  # first pictures, when loaded (see `ordered_with_previews()`)
+
     @classmethod
     def create(cls, title: str, description: str = ''):
         o = cls()
@@ -425,14 +915,59 @@ class Album(OrderableMixin, BaseModel):
         return Picture.query.filter(Picture.album_id.is_(self.id))
 
     def ordered_pictures(self):
-        return self.query_pictures().order_by(Picture.date_taken)
+        return self.query_pictures().order_by(Picture.date_taken, Picture.id)
+
+    def paginate_pictures(self, page: int, per_page: int):
+        """Page of the ordered pictures (along with what is needed to display them), 404 if it does not exist"""
+
+        return self.ordered_pictures()\
+            .options(sqlalchemy.orm.selectinload(Picture.variants), sqlalchemy.orm.selectinload(Picture.blob))\
+            .paginate(page=page, per_page=per_page, max_per_page=per_page)
 
     def get_thumbnail(self):
         if self.thumbnail is None:
+            if self.previews is not None:
+                return self.previews[0] if len(self.previews) > 0 else None
+
             return self.query_pictures().order_by(Picture.date_taken).first()
         else:
             return self.thumbnail
 
+    @classmethod
+    def ordered_with_previews(cls, size: int = 3) -> List['Album']:
+        """Albums (the last ones first), with their thumbnail and their first ``size`` pictures (in ``previews``),
+        in a constant number of queries.
+        """
+
+        albums = cls.ordered_items(desc=True)\
+            .options(sqlalchemy.orm.selectinload(cls.thumbnail).selectinload(Picture.blob))\
+            .all()
+
+        # the first pictures of each album, at once
+        rank = sqlalchemy.func.row_number()\
+            .over(partition_by=Picture.album_id, order_by=(Picture.date_taken, Picture.id))\
+            .label('rank')
+
+        ranked = sqlalchemy.select(Picture.id, rank)\
+            .where(Picture.album_id.in_([album.id for album in albums]))\
+            .subquery()
+
+        pictures = Picture.query\
+            .join(ranked, Picture.id == ranked.c.id)\
+            .filter(ranked.c.rank <= size)\
+            .order_by(ranked.c.rank)\
+            .options(sqlalchemy.orm.selectinload(Picture.blob))\
+            .all()
+
+        previews = dict((album.id, []) for album in albums)
+        for picture in pictures:
+            previews[picture.album_id].append(picture)
+
+        for album in albums:
+            album.previews = previews[album.id]
+
+        return albums
+
 
 @event.listens_for(Album.title, 'set', named=True)
 def receive_album_title_set(target, value, oldvalue, initiator):
@@ -462,6 +997,14 @@ def receive_brief_title_set(target, value, oldvalue, initiator):
     target.slug = slugify.slugify(value)
 
 
+@event.listens_for(Page.content, 'set', named=True)
+@event.listens_for(Newsletter.content, 'set', named=True)
+@event.listens_for(Brief.content, 'set', named=True)
+def receive_text_content_set(target, value, oldvalue, initiator):
+    """Compute the content with summary once, rather than at each view"""
+    target.update_summarized_content(value)
+
+
 class Featured(OrderableMixin, BaseModel):
 
     title = db.Column(db.VARCHAR(length=150), nullable=False)
@@ -1,17 +1,20 @@
 import pathlib
 import datetime
+from urllib.parse import quote
 
 import flask
 from flask import Blueprint, views, request, send_from_directory, current_app
 from flask_login import current_user
+from sqlalchemy import func
 
 import requests
 
 import AM_Nihoul_website
-from AM_Nihoul_website import db, limiter
-from AM_Nihoul_website.base_views import RenderTemplateView, BaseMixin, ObjectManagementMixin, FormView
+from AM_Nihoul_website import db, limiter, uploads
+from AM_Nihoul_website.base_views import RenderTemplateView, BaseMixin, ObjectManagementMixin, FormView, \
+    CachedResponseMixin, ConditionalResponseMixin
 from AM_Nihoul_website.visitor.models import Page, UploadedFile, NewsletterRecipient, Newsletter, Email, Album, \
-    Brief, Featured
+    Brief, Featured, Picture, PictureVariant
 from AM_Nihoul_website.visitor.forms import NewsletterForm
 
 visitor_blueprint = Blueprint('visitor', __name__)
@@ -30,8 +33,9 @@ class IndexInfo:
         self.type = type
 
 
-class IndexView(BaseMixin, RenderTemplateView):
+class IndexView(CachedResponseMixin, BaseMixin, RenderTemplateView):
     template_name = 'index.html'
+    cache_tags = (Brief.__tablename__, Newsletter.__tablename__, Featured.__tablename__)
 
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
@@ -170,10 +174,18 @@ visitor_blueprint.add_url_rule('/robots.txt', view_func=RobotsView.as_view(name=
 
 
 # -- Pages
-class PageView(BaseMixin, ObjectManagementMixin, RenderTemplateView):
+class PageView(ConditionalResponseMixin, CachedResponseMixin, BaseMixin, ObjectManagementMixin, RenderTemplateView):
     template_name = 'page.html'
     model = Page
 
+    def get_validators(self, *args, **kwargs):
+        validators = super().get_validators(*args, **kwargs)
+
+        if self.object.next_id:
+            validators.append(self.object.next.date_modified)
+
+        return validators
+
     def get(self, *args, **kwargs):
         self.get_object_or_abort(*args, **kwargs)
         return super().get(*args, **kwargs)
@@ -210,16 +222,37 @@ class UploadView(ObjectManagementMixin, views.MethodView):
         if kwargs.get('filename') != self.object.file_name:
             flask.abort(error_code)
 
+    def get_etag(self):
+        if self.object.blob is not None:  # the same for all the files with this content
+            return self.object.blob.digest
+
+        return '{}-{}-{}'.format(self.object.id, self.object.file_size, int(self.object.date_modified.timestamp()))
+
     def get(self, *args, **kwargs):
         self.get_object_or_abort(*args, **kwargs)
 
-        with open(self.object.path(), 'rb') as fx:
-            response = flask.make_response(fx.read())
-
-        response.headers['Content-Disposition'] = 'attachment; filename={}'.format(self.object.file_name)
-        response.headers['Cache-Control'] = 'must-revalidate'
-        response.headers['Pragma'] = 'must-revalidate'
-        response.headers['Content-type'] = self.object.possible_mime
+        accel_prefix = current_app.config['X_ACCEL_REDIRECT_PREFIX']
+        if accel_prefix is not None:
+            # let nginx send the file (and handle ranges)
+            response = flask.Response(mimetype=self.object.possible_mime)
+            response.headers['X-Accel-Redirect'] = accel_prefix + quote(self.object.path_in_set())
+            response.headers['Content-Disposition'] = 'attachment; filename={}'.format(self.object.file_name)
+            response.set_etag(self.get_etag())
+            response.last_modified = self.object.date_modified
+            response.make_conditional(request)
+        else:
+            # streamed (or sent by the server if `USE_X_SENDFILE`), with support for ranges
+            response = flask.send_file(
+                pathlib.Path(self.object.path()).resolve(),  # otherwise, relative to the app
+                mimetype=self.object.possible_mime,
+                as_attachment=True,
+                download_name=self.object.file_name,
+                etag=self.get_etag(),
+                last_modified=self.object.date_modified,
+                conditional=True
+            )
+
+        response.cache_control.must_revalidate = True
 
         return response
 
@@ -227,9 +260,21 @@ class UploadView(ObjectManagementMixin, views.MethodView):
 visitor_blueprint.add_url_rule('/fichier/<int:id>/<string:filename>', view_func=UploadView.as_view(name='upload-view'))
 
 
-@visitor_blueprint.route('/photos/<string:filename>')
+@visitor_blueprint.route('/photos/<path:filename>')  # variants are in a subdirectory
 def get_picture(filename):
-    return send_from_directory(pathlib.Path('..') / current_app.config['UPLOADED_PICTURES_DEST'], filename)
+    if 'v' not in request.args and not filename.startswith(uploads.BLOBS_DIRECTORY + '/'):
+        return send_from_directory(pathlib.Path('..') / current_app.config['UPLOADED_PICTURES_DEST'], filename)
+
+    # versioned URL (see `Picture.url()`) or named after the content (see `Blob`), which never changes
+    response = send_from_directory(
+        pathlib.Path('..') / current_app.config['UPLOADED_PICTURES_DEST'],
+        filename,
+        max_age=current_app.config['PICTURES_MAX_AGE'])
+
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+
+    return response
 
 
 # -- Newsletter
@@ -348,9 +393,13 @@ visitor_blueprint.add_url_rule(
     view_func=NewsletterUnsubscribeView.as_view(name='newsletter-unsubscribe'))
 
 
-class NewsletterView(BaseMixin, ObjectManagementMixin, RenderTemplateView):
+class NewsletterView(
+        ConditionalResponseMixin, CachedResponseMixin, BaseMixin, ObjectManagementMixin, RenderTemplateView):
     template_name = 'newsletter.html'
     model = Newsletter
+    cache_tags = (Newsletter.__tablename__, )  # for the next one
+
+    next_newsletter = None
 
     def get(self, *args, **kwargs):
         self.get_object_or_abort(*args, **kwargs)
@@ -365,17 +414,32 @@ class NewsletterView(BaseMixin, ObjectManagementMixin, RenderTemplateView):
         if self.object.slug != kwargs.get('slug'):
             flask.abort(error_code)
 
+    def get_next_newsletter(self):
+        if self.next_newsletter is None:
+            self.next_newsletter = Newsletter.query\
+                .filter(Newsletter.draft.is_(False))\
+                .filter(Newsletter.date_published < self.object.date_published)\
+                .filter(Newsletter.id.isnot(self.object.id))\
+                .order_by(Newsletter.date_published.desc())\
+                .first()
+
+        return self.next_newsletter
+
+    def get_validators(self, *args, **kwargs):
+        validators = super().get_validators(*args, **kwargs)
+
+        next_newsletter = self.get_next_newsletter()
+        if next_newsletter is not None:
+            validators.extend([next_newsletter.id, next_newsletter.date_modified])
+
+        return validators
+
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
         ctx['newsletter'] = self.object
 
         # next?
-        next_newsletter = Newsletter.query\
-            .filter(Newsletter.draft.is_(False))\
-            .filter(Newsletter.date_published < self.object.date_published)\
-            .filter(Newsletter.id.isnot(self.object.id))\
-            .order_by(Newsletter.date_published.desc())\
-            .first()
+        next_newsletter = self.get_next_newsletter()
 
         if next_newsletter is not None:
             ctx['next_newsletter'] = next_newsletter
@@ -387,8 +451,9 @@ visitor_blueprint.add_url_rule(
     '/infolettre/<int:id>-<string:slug>.html', view_func=NewsletterView.as_view(name='newsletter-view'))
 
 
-class NewslettersView(BaseMixin, RenderTemplateView):
+class NewslettersView(CachedResponseMixin, BaseMixin, RenderTemplateView):
     template_name = 'newsletters.html'
+    cache_tags = (Newsletter.__tablename__, )
 
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
@@ -404,14 +469,15 @@ visitor_blueprint.add_url_rule('/infolettres.html', view_func=NewslettersView.as
 
 
 # -- ALBUMS
-class AlbumsView(BaseMixin, RenderTemplateView):
+class AlbumsView(CachedResponseMixin, BaseMixin, RenderTemplateView):
     template_name = 'albums.html'
+    cache_tags = (Album.__tablename__, Picture.__tablename__)
 
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
 
-        # fetch albums
-        ctx['albums'] = Album.ordered_items(desc=True)
+        # fetch albums (and their first pictures)
+        ctx['albums'] = Album.ordered_with_previews()
 
         return ctx
 
@@ -419,13 +485,19 @@ class AlbumsView(BaseMixin, RenderTemplateView):
 visitor_blueprint.add_url_rule('/albums.html', view_func=AlbumsView.as_view(name='albums'))
 
 
-class AlbumView(BaseMixin, ObjectManagementMixin, RenderTemplateView):
-    model = Album
-    template_name = 'album.html'
+class AlbumPagesMixin:
+    """Pictures of the album by pages of ``ALBUM_PAGE_SIZE`` (``?page=``)"""
 
-    def get(self, *args, **kwargs):
-        self.get_object_or_abort(*args, **kwargs)
-        return super().get(*args, **kwargs)
+    cache_query_args = ('page', )
+
+    def get_page(self) -> int:
+        return request.args.get('page', 1, type=int)
+
+    def get_pagination(self):
+        return self.object.paginate_pictures(self.get_page(), current_app.config['ALBUM_PAGE_SIZE'])
+
+    def get_page_url(self, page: int, endpoint: str = 'visitor.album') -> str:
+        return flask.url_for(endpoint, id=self.object.id, slug=self.object.slug, page=page if page > 1 else None)
 
     def get_object_or_abort(self, error_code=404, *args, **kwargs):
         super().get_object_or_abort(error_code, *args, **kwargs)
@@ -433,11 +505,46 @@ class AlbumView(BaseMixin, ObjectManagementMixin, RenderTemplateView):
         if self.object.slug != kwargs.get('slug'):
             flask.abort(error_code)
 
+
+class AlbumView(
+        AlbumPagesMixin,
+        ConditionalResponseMixin,
+        CachedResponseMixin,
+        BaseMixin,
+        ObjectManagementMixin,
+        RenderTemplateView):
+    model = Album
+    template_name = 'album.html'
+    cache_tags = (Picture.__tablename__, PictureVariant.__tablename__)
+
+    def get_validators(self, *args, **kwargs):
+        validators = super().get_validators(*args, **kwargs)
+
+        # pictures
+        validators.extend(self.object.query_pictures()
+                          .with_entities(func.count(Picture.id), func.max(Picture.date_modified))
+                          .first())
+
+        validators.append(self.get_page())
+
+        return validators
+
+    def get(self, *args, **kwargs):
+        self.get_object_or_abort(*args, **kwargs)
+        return super().get(*args, **kwargs)
+
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
 
+        pagination = self.get_pagination()
+
         ctx['album'] = self.object
-        ctx['pictures'] = sorted(self.object.pictures, key=lambda k: k.date_taken)
+        ctx['pictures'] = pagination.items
+        ctx['pagination'] = pagination
+        ctx['previous_url'] = self.get_page_url(pagination.prev_num) if pagination.has_prev else None
+        ctx['next_url'] = self.get_page_url(pagination.next_num) if pagination.has_next else None
+        ctx['next_json_url'] = \
+            self.get_page_url(pagination.next_num, 'visitor.album-pictures') if pagination.has_next else None
 
         return ctx
 
@@ -445,9 +552,37 @@ class AlbumView(BaseMixin, ObjectManagementMixin, RenderTemplateView):
 visitor_blueprint.add_url_rule('/album-<int:id>-<string:slug>.html', view_func=AlbumView.as_view(name='album'))
 
 
+class AlbumPicturesView(AlbumPagesMixin, CachedResponseMixin, ObjectManagementMixin, views.MethodView):
+    """Page of pictures of an album as JSON, for the lightbox (which loads the next ones as they are needed)"""
+
+    methods = ['GET']
+    model = Album
+    cache_tags = (Picture.__tablename__, PictureVariant.__tablename__)
+
+    def get(self, *args, **kwargs):
+        self.get_object_or_abort(*args, **kwargs)
+
+        pagination = self.get_pagination()
+
+        return flask.jsonify(
+            pictures=[{
+                'src': picture.url_largest(),
+                'thumb': picture.url_thumb(),
+                'srcset': picture.srcset(),
+                'sources': [{'srcset': picture.srcset('webp'), 'type': 'image/webp'}] if picture.srcset('webp') else [],
+            } for picture in pagination.items],
+            next=self.get_page_url(pagination.next_num, 'visitor.album-pictures') if pagination.has_next else None
+        )
+
+
+visitor_blueprint.add_url_rule(
+    '/album-<int:id>-<string:slug>.json', view_func=AlbumPicturesView.as_view(name='album-pictures'))
+
+
 # -- Brief
-class BriefsView(BaseMixin, RenderTemplateView):
+class BriefsView(CachedResponseMixin, BaseMixin, RenderTemplateView):
     template_name = 'briefs.html'
+    cache_tags = (Brief.__tablename__, )
 
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
@@ -458,9 +593,12 @@ class BriefsView(BaseMixin, RenderTemplateView):
 visitor_blueprint.add_url_rule('/brèves.html', view_func=BriefsView.as_view(name='briefs'))
 
 
-class BriefView(BaseMixin, ObjectManagementMixin, RenderTemplateView):
+class BriefView(ConditionalResponseMixin, CachedResponseMixin, BaseMixin, ObjectManagementMixin, RenderTemplateView):
     template_name = 'brief.html'
     model = Brief
+    cache_tags = (Brief.__tablename__, )  # for the next one
+
+    next_brief = None
 
     def get(self, *args, **kwargs):
         self.get_object_or_abort(*args, **kwargs)
@@ -475,16 +613,31 @@ class BriefView(BaseMixin, ObjectManagementMixin, RenderTemplateView):
         if not self.object.visible and not current_user.is_authenticated:
             flask.abort(error_code)  # cannot access directly a non-visible page if not connected
 
+    def get_next_brief(self):
+        if self.next_brief is None:
+            self.next_brief = Brief.query\
+                .filter(Brief.visible.is_(True))\
+                .order_by(Brief.id.desc())\
+                .filter(Brief.id < self.object.id)\
+                .first()
+
+        return self.next_brief
+
+    def get_validators(self, *args, **kwargs):
+        validators = super().get_validators(*args, **kwargs)
+
+        next_brief = self.get_next_brief()
+        if next_brief is not None:
+            validators.extend([next_brief.id, next_brief.date_modified])
+
+        return validators
+
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
         ctx['brief'] = self.object
 
         # next?
-        next_brief = Brief.query\
-            .filter(Brief.visible.is_(True))\
-            .order_by(Brief.id.desc())\
-            .filter(Brief.id < self.object.id)\
-            .first()
+        next_brief = self.get_next_brief()
 
         if next_brief is not None:
             ctx['next_brief'] = next_brief